@@ -1,19 +1,21 @@
 import pandas as pd
 import glob
+import functools
 import os
-import matplotlib.pyplot as plt
-from adtk.data import validate_series
-from adtk.detector import ThresholdAD, InterQuartileRangeAD, PersistAD, LevelShiftAD, VolatilityShiftAD
+from instrumentation import instrument_stage, add_rows
+from date_parsing import parse_datetimes
+from prefetch import prefetch_files
+from results_store import open_results_store, start_run, insert_detections, CONSENSUS, RESULTS_DB
 
 def process_datamill(file_path):
     df = pd.read_csv(file_path)
-    df['READING_START_DATE'] = pd.to_datetime(df['READING_START_DATE'], format='%d/%m/%Y %H:%M')
+    df['READING_START_DATE'] = parse_datetimes(df['READING_START_DATE'], format='%d/%m/%Y %H:%M')
     df = df.set_index('READING_START_DATE')
     return df['GROSS_CONSUMPTION']
 
 def process_helios(file_path, option):
     df = pd.read_csv(file_path)
-    df['datetime'] = pd.to_datetime(df['datetime'], format='%d/%m/%Y %H:%M:%S')
+    df['datetime'] = parse_datetimes(df['datetime'], format='%d/%m/%Y %H:%M:%S')
     df = df.set_index('datetime')
     if option == 'daily':
         return df['diff']
@@ -22,15 +24,30 @@ def process_helios(file_path, option):
 
 def process_queensland(file_path, option):
     df = pd.read_csv(file_path,sep=',')
-    df['datetime'] = pd.to_datetime(df['datetime'], format='%d/%m/%Y %H:%M:%S')
+    df['datetime'] = parse_datetimes(df['datetime'], format='%d/%m/%Y %H:%M:%S')
     df = df.set_index('datetime')
     if option == 'daily':
         return df['Pulse1']
     else:  # pulse1_total
         return df['Pulse1_Total']
 
+def read_meter_series(file_path, dataset_type, option):
+    if dataset_type == 'datamill':
+        return process_datamill(file_path)
+    elif dataset_type == 'helios':
+        return process_helios(file_path, option)
+    elif dataset_type == 'queensland':
+        return process_queensland(file_path, option)
+    raise ValueError(f"Unknown dataset type: {dataset_type}")
+
+@instrument_stage()
 def detect_anomalies(s, contamination, z_score_threshold):
+    # Detector backends are imported here, so importing this module stays fast
+    from adtk.data import validate_series
+    from adtk.detector import ThresholdAD, InterQuartileRangeAD, PersistAD, LevelShiftAD, VolatilityShiftAD
+
     s = validate_series(s)
+    add_rows(len(s))
     
     threshold_ad = ThresholdAD(high=s.mean() + z_score_threshold * s.std(), 
                                low=s.mean() - z_score_threshold * s.std())
@@ -54,6 +71,8 @@ def detect_anomalies(s, contamination, z_score_threshold):
 
 
 def plot_consensus_anomalies(s, anomalies, file_path):
+    import matplotlib.pyplot as plt
+
     # Calculate the consensus anomalies where all models agree
     consensus_anomalies = pd.DataFrame(anomalies).all(axis=1)
 
@@ -86,23 +105,36 @@ def plot_consensus_anomalies(s, anomalies, file_path):
     plt.show()
 
 
+@instrument_stage()
 def main(folder_path, dataset_type, option, contamination, z_score_threshold):
     file_list = glob.glob(os.path.join(folder_path, '*.csv'))
+
+    # Every run is kept in the results store for later meter and time queries
+    store = open_results_store()
+    run_id = start_run(store, 'adtk', dataset_type, option, {'contamination': contamination,
+                                                             'z_score_threshold': z_score_threshold}) if store else None
     
-    for file_path in file_list:
+    # The next files are read while the detectors run on the current one
+    load = functools.partial(read_meter_series, dataset_type=dataset_type, option=option)
+    for file_path, s in prefetch_files(file_list, load):
         print(f"Processing file: {file_path}")
         
-        if dataset_type == 'datamill':
-            s = process_datamill(file_path)
-        elif dataset_type == 'helios':
-            s = process_helios(file_path, option)
-        elif dataset_type == 'queensland':
-            s = process_queensland(file_path, option)
-        
         anomalies = detect_anomalies(s, contamination, z_score_threshold)
         
         total_consensus_anomalies = sum(pd.DataFrame(anomalies).all(axis=1))
         print(f"Total consensus anomalies across all models: {total_consensus_anomalies}")
+
+        if store is not None:
+            # ADTK detectors give flags only, so they are stored without a score. A meter whose flags cannot be
+            # aligned (e.g. a duplicated timestamp) is reported and the run goes on.
+            try:
+                flags = pd.DataFrame(anomalies).reindex(s.index).fillna(False).astype(bool)
+                model_results = {name: (None, flags[name], flags[name]) for name in flags}
+                model_results[CONSENSUS] = (None, flags.all(axis=1), flags.all(axis=1))
+                insert_detections(store, run_id, dataset_type, os.path.basename(file_path)[:-len('.csv')], s.index,
+                                  model_results, s.to_numpy())
+            except Exception as e:
+                print(f"Error saving results of {file_path} to {RESULTS_DB}: {e}")
         
         plot_consensus_anomalies(s, anomalies, file_path)
 
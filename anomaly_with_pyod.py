@@ -1,20 +1,26 @@
 import os
+import time
+import functools
 import pandas as pd
 import numpy as np
-from pyod.models.iforest import IForest
-from pyod.models.knn import KNN
-from pyod.models.lof import LOF
-from pyod.models.auto_encoder import AutoEncoder
-from sklearn.preprocessing import StandardScaler
-import matplotlib.pyplot as plt
+from instrumentation import instrument_stage, stage_metrics, add_rows
+from date_parsing import parse_datetimes
+from detector_scoring import score_model
+from results_store import open_results_store, start_run, store_results
+from prefetch import prefetch_files
+from data_quality import mask_differences
+from detector_routing import plan_detectors, planned_models, record_cost, report_plan
 
-def process_file(file_path, dataset_type, option, contamination=0.01, models=None, z_score_threshold=3):
-    # Read the CSV file
-    df = pd.read_csv(file_path, sep=';') if 'helios' in dataset_type else pd.read_csv(file_path)
+def prepare_features(file_path, dataset_type, option):
+    from sklearn.preprocessing import StandardScaler
+
+    # Read the CSV file; the sorted Helios files are comma-separated after replace_semicolon.py like the others
+    df = pd.read_csv(file_path)
+    add_rows(len(df))
 
     # Convert datetime to pandas datetime
     if dataset_type == 'helios':
-        df['datetime'] = pd.to_datetime(df['datetime'], format='%d/%m/%Y %H:%M:%S')
+        df['datetime'] = parse_datetimes(df['datetime'], format='%d/%m/%Y %H:%M:%S')
         if option == 'daily':
             df['diff'] = df['diff']
         elif option == 'total':
@@ -22,7 +28,7 @@ def process_file(file_path, dataset_type, option, contamination=0.01, models=Non
 
     elif dataset_type == 'queensland':
         try:
-            df['datetime'] = pd.to_datetime(df['datetime'], format='%d/%m/%Y %H:%M:%S')
+            df['datetime'] = parse_datetimes(df['datetime'], format='%d/%m/%Y %H:%M:%S')
             if option == 'daily':
                 df['diff'] = df['Pulse1'].diff()
             elif option == 'total':
@@ -33,12 +39,15 @@ def process_file(file_path, dataset_type, option, contamination=0.01, models=Non
             raise
     
     elif dataset_type == 'datamill':
-        df['datetime'] = pd.to_datetime(df['READING_START_DATE'], format='%d/%m/%Y %H:%M')
+        df['datetime'] = parse_datetimes(df['READING_START_DATE'], format='%d/%m/%Y %H:%M')
         if option == 'daily':
             df['diff'] = df['DAILY_AVERAGE_CONSUMPTION'].diff()
         else:
             df['diff'] = df['GROSS_CONSUMPTION'].diff()
 
+    # Duplicates, gaps and counter resets flagged by the sort stage are not consumption
+    mask_differences(df, file_path)
+
     # Sort by datetime
     df = df.sort_values('datetime')
 
@@ -66,21 +75,47 @@ def process_file(file_path, dataset_type, option, contamination=0.01, models=Non
     scaler = StandardScaler()
     X_scaled = scaler.fit_transform(X)
 
+    return df, X_scaled
+
+@instrument_stage()
+def process_file(file_path, dataset_type, option, contamination=0.01, models=None, z_score_threshold=3,
+                 tuned_autoencoder=False, prepared=None, timings=None):
+    # prepared holds the (df, X_scaled) of prepare_features when the file was read ahead.
+    # Seconds spent on each model are added to timings when a dict is passed.
+    if prepared is not None:
+        df, X_scaled = prepared
+        add_rows(len(df))
+    else:
+        df, X_scaled = prepare_features(file_path, dataset_type, option)
+    if tuned_autoencoder:
+        from autoencoder_cpu import fit_autoencoder_cpu
+
     # Initialize results dictionary
     results = {}
 
     # Anomaly Detection Models
     for model_name, model in models.items():
-        model.fit(X_scaled)
-        outlier_scores = model.decision_function(X_scaled)
-        df[f'{model_name}_anomaly_score'] = outlier_scores
-        df[f'{model_name}_is_anomaly'] = model.predict(X_scaled)
-        df[f'{model_name}_is_validated_anomaly'] = (df[f'{model_name}_is_anomaly'] == 1) & (abs(df['z_score']) > z_score_threshold)
+        start = time.perf_counter()
+        with stage_metrics(f'anomaly_with_pyod.{model_name}.fit', file_path) as metrics:
+            metrics.add_rows(len(X_scaled))
+            if model_name == 'AutoEncoder' and tuned_autoencoder:
+                fit_autoencoder_cpu(model, X_scaled)
+            else:
+                model.fit(X_scaled)
+        # Scores, labels and validated flags from one scoring pass
+        scores, labels, validated = score_model(model, X_scaled, df['z_score'].to_numpy(), z_score_threshold)
+        df[f'{model_name}_anomaly_score'] = scores
+        df[f'{model_name}_is_anomaly'] = labels
+        df[f'{model_name}_is_validated_anomaly'] = validated
+        if timings is not None:
+            timings[model_name] = time.perf_counter() - start
         results[model_name] = df[f'{model_name}_is_validated_anomaly'].sum()
 
     return df, results
 
 def plot_results(df, user_key, dataset_type, results):
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(12, 6))
     x = df['datetime']
     y = df['diff']
@@ -100,71 +135,110 @@ def plot_results(df, user_key, dataset_type, results):
     plt.tight_layout()
     plt.show()
 
-def main(folder_path, dataset_type, option, contamination, z_score_threshold):
+@instrument_stage()
+def main(folder_path, dataset_type, option, contamination, z_score_threshold, tuned_autoencoder=False, budget=None):
+    # Detector backends are imported here, so importing this module stays fast
+    from pyod.models.iforest import IForest
+    from pyod.models.knn import KNN
+    from pyod.models.lof import LOF
+    from pyod.models.auto_encoder import AutoEncoder
+    from autoencoder_cpu import cpu_autoencoder
+
     # Define models
     models = {
         'IForest': IForest(contamination=contamination, random_state=42),
         'KNN': KNN(contamination=contamination, n_neighbors=5),
         'LOF': LOF(contamination=contamination),
-        'AutoEncoder': AutoEncoder(contamination=contamination, epoch_num=10)
+        'AutoEncoder': cpu_autoencoder(contamination) if tuned_autoencoder else AutoEncoder(contamination=contamination, epoch_num=10)
     }
+
+    # Every run is kept in the results store for later meter and time queries
+    store = open_results_store()
+    run_id = start_run(store, 'pyod', dataset_type, option, {'contamination': contamination, 'z_score_threshold': z_score_threshold,
+                                                             'tuned_autoencoder': tuned_autoencoder}) if store else None
     
-    for filename in os.listdir(folder_path):
-        if filename.endswith('.csv'):
-            file_path = os.path.join(folder_path, filename)
-            
-            df, results = process_file(file_path, dataset_type, option, contamination, models, z_score_threshold)
-            
-            user_key = filename
-            
-            print(f"Processing data for file: {filename}")
-            print(f"Total data points: {len(df)}")
-            for model_name, count in results.items():
-                print(f"{model_name} validated anomalies: {count}")
-            
-            # Plot the results
-            plot_results(df, user_key, dataset_type, results)
-
-# Get user input for dataset type
-dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
-while dataset_type not in ['helios', 'queensland', 'datamill']:
-    dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
-
-# Get user input for options
-if dataset_type == 'helios':
-    option = input("Enter option (daily/total): ").lower()
-    while option not in ['daily', 'total']:
-        option = input("Invalid input. Please enter 'daily' or 'total': ").lower()
-elif dataset_type == 'queensland':
-    option = input("Enter option (daily/total): ").lower()
-    while option not in ['daily', 'total']:
-        option = input("Invalid input. Please enter 'daily' or 'total': ").lower()
-elif dataset_type == 'datamill':
-    option = input("Enter option (daily/total): ").lower()
-    while option not in ['daily', 'total']:
-        option = input("Invalid input. Please enter 'daily' or 'total': ").lower()
-# Get user input for Z-score and contamination
-try:
-    z_score_threshold = float(input("Enter Z-score threshold (default 1 for datamill and helios 3 for queensland): "))
-except ValueError:
-    print("Invalid Z-score threshold. Using default value of 3.")
-    z_score_threshold = 3
-
-try:
-    contamination = float(input("Enter contamination factor (default 0.01): "))
-except ValueError:
-    print("Invalid contamination factor. Using default value of 0.01.")
-    contamination = 0.01
-
-# Set the folder path based on the dataset type
-if dataset_type == 'helios':
-    folder_path = './dataset/helios/user_helios_sorted/'
-elif dataset_type == 'queensland':
-    if option == 'daily':
-        folder_path = './dataset/queensland/user_sorted_pulse/'
+    # Detectors per meter from their estimated cost (within budget seconds if one is set), longest meters first
+    file_paths = [os.path.join(folder_path, filename) for filename in os.listdir(folder_path) if filename.endswith('.csv')]
+    plan = plan_detectors(file_paths, models, 'fit', features=5, budget=budget)
+
+    # The next files are read while the models are fitted on the current one
+    load = functools.partial(prepare_features, dataset_type=dataset_type, option=option)
+    for file_path, prepared in prefetch_files(plan['order'], load):
+        filename = os.path.basename(file_path)
+        meter_models = planned_models(plan, file_path, models)
+        if not meter_models:
+            print(f"Skipping file {filename}: too short for every detector")
+            continue
+
+        timings = {}
+        df, results = process_file(file_path, dataset_type, option, contamination, meter_models, z_score_threshold,
+                                   tuned_autoencoder, prepared, timings)
+        record_cost(plan, file_path, timings)
+        
+        user_key = filename
+        add_rows(len(df))
+        
+        print(f"Processing data for file: {filename}")
+        print(f"Total data points: {len(df)}")
+        for model_name, count in results.items():
+            print(f"{model_name} validated anomalies: {count}")
+        store_results(store, run_id, dataset_type, filename[:-len('.csv')], df, meter_models, 'diff')
+        
+        # Plot the results
+        plot_results(df, user_key, dataset_type, results)
+
+    report_plan(plan)
+
+if __name__ == "__main__":
+    # Get user input for dataset type
+    dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
+    while dataset_type not in ['helios', 'queensland', 'datamill']:
+        dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
+
+    # Get user input for options
+    if dataset_type == 'helios':
+        option = input("Enter option (daily/total): ").lower()
+        while option not in ['daily', 'total']:
+            option = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+    elif dataset_type == 'queensland':
+        option = input("Enter option (daily/total): ").lower()
+        while option not in ['daily', 'total']:
+            option = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+    elif dataset_type == 'datamill':
+        option = input("Enter option (daily/total): ").lower()
+        while option not in ['daily', 'total']:
+            option = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+    # Get user input for Z-score and contamination
+    try:
+        z_score_threshold = float(input("Enter Z-score threshold (default 3 for helios, 1 for queensland and datamill): "))
+    except ValueError:
+        # A 7 row window never gives a z-score above 2.27, so 3 is only used with the 24 row Helios window
+        z_score_threshold = 3 if dataset_type == 'helios' else 1
+        print(f"Invalid Z-score threshold. Using default value of {z_score_threshold}.")
+
+    try:
+        contamination = float(input("Enter contamination factor (default 0.01): "))
+    except ValueError:
+        print("Invalid contamination factor. Using default value of 0.01.")
+        contamination = 0.01
+
+    # Set the folder path based on the dataset type
+    if dataset_type == 'helios':
+        folder_path = './dataset/helios/user_helios_sorted/'
+    elif dataset_type == 'queensland':
+        if option == 'daily':
+            folder_path = './dataset/queensland/user_sorted_pulse/'
+        else:
+            folder_path = './dataset/queensland/user_sorted_pulsetot/'
     else:
-        folder_path = './dataset/queensland/user_sorted_pulsetot/'
-else:
-    folder_path = './dataset/datamill/user_datamill_sorted/'
+        folder_path = './dataset/datamill/user_datamill_sorted/'
+
+    tuned_autoencoder = input("Use the tuned CPU AutoEncoder training with early stopping? (yes/no, default no): ").strip().lower() in ['y', 'yes']
+
+    try:
+        budget = float(input("Enter detector time budget in seconds (default WATER_DETECTOR_BUDGET, 0 runs every detector): "))
+    except ValueError:
+        print("Invalid detector budget. Using the default budget.")
+        budget = None
 
-main(folder_path, dataset_type, option, contamination, z_score_threshold)
+    main(folder_path, dataset_type, option, contamination, z_score_threshold, tuned_autoencoder, budget)
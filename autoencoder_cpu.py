@@ -0,0 +1,154 @@
+import os
+import copy
+import time
+import shutil
+import tempfile
+import numpy as np
+import torch
+from sklearn.utils import check_array
+from pyod.models.auto_encoder import AutoEncoder
+
+# Thread counts for CPU training; by default torch picks them from the number of cores.
+# Intra-op threads split one operation (a matrix product), inter-op threads run independent operations.
+TORCH_THREADS = int(os.environ.get('WATER_TORCH_THREADS', '0'))
+TORCH_INTEROP_THREADS = int(os.environ.get('WATER_TORCH_INTEROP_THREADS', '0'))
+
+# Rows per mini-batch of the tuned path; much larger than the pyod default of 32
+CPU_BATCH_SIZE = 1024
+
+# Same epsilon as pyod's TorchDataset, so scores match the standard AutoEncoder
+STD_EPS = 1e-8
+
+def configure_torch_threads(threads=None, interop_threads=None):
+    threads = threads or TORCH_THREADS
+    interop_threads = interop_threads or TORCH_INTEROP_THREADS
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # Only possible before torch runs its first parallel operation in this process
+            print(f"Inter-op threads could not be changed: {e}")
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+def cpu_autoencoder(contamination=0.01, max_epochs=50, batch_size=CPU_BATCH_SIZE, lr=1e-3, random_state=42):
+    # pyod AutoEncoder with settings for fit_autoencoder_cpu; it is saved and used like any other model
+    return AutoEncoder(contamination=contamination, epoch_num=max_epochs, batch_size=batch_size, lr=lr,
+                       device='cpu', random_state=random_state, verbose=0)
+
+def write_training_memmap(X, mean, std, memmap_folder, seed=42, chunk_rows=65536):
+    # Normalised float32 copy of the training rows in a random order, on disk. Mini-batches are then
+    # contiguous slices of the file, and shuffling batch order each epoch gives a random pass over the data.
+    path = os.path.join(memmap_folder, 'training_features.npy')
+    order = np.random.default_rng(seed).permutation(len(X))
+    data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=X.shape)
+    for start in range(0, len(X), chunk_rows):
+        rows = order[start:start + chunk_rows]
+        data[start:start + len(rows)] = (X[rows] - mean) / (std + STD_EPS)
+    data.flush()
+    return data
+
+def autocast_context(compute_dtype):
+    if compute_dtype == 'bfloat16':
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return torch.autocast('cpu', enabled=False)
+
+def holdout_loss(model, data, start, stop, batch_size, compute_dtype):
+    # Mean squared reconstruction error of the held-out rows
+    model.model.eval()
+    total = 0.0
+    with torch.no_grad(), autocast_context(compute_dtype):
+        for low in range(start, stop, batch_size):
+            x = torch.from_numpy(np.asarray(data[low:min(low + batch_size, stop)]))
+            total += float(((model.model(x).float() - x) ** 2).sum())
+    model.model.train()
+    return total / max((stop - start) * data.shape[1], 1)
+
+def score_autoencoder(model, X, batch_size=65536, compute_dtype='float32'):
+    # Reconstruction distance of every row, the same score as AutoEncoder.decision_function,
+    # computed on whole blocks of rows instead of through a per-row dataset
+    X = np.asarray(X)
+    scores = np.empty(len(X))
+    model.model.eval()
+    with torch.no_grad(), autocast_context(compute_dtype):
+        for start in range(0, len(X), batch_size):
+            block = X[start:start + batch_size]
+            if model.preprocessing:
+                block = (block - model.X_mean) / (model.X_std + STD_EPS)
+            x = torch.from_numpy(np.ascontiguousarray(block, dtype=np.float32))
+            scores[start:start + len(block)] = torch.sqrt(((x - model.model(x).float()) ** 2).sum(dim=1)).numpy()
+    return scores
+
+def fit_autoencoder_cpu(model, X, validation_fraction=0.1, patience=3, min_delta=1e-4, compute_dtype='float32',
+                        threads=None, interop_threads=None, memmap_folder=None, seed=42):
+    # Trains a pyod AutoEncoder with large mini-batches read from a memory-mapped feature file and stops
+    # when the reconstruction loss of a held-out part of the rows stops improving for patience epochs.
+    # model.epoch_num is the maximum number of epochs. compute_dtype is 'float32' or 'bfloat16'.
+    threads, interop_threads = configure_torch_threads(threads, interop_threads)
+    X = check_array(X)
+    model._set_n_classes(None)
+    model.data_num, model.feature_size = X.shape
+    model._set_seed(model.random_state)
+    model.build_model()
+    model.training_prepare()
+
+    if model.preprocessing:
+        model.X_mean = np.mean(X, axis=0)
+        model.X_std = np.std(X, axis=0)
+        mean, std = model.X_mean, model.X_std
+    else:
+        mean, std = 0.0, 0.0
+
+    own_folder = memmap_folder is None
+    memmap_folder = memmap_folder or tempfile.mkdtemp(prefix='water_autoencoder_')
+    try:
+        data = write_training_memmap(X, mean, std, memmap_folder, seed)
+        holdout = int(len(X) * validation_fraction) if len(X) * validation_fraction >= 1 else 0
+        train_rows = len(X) - holdout
+        batch_starts = np.arange(0, train_rows, model.batch_size)
+        rng = np.random.default_rng(seed)
+
+        best_loss = np.inf
+        best_state = None
+        stale_epochs = 0
+        model.training_history_ = []
+        for epoch in range(model.epoch_num):
+            start_time = time.perf_counter()
+            losses = []
+            with autocast_context(compute_dtype):
+                for start in rng.permutation(batch_starts):
+                    stop = min(start + model.batch_size, train_rows)
+                    # BatchNorm needs more than one row per batch
+                    if stop - start < 2:
+                        continue
+                    losses.append(model.training_forward(torch.from_numpy(np.asarray(data[start:stop]))))
+
+            train_loss = float(np.mean(losses)) if losses else np.nan
+            loss = holdout_loss(model, data, train_rows, len(X), model.batch_size, compute_dtype) if holdout else train_loss
+            model.training_history_.append({'epoch': epoch + 1, 'train_loss': train_loss, 'holdout_loss': loss,
+                                            'seconds': time.perf_counter() - start_time})
+
+            if loss < best_loss - min_delta:
+                best_loss = loss
+                best_state = copy.deepcopy(model.model.state_dict())
+                model.best_epoch_ = epoch + 1
+                stale_epochs = 0
+            else:
+                stale_epochs += 1
+                if stale_epochs >= patience:
+                    print(f"AutoEncoder stopped early after {epoch + 1} epochs, best epoch {model.best_epoch_}")
+                    break
+    finally:
+        if own_folder:
+            shutil.rmtree(memmap_folder, ignore_errors=True)
+
+    if best_state is not None:
+        model.model.load_state_dict(best_state)
+    model.model.eval()
+    model.training_threads_ = (threads, interop_threads)
+    model.compute_dtype_ = compute_dtype
+
+    model.decision_scores_ = score_autoencoder(model, X, compute_dtype=compute_dtype)
+    model._process_decision_scores()
+    return model
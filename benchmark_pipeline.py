@@ -0,0 +1,569 @@
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import platform
+import resource
+import tempfile
+import tracemalloc
+import contextlib
+import multiprocessing as mp
+from datetime import datetime
+
+from generate_synthetic_data import generate_datasets, generate_meter_file
+
+# Stages of the pipeline for each dataset in the order they run.
+# Each entry is (stage name, input folder, callable name, arguments); arguments starting with './' are
+# folders relative to the dataset root.
+PIPELINE_STAGES = {
+    'datamill': [
+        ('split_datasets', 'org_dataset', 'split_datasets.process_datamill_dataset',
+         ['./org_dataset', './user_dataset']),
+        ('sort_time', 'user_dataset', 'sort_time.sort_and_save_datamill',
+         ['./user_dataset', './user_datamill_sorted']),
+        ('train', 'user_datamill_sorted', 'train_whole_dataset.train_and_save_models',
+         ['./user_datamill_sorted', 'GROSS_CONSUMPTION', './models/total']),
+        ('predict', 'user_datamill_sorted', 'predict_whole_dataset.main',
+         ['./user_datamill_sorted', './models/total', 'datamill', 'total', 'GROSS_CONSUMPTION']),
+        ('adtk', 'user_datamill_sorted', 'anomaly_with_adtk.main',
+         ['./user_datamill_sorted', 'datamill', 'default', 0.01, 1])
+    ],
+    'queensland': [
+        ('split_datasets', 'org_dataset', 'split_datasets.preprocess_queensland',
+         ['./org_dataset', './dataset_correct']),
+        ('split_datasets', 'dataset_correct', 'split_datasets.split_queensland',
+         ['./dataset_correct', './pulse', './pulsetotal']),
+        ('sort_time', 'pulsetotal', 'sort_time.sort_and_save_queensland',
+         ['./pulsetotal', './user_sorted_pulsetot']),
+        ('train', 'user_sorted_pulsetot', 'train_whole_dataset.train_and_save_models',
+         ['./user_sorted_pulsetot', 'Pulse1_Total', './models/total']),
+        ('predict', 'user_sorted_pulsetot', 'predict_whole_dataset.main',
+         ['./user_sorted_pulsetot', './models/total', 'queensland', 'total', 'Pulse1_Total']),
+        ('adtk', 'user_sorted_pulsetot', 'anomaly_with_adtk.main',
+         ['./user_sorted_pulsetot', 'queensland', 'total', 0.01, 3])
+    ],
+    'helios': [
+        ('split_datasets', 'org_dataset', 'split_datasets.process_helios_dataset',
+         ['./org_dataset', './user_dataset']),
+        ('sort_time', 'user_dataset', 'sort_time.sort_and_save_helios',
+         ['./user_dataset', './user_helios_sorted_semicol']),
+        ('replace_semicolon', 'user_helios_sorted_semicol', 'replace_semicolon.replace_semicolons',
+         ['./user_helios_sorted_semicol', './user_helios_sorted']),
+        ('train', 'user_helios_sorted', 'train_whole_dataset.train_and_save_models',
+         ['./user_helios_sorted', 'meter reading', './models/total']),
+        ('predict', 'user_helios_sorted', 'predict_whole_dataset.main',
+         ['./user_helios_sorted', './models/total', 'helios', 'total', 'meter reading']),
+        ('adtk', 'user_helios_sorted', 'anomaly_with_adtk.main',
+         ['./user_helios_sorted', 'helios', 'total', 0.01, 3])
+    ]
+}
+
+def count_csv_rows(folder):
+    # Count data rows (excluding headers) and bytes of every CSV file in a folder
+    rows = 0
+    size = 0
+    for file_path in glob.glob(os.path.join(folder, '*.csv')):
+        with open(file_path, 'rb') as f:
+            lines = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+        rows += max(lines - 1, 0)
+        size += os.path.getsize(file_path)
+    return rows, size
+
+def resolve_callable(name):
+    module_name, function_name = name.rsplit('.', 1)
+    module = __import__(module_name)
+    return getattr(module, function_name)
+
+def run_stage_worker(function_name, args, queue, quiet):
+    # Runs in a fresh process so the peak RSS belongs to this stage only
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    import matplotlib.pyplot as plt
+    # Close figures where an interactive backend would block on show()
+    plt.show = lambda *a, **k: plt.close('all')
+
+    function = resolve_callable(function_name)
+    output = open(os.devnull, 'w') if quiet else sys.stdout
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            function(*args)
+            elapsed = time.perf_counter() - start
+        error = None
+    except Exception as e:
+        elapsed = time.perf_counter() - start
+        error = str(e)
+
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+    queue.put({'seconds': elapsed, 'peak_rss_mb': peak_rss_mb, 'error': error})
+
+def run_stage(function_name, args, quiet=True):
+    context = mp.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_stage_worker, args=(function_name, args, queue, quiet))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def benchmark_dataset(dataset_root, dataset_type, quiet=True):
+    results = []
+
+    for stage, input_folder, function_name, args in PIPELINE_STAGES[dataset_type]:
+        stage_args = [os.path.join(dataset_root, a[2:]) if isinstance(a, str) and a.startswith('./') else a
+                      for a in args]
+        rows, size = count_csv_rows(os.path.join(dataset_root, input_folder))
+
+        print(f"Running {dataset_type} {stage} ({function_name}) on {rows} rows")
+        result = run_stage(function_name, stage_args, quiet)
+        result.update({
+            'dataset': dataset_type,
+            'stage': stage,
+            'function': function_name,
+            'rows': rows,
+            'bytes_read': size,
+            'rows_per_second': rows / result['seconds'] if result['seconds'] > 0 else None,
+            'mb_per_second': size / (1024 * 1024) / result['seconds'] if result['seconds'] > 0 else None
+        })
+        results.append(result)
+
+        if result['error']:
+            print(f"Error in {dataset_type} {stage}: {result['error']}")
+        else:
+            print(f"{dataset_type} {stage}: {result['seconds']:.2f}s, "
+                  f"{result['rows_per_second']:.0f} rows/s, peak RSS {result['peak_rss_mb']:.1f} MB")
+
+    return results
+
+def environment_info():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count()
+    }
+
+def save_benchmark(benchmark, params, results, output_folder='./benchmark_results'):
+    # All benchmarks share one JSON layout so runs can be compared against each other
+    os.makedirs(output_folder, exist_ok=True)
+    report = {
+        'benchmark': benchmark,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'environment': environment_info(),
+        'params': params,
+        'results': results
+    }
+    output_file = os.path.join(output_folder, f"{benchmark}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {output_file}")
+    return output_file
+
+def benchmark_pipeline(meters=100, readings=1000, datasets=('datamill', 'queensland', 'helios'),
+                       work_folder=None, quiet=True, keep_data=False, seed=42):
+    work_folder = work_folder or tempfile.mkdtemp(prefix='water_benchmark_')
+    print(f"Generating synthetic data in {work_folder}")
+    generate_datasets(work_folder, meters, readings, datasets, seed=seed)
+    # Detection results of the synthetic meters stay out of the real results store
+    os.environ['WATER_RESULTS_DB'] = os.path.join(work_folder, 'anomalies.db')
+
+    results = []
+    try:
+        for dataset_type in datasets:
+            results.extend(benchmark_dataset(os.path.join(work_folder, dataset_type), dataset_type, quiet))
+    finally:
+        if not keep_data:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    params = {'meters': meters, 'readings': readings, 'datasets': list(datasets), 'seed': seed}
+    return save_benchmark('pipeline', params, results)
+
+def measure_call(function, *args, **kwargs):
+    # Wall time of one call, then its peak traced allocation (numpy and pandas buffers included) in a second call
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {'seconds': elapsed, 'peak_traced_mb': peak / (1024 * 1024)}
+
+def benchmark_features(readings=(10000, 100000, 1000000), work_folder=None):
+    # Peak memory and time of the DataFrame feature path against the lean float32 path of the training
+    # features, for the whole per-file call and for the feature step alone on data already in memory
+    import pandas as pd
+    import train_whole_dataset
+    from feature_engine import load_series, build_feature_matrix
+
+    work_folder = work_folder or tempfile.mkdtemp(prefix='water_benchmark_')
+    features = ['diff', 'day_of_week', 'rolling_mean', 'rolling_std']
+    results = []
+    try:
+        for n in readings:
+            file_path = generate_meter_file(os.path.join(work_folder, f'meter_{n}.csv'), n)
+
+            df = pd.read_csv(file_path)
+            df['datetime'] = pd.to_datetime(df['datetime'], format='%d/%m/%Y %H:%M:%S')
+            timestamps, values = load_series(file_path, 'helios', 'meter reading')
+
+            runs = [
+                ('dataframe', 'process_file', lambda: train_whole_dataset.process_file(file_path, 'meter reading', scale=False)),
+                ('lean', 'process_file', lambda: train_whole_dataset.process_file(file_path, 'meter reading', scale=False, lean=True)),
+                ('dataframe', 'features', lambda: train_whole_dataset.compute_features(df, 'meter reading')),
+                ('lean', 'features', lambda: build_feature_matrix(timestamps, values, features, window_size=7))
+            ]
+            for implementation, step, function in runs:
+                result = measure_call(function)
+                result.update({'implementation': implementation, 'step': step, 'rows': n,
+                               'rows_per_second': n / result['seconds']})
+                results.append(result)
+                print(f"{implementation} {step}, {n} rows: {result['seconds']:.3f}s, "
+                      f"peak {result['peak_traced_mb']:.1f} MB")
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    return save_benchmark('features', {'readings': list(readings)}, results)
+
+def benchmark_peer(meters=(1000, 5000, 20000), bins=720, seed=42):
+    # Time of the cross-meter peer detector on random grids of growing population size
+    import numpy as np
+    from peer_detector import peer_scores
+
+    rng = np.random.default_rng(seed)
+    results = []
+    for n in meters:
+        values = rng.gamma(4.0, 0.25, size=(n, bins)).astype(np.float32) * rng.uniform(5, 20, size=(n, 1)).astype(np.float32)
+        mask = rng.random((n, bins)) > 0.02
+        cohorts = np.array([f'cohort{i % 10}' for i in range(n)], dtype=object)
+
+        result = measure_call(peer_scores, values, mask, cohorts)
+        result.update({'meters': n, 'bins': bins, 'cells_per_second': n * bins / result['seconds'],
+                       'seconds_per_1000_meters': 1000 * result['seconds'] / n})
+        results.append(result)
+        print(f"{n} meters x {bins} bins: {result['seconds']:.3f}s, {result['seconds_per_1000_meters']:.3f}s per 1000 meters, "
+              f"peak {result['peak_traced_mb']:.1f} MB")
+
+    return save_benchmark('peer', {'meters': list(meters), 'bins': bins}, results)
+
+def benchmark_autoencoder(readings=200000, contamination=0.01, work_folder=None):
+    # Epochs per second and score agreement of the tuned CPU AutoEncoder (float32 and bfloat16)
+    # against the current pyod setup, trained on the features of one synthetic meter
+    from scipy.stats import spearmanr
+    from sklearn.preprocessing import StandardScaler
+    from pyod.models.auto_encoder import AutoEncoder
+    from feature_engine import load_series, build_feature_matrix
+    from autoencoder_cpu import cpu_autoencoder, fit_autoencoder_cpu, score_autoencoder
+
+    work_folder = work_folder or tempfile.mkdtemp(prefix='water_benchmark_')
+    try:
+        file_path = generate_meter_file(os.path.join(work_folder, 'meter.csv'), readings)
+        timestamps, values = load_series(file_path, 'helios', 'meter reading')
+        X, _ = build_feature_matrix(timestamps, values, ['diff', 'day_of_week', 'rolling_mean', 'rolling_std'], window_size=7)
+        X = StandardScaler().fit_transform(X)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    runs = [
+        ('pyod_default', lambda: AutoEncoder(contamination=contamination, verbose=0).fit(X)),
+        # Run-to-run agreement of the current setup itself, as a baseline for the tuned runs
+        ('pyod_default_other_seed', lambda: AutoEncoder(contamination=contamination, verbose=0, random_state=7).fit(X)),
+        ('tuned_float32', lambda: fit_autoencoder_cpu(cpu_autoencoder(contamination), X)),
+        ('tuned_bfloat16', lambda: fit_autoencoder_cpu(cpu_autoencoder(contamination), X, compute_dtype='bfloat16'))
+    ]
+
+    results = []
+    reference = None
+    for name, fit in runs:
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            start = time.perf_counter()
+            model = fit()
+            seconds = time.perf_counter() - start
+        epochs = len(getattr(model, 'training_history_', [])) or model.epoch_num
+        scores = score_autoencoder(model, X)
+        labels = scores > model.threshold_
+        if reference is None:
+            reference = (scores, labels)
+
+        # Rank agreement of the scores and overlap of the flagged rows with the current setup
+        overlap = (labels & reference[1]).sum() / max((labels | reference[1]).sum(), 1)
+        result = {'setup': name, 'rows': len(X), 'seconds': seconds, 'epochs': epochs, 'epochs_per_second': epochs / seconds,
+                  'batch_size': model.batch_size, 'score_spearman': float(spearmanr(scores, reference[0])[0]),
+                  'flagged_jaccard': float(overlap)}
+        results.append(result)
+        print(f"{name}: {seconds:.1f}s, {epochs} epochs, {result['epochs_per_second']:.2f} epochs/s, "
+              f"spearman {result['score_spearman']:.3f}, flagged overlap {result['flagged_jaccard']:.3f}")
+
+    return save_benchmark('autoencoder', {'readings': readings, 'contamination': contamination}, results)
+
+def benchmark_results_store(meters=1000, readings=2000, queries=50, work_folder=None, seed=42):
+    # Bulk insert rate of the results store and latency of its meter/time and ranking queries
+    import numpy as np
+    import pandas as pd
+    import results_store
+
+    work_folder = work_folder or tempfile.mkdtemp(prefix='water_benchmark_')
+    rng = np.random.default_rng(seed)
+    timestamps = pd.date_range('2020-01-01', periods=readings, freq='h')
+    try:
+        conn = results_store.open_store(os.path.join(work_folder, 'anomalies.db'))
+        run_id = results_store.start_run(conn, 'benchmark', 'helios')
+
+        start = time.perf_counter()
+        for meter in range(meters):
+            scores = rng.random(readings)
+            anomaly = scores > 0.99
+            validated = anomaly & (rng.random(readings) > 0.5)
+            results_store.insert_detections(conn, run_id, 'helios', f'meter_{meter}', timestamps,
+                                            {'IForest': (scores, anomaly, validated),
+                                             results_store.CONSENSUS: (None, validated, validated)},
+                                            rng.random(readings), rng.normal(size=readings))
+        insert_seconds = time.perf_counter() - start
+        rows = meters * readings * 2
+
+        month_start = timestamps[readings // 2]
+        runs = [
+            ('meter_month_consensus', lambda i: results_store.meter_anomalies(conn, 'helios', f'meter_{i % meters}', month_start,
+                                                                              month_start + pd.Timedelta(days=30))),
+            ('meter_month_all_rows', lambda i: results_store.meter_anomalies(conn, 'helios', f'meter_{i % meters}', month_start,
+                                                                             month_start + pd.Timedelta(days=30), 'IForest',
+                                                                             validated_only=False)),
+            ('top_meters', lambda i: results_store.top_meters(conn, 'helios', 20))
+        ]
+        results = [{'query': 'bulk_insert', 'rows': rows, 'seconds': insert_seconds, 'rows_per_second': rows / insert_seconds}]
+        print(f"Inserted {rows} rows in {insert_seconds:.1f}s, {rows / insert_seconds:.0f} rows/s")
+        for name, query in runs:
+            seconds = []
+            for i in range(queries):
+                query_start = time.perf_counter()
+                query(i * 37)
+                seconds.append(time.perf_counter() - query_start)
+            result = {'query': name, 'rows': rows, 'median_ms': 1000 * float(np.median(seconds)),
+                      'max_ms': 1000 * float(np.max(seconds))}
+            results.append(result)
+            print(f"{name}: median {result['median_ms']:.2f} ms, max {result['max_ms']:.2f} ms over {rows} stored rows")
+        conn.close()
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    return save_benchmark('results_store', {'meters': meters, 'readings': readings, 'queries': queries}, results)
+
+def benchmark_scoring(readings=50000, contamination=0.01, work_folder=None):
+    # Time per detector of decision_function followed by predict (two scoring passes) against the fused
+    # single pass of detector_scoring.score_model, and whether both give the same scores and labels
+    import numpy as np
+    from sklearn.preprocessing import StandardScaler
+    from pyod.models.iforest import IForest
+    from pyod.models.knn import KNN
+    from pyod.models.lof import LOF
+    from pyod.models.auto_encoder import AutoEncoder
+    from feature_engine import load_series, build_feature_matrix
+    from detector_scoring import score_model
+
+    work_folder = work_folder or tempfile.mkdtemp(prefix='water_benchmark_')
+    try:
+        file_path = generate_meter_file(os.path.join(work_folder, 'meter.csv'), readings)
+        timestamps, values = load_series(file_path, 'helios', 'meter reading')
+        X, z_score = build_feature_matrix(timestamps, values, ['diff', 'day_of_week', 'rolling_mean', 'rolling_std'], window_size=7)
+        X = StandardScaler().fit_transform(X)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    models = {
+        'IForest': IForest(contamination=contamination, random_state=42),
+        'KNN': KNN(contamination=contamination, n_neighbors=5),
+        'LOF': LOF(contamination=contamination),
+        'AutoEncoder': AutoEncoder(contamination=contamination, epoch_num=2, verbose=0)
+    }
+    results = []
+    for model_name, model in models.items():
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            model.fit(X)
+
+            start = time.perf_counter()
+            separate_scores = model.decision_function(X)
+            separate_labels = model.predict(X)
+            separate_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            scores, labels, _ = score_model(model, X, z_score, 3)
+            fused_seconds = time.perf_counter() - start
+
+        result = {'model': model_name, 'rows': len(X), 'separate_seconds': separate_seconds, 'fused_seconds': fused_seconds,
+                  'saved_seconds': separate_seconds - fused_seconds, 'speedup': separate_seconds / fused_seconds,
+                  'max_score_difference': float(np.max(np.abs(scores - separate_scores))),
+                  'label_mismatches': int((labels != separate_labels).sum())}
+        results.append(result)
+        print(f"{model_name}: decision_function + predict {separate_seconds:.2f}s, fused {fused_seconds:.2f}s, "
+              f"saved {result['saved_seconds']:.2f}s ({result['speedup']:.1f}x), label mismatches {result['label_mismatches']}")
+
+    return save_benchmark('scoring', {'readings': readings, 'contamination': contamination}, results)
+
+def benchmark_rolling(readings=1000000, windows=(24, 168, 720), seed=42):
+    # Daily, weekly and monthly rolling mean, std, min, max and z-score of hourly consumption differences: one
+    # pandas rolling call per statistic and window against feature_engine.rolling_window_stats. The accuracy of
+    # both is measured against an exact two-pass std on a sample of windows.
+    import numpy as np
+    import pandas as pd
+    from feature_engine import rolling_window_stats
+
+    rng = np.random.default_rng(seed)
+    # Meter readings grow, so the differences are positive with a slow trend and some missing readings
+    diff = rng.exponential(1.0, readings) + np.linspace(0, 50, readings)
+    diff[rng.integers(0, readings, readings // 1000)] = np.nan
+    series = pd.Series(diff)
+
+    start = time.perf_counter()
+    pandas_stats = {}
+    for window in windows:
+        rolling = series.rolling(window)
+        stats = {'mean': rolling.mean(), 'std': rolling.std(), 'min': rolling.min(), 'max': rolling.max()}
+        stats['z'] = (series - stats['mean']) / stats['std']
+        pandas_stats[window] = {name: column.to_numpy() for name, column in stats.items()}
+    pandas_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    kernel_stats = rolling_window_stats(diff, windows)
+    kernel_seconds = time.perf_counter() - start
+
+    sample = rng.choice(np.arange(max(windows), readings), size=min(2000, readings - max(windows)), replace=False)
+    results = []
+    for window in windows:
+        exact = np.array([np.std(diff[i - window + 1:i + 1], ddof=1) for i in sample])
+        present = ~np.isnan(exact)
+        result = {'window': window, 'rows': readings,
+                  'max_difference': {name: float(np.nanmax(np.abs(kernel_stats[window][name] - pandas_stats[window][name])))
+                                     for name in ['mean', 'std', 'min', 'max']},
+                  'pandas_std_error': float(np.max(np.abs(pandas_stats[window]['std'][sample] - exact)[present])),
+                  'kernel_std_error': float(np.max(np.abs(kernel_stats[window]['std'][sample] - exact)[present]))}
+        results.append(result)
+        print(f"Window {window}: largest std error pandas {result['pandas_std_error']:.1e}, kernel {result['kernel_std_error']:.1e}")
+    results.append({'pandas_seconds': pandas_seconds, 'kernel_seconds': kernel_seconds, 'speedup': pandas_seconds / kernel_seconds})
+    print(f"{len(windows)} windows x 5 statistics over {readings} readings: pandas rolling {pandas_seconds:.2f}s, "
+          f"rolling_window_stats {kernel_seconds:.2f}s ({pandas_seconds / kernel_seconds:.1f}x)")
+    return save_benchmark('rolling', {'readings': readings, 'windows': list(windows)}, results)
+
+def benchmark_dates(meters=200, readings=8760, seed=42):
+    # Helios-shaped timestamp columns: hourly readings of many users over the same year, each user starting on a
+    # different day. Parses every user's column with pd.to_datetime and with the memoised date_parsing layer.
+    import numpy as np
+    import pandas as pd
+    from date_parsing import parse_datetimes, clear_date_cache
+
+    rng = np.random.default_rng(seed)
+    hours = pd.date_range('2020-01-01', periods=readings + 24 * 30, freq='h').strftime('%d/%m/%Y %H:%M:%S').to_numpy(dtype=object)
+    columns = [pd.Series(hours[offset:offset + readings]) for offset in rng.integers(0, 30, meters) * 24]
+    time_format = '%d/%m/%Y %H:%M:%S'
+
+    results = []
+    for name, parse in [('to_datetime', lambda column, **kwargs: pd.to_datetime(column, **kwargs)), ('memoised', parse_datetimes)]:
+        for label, kwargs in [('format', {'format': time_format}), ('dayfirst', {'dayfirst': True})]:
+            clear_date_cache()
+            start = time.perf_counter()
+            parsed = [parse(column, **kwargs) for column in columns]
+            seconds = time.perf_counter() - start
+            results.append({'parser': name, 'mode': label, 'meters': meters, 'rows': meters * readings, 'seconds': seconds,
+                            'rows_per_second': meters * readings / seconds,
+                            'matches': all(parsed[i].equals(pd.to_datetime(columns[i], **kwargs)) for i in range(min(5, meters)))})
+            print(f"{name} ({label}): {meters * readings} timestamps in {seconds:.2f}s ({meters * readings / seconds:,.0f} rows/s)")
+
+    for label in ['format', 'dayfirst']:
+        baseline, memoised = [r['seconds'] for r in results if r['mode'] == label]
+        print(f"Speedup ({label}): {baseline / memoised:.1f}x")
+    return save_benchmark('dates', {'meters': meters, 'readings': readings}, results)
+
+# Heavy libraries that no module may import at load time; each command imports them when it needs them
+HEAVY_MODULES = ['torch', 'pyod', 'adtk', 'sklearn', 'matplotlib']
+# Startup budgets in seconds for importing the CLI itself and the module of one command (pandas alone takes about 0.4 s)
+CLI_IMPORT_BUDGET = 0.1
+COMMAND_IMPORT_BUDGET = 1.5
+
+IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start, 'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+def measure_import(module, repeats=3):
+    # Import time of a module in fresh interpreters (the fastest of a few runs) and the heavy libraries it loaded
+    import subprocess
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return min(runs, key=lambda run: run['seconds'])
+
+def benchmark_imports(repeats=3):
+    # Fails (returns False) when the CLI or the module of a command loads too slowly or pulls in a heavy library at import
+    from cli import COMMAND_MODULES
+
+    modules = [('cli', 'cli', CLI_IMPORT_BUDGET)] + [(command, module, COMMAND_IMPORT_BUDGET)
+                                                     for command, command_modules in COMMAND_MODULES.items() for module in command_modules]
+    results = []
+    passed = True
+    for command, module, budget in modules:
+        result = measure_import(module, repeats)
+        unexpected = result['loaded']
+        ok = result['seconds'] <= budget and not unexpected
+        passed = passed and ok
+        results.append({'command': command, 'module': module, 'seconds': result['seconds'], 'budget_seconds': budget,
+                        'heavy_modules': result['loaded'], 'passed': ok})
+        print(f"{'ok  ' if ok else 'FAIL'} {command} ({module}): {result['seconds']:.3f}s of {budget:.1f}s"
+              + (f", loads {', '.join(unexpected)}" if unexpected else ""))
+
+    save_benchmark('imports', {'repeats': repeats, 'cli_budget': CLI_IMPORT_BUDGET, 'command_budget': COMMAND_IMPORT_BUDGET}, results)
+    print("Import times within budget" if passed else "Import time regression detected")
+    return passed
+
+if __name__ == "__main__":
+    benchmark = input("Which benchmark do you want to run? (pipeline/features/peer/autoencoder/results/imports/scoring/dates/rolling): ").strip().lower()
+    if benchmark == 'rolling':
+        benchmark_rolling()
+        sys.exit()
+    if benchmark == 'dates':
+        benchmark_dates()
+        sys.exit()
+    if benchmark == 'scoring':
+        benchmark_scoring()
+        sys.exit()
+    if benchmark == 'imports':
+        sys.exit(0 if benchmark_imports() else 1)
+    if benchmark == 'results':
+        benchmark_results_store()
+        sys.exit()
+    if benchmark == 'autoencoder':
+        benchmark_autoencoder()
+        sys.exit()
+    if benchmark == 'features':
+        benchmark_features()
+        sys.exit()
+    if benchmark == 'peer':
+        benchmark_peer()
+        sys.exit()
+
+    try:
+        meters = int(input("Enter number of meters per dataset (default 100): "))
+    except ValueError:
+        print("Invalid number of meters. Using default value of 100.")
+        meters = 100
+
+    try:
+        readings = int(input("Enter number of readings per meter (default 1000): "))
+    except ValueError:
+        print("Invalid number of readings. Using default value of 1000.")
+        readings = 1000
+
+    dataset_choice = input("Which dataset do you want to benchmark? (queensland/helios/datamill/all): ").strip().lower()
+    if dataset_choice in ['queensland', 'helios', 'datamill']:
+        datasets = (dataset_choice,)
+    else:
+        datasets = ('datamill', 'queensland', 'helios')
+
+    benchmark_pipeline(meters, readings, datasets)
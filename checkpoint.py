@@ -0,0 +1,126 @@
+import os
+import json
+
+# Progress journal kept in the output folder of a running split or sort job. It is removed when the job
+# completes; when a run is interrupted the next run reads it to continue after the last completed unit.
+PROGRESS_FILE = '.progress.jsonl'
+
+# Suffix of files that are still being written; they are renamed to their final name when complete
+TEMP_SUFFIX = '.part'
+
+def file_fingerprint(file_path):
+    # Size and modification time identify a file version without reading it
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def atomic_to_csv(df, output_file, **kwargs):
+    # Write to a temporary file and rename it, so an output file is either complete or absent
+    temp_file = output_file + TEMP_SUFFIX
+    df.to_csv(temp_file, **kwargs)
+    os.replace(temp_file, output_file)
+
+def remove_temp_files(output_folder):
+    for file_name in os.listdir(output_folder):
+        if file_name.endswith(TEMP_SUFFIX):
+            os.remove(os.path.join(output_folder, file_name))
+            print(f"Removed unfinished file: {file_name}")
+
+def append_line(progress, entry):
+    # Each entry is flushed to disk before the job moves on, so it survives a crash
+    with open(progress['path'], 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_journal(progress_path):
+    entries = []
+    with open(progress_path) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A line torn by the interruption is ignored
+                break
+    return entries
+
+def start_progress(output_folder, job, sources=None, resume=True):
+    # Opens the progress journal of a job. A journal of another job or of changed source files is discarded.
+    # Appends that were started but not finished are rolled back to the size the file had before them.
+    os.makedirs(output_folder, exist_ok=True)
+    progress_path = os.path.join(output_folder, PROGRESS_FILE)
+    header = {'job': job, 'sources': sources or {}}
+    progress = {'path': progress_path, 'done': {}, 'resumed': False}
+
+    entries = read_journal(progress_path) if resume and os.path.exists(progress_path) else []
+    if entries and entries[0] == header:
+        begun = {}
+        for entry in entries[1:]:
+            if 'begin_size' in entry:
+                begun[entry['unit']] = entry
+            else:
+                progress['done'][entry['unit']] = entry
+                begun.pop(entry['unit'], None)
+
+        for unit, entry in begun.items():
+            rollback_append(entry['file'], entry['begin_size'])
+        progress['resumed'] = bool(progress['done'] or begun)
+        remove_temp_files(output_folder)
+
+        # Rewrite the journal without the rolled back appends
+        with open(progress_path + TEMP_SUFFIX, 'w') as f:
+            for entry in [header] + list(progress['done'].values()):
+                f.write(json.dumps(entry) + '\n')
+        os.replace(progress_path + TEMP_SUFFIX, progress_path)
+    else:
+        remove_temp_files(output_folder)
+        with open(progress_path, 'w') as f:
+            f.write(json.dumps(header) + '\n')
+
+    if progress['resumed']:
+        print(f"Resuming {job}: {len(progress['done'])} units already completed")
+    return progress
+
+def rollback_append(output_file, begin_size):
+    # Truncate a partially appended file back to its size before the append, or remove a partial new file
+    if not os.path.exists(output_file):
+        return
+    if begin_size is None:
+        os.remove(output_file)
+        print(f"Removed partially written file: {output_file}")
+    elif os.path.getsize(output_file) != begin_size:
+        with open(output_file, 'r+b') as f:
+            f.truncate(begin_size)
+        print(f"Rolled back partial append to {output_file}")
+
+def unit_done(progress, unit, input_file=None):
+    # A unit counts as done while its input and output files are unchanged since it was recorded
+    entry = progress['done'].get(unit)
+    if entry is None:
+        return False
+    if input_file is not None and entry.get('input') != file_fingerprint(input_file):
+        return False
+    for output_file, fingerprint in entry['outputs'].items():
+        if not os.path.exists(output_file) or file_fingerprint(output_file) != fingerprint:
+            return False
+    return True
+
+def begin_append(progress, unit, output_file):
+    # Record the size of a file before appending to it, so an interrupted append can be rolled back
+    begin_size = os.path.getsize(output_file) if os.path.exists(output_file) else None
+    append_line(progress, {'unit': unit, 'file': output_file, 'begin_size': begin_size})
+
+def complete_unit(progress, unit, output_files, input_file=None):
+    entry = {'unit': unit, 'outputs': {output_file: file_fingerprint(output_file) for output_file in output_files}}
+    if input_file is not None:
+        entry['input'] = file_fingerprint(input_file)
+    progress['done'][unit] = entry
+    append_line(progress, entry)
+
+def finish_progress(progress, failed=()):
+    # Keeps the journal when units failed, so a rerun only redoes those; returns True when the job is complete
+    if failed:
+        print(f"{len(failed)} units failed, rerun to continue from the checkpoint: {', '.join(map(str, failed))}")
+        return False
+    if os.path.exists(progress['path']):
+        os.remove(progress['path'])
+    return True
@@ -0,0 +1,237 @@
+import sys
+import argparse
+
+# One command line for the pipeline, detectors and tools. Every command imports its module only when it runs,
+# so pandas, sklearn, pyod, torch, adtk and matplotlib are loaded by the commands that use them and by no others.
+#   python cli.py pipeline helios
+#   python cli.py train helios total --tuned-autoencoder
+#   python cli.py show helios daily --start 2020-01-01 --end 2020-01-08
+
+DATASETS = ['helios', 'queensland', 'datamill']
+VALUE_TYPES = ['daily', 'total']
+
+# Modules each command imports, used by the import-time benchmark
+COMMAND_MODULES = {
+    'pipeline': ['pipeline'],
+    'train': ['train_whole_dataset'],
+    'predict': ['predict_whole_dataset'],
+    'pyod': ['anomaly_with_pyod'],
+    'adtk': ['anomaly_with_adtk'],
+    'peer': ['peer_detector'],
+    'sweep': ['sweep_thresholds'],
+    'shard': ['shard_scoring'],
+    'show': ['show_data'],
+    'results': ['results_store'],
+    'benchmark': ['benchmark_pipeline']
+}
+
+# Default Z-score thresholds per dataset. The pyod z-scores are taken over a trailing window (24 readings for
+# Helios, 7 otherwise) and never exceed (n - 1) / sqrt(n), 4.69 and 2.27, so 3 is only reachable on Helios.
+# ADTK compares every value with the mean and std of the whole series.
+PYOD_Z_SCORES = {'helios': 3, 'queensland': 1, 'datamill': 1}
+ADTK_Z_SCORES = {'helios': 1, 'queensland': 3, 'datamill': 1}
+
+def sorted_folder(dataset_type, value_type):
+    if dataset_type == 'helios':
+        return './dataset/helios/user_helios_sorted'
+    if dataset_type == 'queensland':
+        return f'./dataset/queensland/user_sorted_pulse{"tot" if value_type == "total" else ""}'
+    return './dataset/datamill/user_datamill_sorted'
+
+def value_column(dataset_type, value_type):
+    if dataset_type == 'helios':
+        return 'diff' if value_type == 'daily' else 'meter reading'
+    if dataset_type == 'queensland':
+        return 'Pulse1' if value_type == 'daily' else 'Pulse1_Total'
+    return 'DAILY_AVERAGE_CONSUMPTION' if value_type == 'daily' else 'GROSS_CONSUMPTION'
+
+def model_folder(dataset_type, value_type):
+    return f'./models/{dataset_type}/{value_type}'
+
+def run_pipeline_command(args):
+    from pipeline import PIPELINES, run_pipeline
+    for dataset_type in (PIPELINES if args.dataset == 'all' else [args.dataset]):
+        run_pipeline(f'./dataset/{dataset_type}', dataset_type, args.force)
+
+def run_train(args):
+    from train_whole_dataset import train_and_save_models, update_models
+    folder_path = args.folder or sorted_folder(args.dataset, args.value_type)
+    # Lean float32 feature path, the same as the train_whole_dataset script
+    if args.update:
+        update_models(folder_path, value_column(args.dataset, args.value_type), model_folder(args.dataset, args.value_type), lean=True)
+    else:
+        train_and_save_models(folder_path, value_column(args.dataset, args.value_type), model_folder(args.dataset, args.value_type),
+                              args.contamination, lean=True, tuned_autoencoder=args.tuned_autoencoder,
+                              compute_dtype=args.compute_dtype)
+
+def run_predict(args):
+    from predict_whole_dataset import main
+    main(args.folder or sorted_folder(args.dataset, args.value_type), model_folder(args.dataset, args.value_type), args.dataset,
+         args.value_type, value_column(args.dataset, args.value_type), args.contamination, args.budget)
+
+def run_pyod(args):
+    from anomaly_with_pyod import main
+    z_score = args.z_score if args.z_score is not None else PYOD_Z_SCORES[args.dataset]
+    main(args.folder or sorted_folder(args.dataset, args.value_type), args.dataset, args.value_type, args.contamination,
+         z_score, args.tuned_autoencoder, args.budget)
+
+def run_adtk(args):
+    from anomaly_with_adtk import main
+    option = 'default' if args.dataset == 'datamill' else args.value_type
+    z_score = args.z_score if args.z_score is not None else ADTK_Z_SCORES[args.dataset]
+    main(args.folder or sorted_folder(args.dataset, args.value_type), args.dataset, option, args.contamination, z_score)
+
+def run_peer(args):
+    from peer_detector import detect_peer_anomalies
+    detect_peer_anomalies(f'./dataset/{args.dataset}/grid_{args.value_type}', threshold=args.threshold,
+                          min_peers=args.min_peers, cohort_file=args.cohort_file)
+
+def run_sweep(args):
+    from sweep_thresholds import sweep, parse_grid
+    contamination_grid = parse_grid(args.contamination, [0.005, 0.01, 0.02, 0.05]) if args.mode != 'adtk' else [0.01]
+    scores_folder = f'./sweep_results/scores/{args.mode}_{args.dataset}_{args.value_type}'
+    sweep(sorted_folder(args.dataset, args.value_type), args.mode, args.dataset, args.value_type, contamination_grid,
+          parse_grid(args.z_scores, [1, 2, 3]), scores_folder, './sweep_results',
+          model_save_path=model_folder(args.dataset, args.value_type), value_column=value_column(args.dataset, args.value_type))
+
+def run_shard(args):
+    from shard_scoring import run_worker, run_local, merge_shards
+    if args.mode == 'merge':
+        merge_shards(args.work_folder)
+        return
+    shard_args = (sorted_folder(args.dataset, args.value_type), args.work_folder, model_folder(args.dataset, args.value_type),
+                  args.dataset, args.value_type, value_column(args.dataset, args.value_type))
+    if args.mode == 'local':
+        run_local(*shard_args, args.workers, args.shards, contamination=args.contamination, budget=args.budget)
+    else:
+        run_worker(*shard_args, args.shards, contamination=args.contamination, budget=args.budget)
+        merge_shards(args.work_folder)
+
+def run_show(args):
+    from show_data import plot_water_usage_from_files
+    if args.dataset == 'queensland':
+        consumption_type = 'pulsetotal' if args.value_type == 'total' else 'pulse'
+    elif args.dataset == 'datamill':
+        consumption_type = value_column(args.dataset, args.value_type)
+    else:
+        consumption_type = args.value_type
+    plot_water_usage_from_files(args.folder or sorted_folder(args.dataset, args.value_type), args.dataset, consumption_type,
+                                args.start, args.end)
+
+def run_results(args):
+    from results_store import open_store, meter_anomalies, top_meters
+    conn = open_store(args.db)
+    if args.meter:
+        print(meter_anomalies(conn, args.dataset, args.meter, args.start, args.end, args.model).to_string(index=False))
+    else:
+        print(top_meters(conn, args.dataset, args.top, args.model).to_string(index=False))
+
+def run_benchmark(args):
+    import benchmark_pipeline
+    if args.name == 'imports':
+        # A non-zero exit status marks a startup regression
+        if not benchmark_pipeline.benchmark_imports():
+            sys.exit(1)
+    elif args.name == 'pipeline':
+        benchmark_pipeline.benchmark_pipeline(args.meters, args.readings)
+    else:
+        getattr(benchmark_pipeline, f'benchmark_{args.name}')()
+
+def add_budget_argument(parser):
+    parser.add_argument('--budget', type=float, help='detector time budget in seconds for the whole run '
+                                                     '(default WATER_DETECTOR_BUDGET, 0 runs every detector on every meter)')
+
+def add_dataset_arguments(parser, folder=True):
+    parser.add_argument('dataset', choices=DATASETS)
+    parser.add_argument('value_type', choices=VALUE_TYPES)
+    if folder:
+        parser.add_argument('--folder', help='folder with the sorted meter files (default: the dataset folder)')
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description='Water meter anomaly detection')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('pipeline', help='split, sort and resample a dataset incrementally')
+    command.add_argument('dataset', choices=DATASETS + ['all'])
+    command.add_argument('--force', action='store_true', help='rebuild every stage from scratch')
+    command.set_defaults(run=run_pipeline_command)
+
+    command = commands.add_parser('train', help='train the pyod models on a whole dataset')
+    add_dataset_arguments(command)
+    command.add_argument('--contamination', type=float, default=0.01)
+    command.add_argument('--update', action='store_true', help='update the saved models with new files')
+    command.add_argument('--tuned-autoencoder', action='store_true')
+    command.add_argument('--compute-dtype', choices=['float32', 'bfloat16'], default='float32')
+    command.set_defaults(run=run_train)
+
+    command = commands.add_parser('predict', help='score a dataset with the saved models')
+    add_dataset_arguments(command)
+    command.add_argument('--contamination', type=float, default=0.01)
+    add_budget_argument(command)
+    command.set_defaults(run=run_predict)
+
+    for name, run in [('pyod', run_pyod), ('adtk', run_adtk)]:
+        command = commands.add_parser(name, help=f'fit and run the {name} detectors per meter')
+        add_dataset_arguments(command)
+        command.add_argument('--contamination', type=float, default=0.01)
+        command.add_argument('--z-score', type=float, help='Z-score threshold (default depends on the dataset)')
+        if name == 'pyod':
+            command.add_argument('--tuned-autoencoder', action='store_true')
+            add_budget_argument(command)
+        command.set_defaults(run=run)
+
+    command = commands.add_parser('peer', help='compare meters with their peers on the resampled grid')
+    add_dataset_arguments(command, folder=False)
+    command.add_argument('--threshold', type=float, default=3.5)
+    command.add_argument('--min-peers', type=int, default=5)
+    command.add_argument('--cohort-file')
+    command.set_defaults(run=run_peer)
+
+    command = commands.add_parser('sweep', help='count anomalies over a grid of contamination and Z-score values')
+    command.add_argument('mode', choices=['pyod', 'models', 'adtk'])
+    add_dataset_arguments(command, folder=False)
+    command.add_argument('--contamination', default='', help='comma separated values (default 0.005,0.01,0.02,0.05)')
+    command.add_argument('--z-scores', default='', help='comma separated values (default 1,2,3)')
+    command.set_defaults(run=run_sweep)
+
+    command = commands.add_parser('shard', help='score a dataset in shards shared by several workers')
+    command.add_argument('mode', choices=['worker', 'merge', 'local'])
+    command.add_argument('dataset', choices=DATASETS, nargs='?', default='helios')
+    command.add_argument('value_type', choices=VALUE_TYPES, nargs='?', default='total')
+    command.add_argument('--work-folder', default='./shard_work')
+    command.add_argument('--shards', type=int, default=16)
+    command.add_argument('--workers', type=int, default=4)
+    command.add_argument('--contamination', type=float, default=0.01)
+    add_budget_argument(command)
+    command.set_defaults(run=run_shard)
+
+    command = commands.add_parser('show', help='plot the sorted meter files')
+    add_dataset_arguments(command)
+    command.add_argument('--start', help='start of the time window, e.g. 2020-01-01')
+    command.add_argument('--end', help='end of the time window, e.g. 2020-01-08')
+    command.set_defaults(run=run_show)
+
+    command = commands.add_parser('results', help='query the results store')
+    command.add_argument('dataset', choices=DATASETS)
+    command.add_argument('--meter', help='list the anomalies of this meter instead of the top meters')
+    command.add_argument('--start')
+    command.add_argument('--end')
+    command.add_argument('--model', default='all_methods')
+    command.add_argument('--top', type=int, default=10)
+    command.add_argument('--db', help='results database (default results/anomalies.db)')
+    command.set_defaults(run=run_results)
+
+    command = commands.add_parser('benchmark', help='run a benchmark')
+    command.add_argument('name', choices=['pipeline', 'features', 'peer', 'autoencoder', 'results_store', 'imports', 'scoring', 'dates',
+                                          'rolling'])
+    command.add_argument('--meters', type=int, default=100)
+    command.add_argument('--readings', type=int, default=1000)
+    command.set_defaults(run=run_benchmark)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import numpy as np
+from checkpoint import file_fingerprint, TEMP_SUFFIX
+
+# Quality sidecar written next to every sorted meter file by the sort stage: the rows whose change from the
+# previous row cannot be trusted. Feature code masks the differences of these rows instead of turning them into
+# spikes, without reading the data again. Only flagged rows are stored, so the sidecar stays a few bytes.
+QUALITY_SUFFIX = '.quality'
+
+# Cumulative counters: their differences are the consumption, so a gap or a reset shows up as a spike
+COUNTER_COLUMNS = ['meter reading', 'Pulse1_Total']
+
+# A Datamill postcode file mixes the billing periods of many meters without a meter id, and different meters often
+# share a start date. A repeated start date is only a duplicate when these columns repeat too (the same meter's reading).
+DATAMILL_READING_COLUMNS = ['READING_END_DATE', 'READING_START_READING']
+
+# A step longer than GAP_FACTOR times the usual reading interval of the meter is a reporting gap
+GAP_FACTOR = 3
+
+# Flag bits of a row
+DUPLICATE = 1
+GAP = 2
+RESET = 4
+FLAG_NAMES = {DUPLICATE: 'duplicates', GAP: 'gaps', RESET: 'resets'}
+
+def quality_path(csv_path):
+    return csv_path + QUALITY_SUFFIX
+
+def detect_quality(timestamps, counter=None, duplicates=None):
+    # Flags the rows of a time-sorted series: a repeated timestamp, and for cumulative counters the first row
+    # after a reporting gap and a counter that went down (reset or rollover). duplicates (a boolean per row)
+    # replaces the repeated timestamp test when rows of several meters share timestamps. Returns (rows, flags)
+    # of the flagged rows only.
+    times = np.asarray(timestamps).astype('datetime64[ns]').view(np.int64)
+    flags = np.zeros(len(times), dtype=np.uint8)
+    if duplicates is not None:
+        flags[np.asarray(duplicates, dtype=bool)] |= DUPLICATE
+    if len(times) > 1:
+        step = np.diff(times)
+        if duplicates is None:
+            flags[1:][step == 0] |= DUPLICATE
+        if counter is not None:
+            positive = step[step > 0]
+            if len(positive):
+                flags[1:][step > GAP_FACTOR * np.median(positive)] |= GAP
+            with np.errstate(invalid='ignore'):
+                flags[1:][np.diff(np.asarray(counter, dtype=np.float64)) < 0] |= RESET
+    rows = np.flatnonzero(flags)
+    return rows, flags[rows]
+
+def save_quality(csv_path, rows, flags):
+    # The fingerprint of the CSV is saved with the flags, so a sidecar of an older version of the file is never used
+    temp_file = quality_path(csv_path) + TEMP_SUFFIX
+    with open(temp_file, 'wb') as f:
+        np.savez(f, rows=np.asarray(rows, dtype=np.int64), flags=np.asarray(flags, dtype=np.uint8),
+                 fingerprint=np.array(file_fingerprint(csv_path), dtype=np.int64))
+    os.replace(temp_file, quality_path(csv_path))
+    return quality_path(csv_path)
+
+def frame_quality(df, time_column, name='', reading_columns=None):
+    # Flags of a sorted DataFrame, computed by the sort stage on the data it is about to write, so nothing is
+    # read again; the time column must still hold timestamps. With reading_columns a row is a duplicate only
+    # when its timestamp and these columns repeat an earlier row.
+    counter = next((df[column].to_numpy() for column in COUNTER_COLUMNS if column in df), None)
+    duplicates = None
+    if reading_columns:
+        duplicates = df.duplicated([time_column] + [column for column in reading_columns if column in df]).to_numpy()
+    rows, flags = detect_quality(df[time_column].to_numpy(), counter, duplicates)
+    counts = quality_counts(flags)
+    if any(counts.values()):
+        print(f"{name}: " + ', '.join(f"{count} {flag_name}" for flag_name, count in counts.items()))
+    return rows, flags
+
+def copy_quality(source_csv, target_csv):
+    # Same rows in the same order (e.g. only the delimiter changed): the flags are saved for the new file
+    quality = load_quality(source_csv)
+    if quality is None:
+        return None
+    return save_quality(target_csv, *quality)
+
+def load_quality(csv_path):
+    # Returns (rows, flags), or None when the sidecar is missing or belongs to another version of the file
+    path = quality_path(csv_path)
+    if not isinstance(csv_path, str) or not os.path.exists(path):
+        return None
+    with np.load(path) as quality:
+        if list(quality['fingerprint']) != file_fingerprint(csv_path):
+            return None
+        return quality['rows'], quality['flags']
+
+def quality_counts(flags):
+    return {name: int((np.asarray(flags) & flag != 0).sum()) for flag, name in FLAG_NAMES.items()}
+
+def masked_rows(csv_path):
+    # Rows of a sorted file whose difference to the previous row must not be used; empty without a valid sidecar
+    quality = load_quality(csv_path)
+    return quality[0] if quality is not None else np.empty(0, dtype=np.int64)
+
+def row_mask(rows, start, stop):
+    # Boolean mask of the file rows start..stop-1 that are in rows (sorted)
+    mask = np.zeros(stop - start, dtype=bool)
+    selected = rows[np.searchsorted(rows, start):np.searchsorted(rows, stop)]
+    mask[selected - start] = True
+    return mask
+
+def mask_differences(df, csv_path, column='diff'):
+    # Sets the differences of the flagged rows to NaN in a DataFrame read from csv_path; the DataFrame index must
+    # still be the row numbers of the file (the default of read_csv), the row order does not matter
+    rows = masked_rows(csv_path)
+    if len(rows):
+        df.loc[df.index.isin(rows), column] = np.nan
+    return df
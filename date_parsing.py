@@ -0,0 +1,69 @@
+import threading
+import numpy as np
+import pandas as pd
+
+# Timestamp strings remembered across files and stages, per format. Helios users share their hourly
+# timestamps and Queensland meters report on common grids, so most strings of a file were seen before.
+DATE_CACHE_SIZE = 500000
+
+# (format, dayfirst) -> {'current': (Index of strings, datetime64 values), 'previous': (...)}.
+# Two generations give a bounded, approximately least-recently-used cache: strings found in the previous
+# generation move to the current one, and a full current generation replaces the previous one.
+_caches = {}
+_lock = threading.Lock()
+
+def empty_generation():
+    return pd.Index([], dtype=object), np.empty(0, dtype='datetime64[s]')
+
+def lookup(generation, strings):
+    index, values = generation
+    positions = index.get_indexer(strings) if len(index) else np.full(len(strings), -1)
+    return positions >= 0, values[positions[positions >= 0]]
+
+def parse_datetimes(strings, format=None, dayfirst=False, cache_size=DATE_CACHE_SIZE):
+    # Same result as pd.to_datetime(strings, format=format, dayfirst=dayfirst): a Series for a Series input,
+    # a DatetimeIndex otherwise. Only the distinct strings are looked up, and only the ones not in the cache are parsed.
+    codes, uniques = pd.factorize(np.asarray(strings, dtype=object))
+    uniques = pd.Index(uniques, dtype=object)
+    if not len(uniques):
+        # Empty or all missing: nothing to look up or cache, and the indexing below needs at least one value
+        return pd.to_datetime(strings, format=format, dayfirst=dayfirst)
+
+    with _lock:
+        cache = _caches.setdefault((format, dayfirst), {'current': empty_generation(), 'previous': empty_generation()})
+        parsed = None
+        found, current_values = lookup(cache['current'], uniques)
+        missing = ~found
+        if missing.any():
+            found_previous, previous_values = lookup(cache['previous'], uniques[missing])
+            new_strings = uniques[missing][~found_previous]
+            new_values = pd.to_datetime(new_strings, format=format, dayfirst=dayfirst).to_numpy() if len(new_strings) else previous_values[:0]
+
+            parsed = np.empty(len(uniques), dtype=np.result_type(current_values, previous_values, new_values))
+            parsed[found] = current_values
+            missing_values = np.empty(missing.sum(), dtype=parsed.dtype)
+            missing_values[found_previous] = previous_values
+            missing_values[~found_previous] = new_values
+            parsed[missing] = missing_values
+
+            # Strings from the previous generation and newly parsed ones join the current generation
+            index, values = cache['current']
+            cache['current'] = (index.append(uniques[missing]), np.concatenate([values, missing_values]))
+            if len(cache['current'][0]) > cache_size // 2:
+                cache['previous'] = cache['current']
+                cache['current'] = empty_generation()
+        else:
+            parsed = current_values
+
+    result = parsed[codes]
+    # Missing strings (code -1) stay missing
+    if (codes < 0).any():
+        result[codes < 0] = np.datetime64('NaT')
+
+    if isinstance(strings, pd.Series):
+        return pd.Series(result, index=strings.index, name=strings.name)
+    return pd.DatetimeIndex(result)
+
+def clear_date_cache():
+    with _lock:
+        _caches.clear()
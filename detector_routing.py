@@ -0,0 +1,205 @@
+import os
+import json
+import math
+from checkpoint import TEMP_SUFFIX
+from instrumentation import add_metrics
+from time_index import indexed_row_count
+
+# Time budget in seconds for the detectors of one run, summed over all meters (and all workers of a sharded run).
+# 0 runs every detector on every meter long enough for it; set WATER_DETECTOR_BUDGET to route under a budget.
+DETECTOR_BUDGET = float(os.environ.get('WATER_DETECTOR_BUDGET', '0'))
+
+# Cost coefficients corrected with the measured times of earlier runs; set WATER_DETECTOR_COSTS to an empty string
+# to always plan with the defaults below
+DETECTOR_COSTS = os.environ.get('WATER_DETECTOR_COSTS', './logs/detector_costs.json')
+
+# Estimated seconds of one detector on one meter = fixed + per_unit * units, measured on one CPU core.
+# 'fit' is fitting and scoring the detector on the meter (anomaly_with_pyod), 'score' is scoring with a saved
+# model (predict_whole_dataset). Units of rows n with d features: 'rows' = n, 'cells' = n * d,
+# 'neighbours' = n * log2(n) * d (tree build and neighbour queries), 'epochs' = n * d * epochs.
+COST_MODEL = {
+    'fit': {'IForest': (0.2, 2.4e-5, 'rows'), 'KNN': (0.003, 5.5e-7, 'neighbours'), 'LOF': (0.003, 1.1e-6, 'neighbours'),
+            'AutoEncoder': (0.05, 1.8e-5, 'epochs')},
+    'score': {'IForest': (0.013, 6.3e-6, 'rows'), 'KNN': (0.001, 2.7e-7, 'neighbours'), 'LOF': (0.001, 5.3e-7, 'neighbours'),
+              'AutoEncoder': (0.001, 3.2e-7, 'cells')}
+}
+DEFAULT_COST = (0.0, 1e-5, 'cells')
+
+def series_rows(file_path):
+    # Exact from the time index of the sort stage, otherwise estimated from the file size and the first lines
+    rows = indexed_row_count(file_path)
+    if rows is not None:
+        return rows
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        header = len(f.readline())
+        sample = f.read(65536)
+    lines = sample.count(b'\n') + (1 if sample and not sample.endswith(b'\n') else 0)
+    if len(sample) < 65536 or not lines:
+        return lines
+    return round((size - header) * lines / len(sample))
+
+def min_rows(model, phase):
+    # A neighbour detector fitted on no more rows than its neighbourhood has no outliers to find (KNN raises)
+    if phase == 'fit' and hasattr(model, 'n_neighbors'):
+        return model.n_neighbors + 1
+    return 1
+
+def cost_units(units, model, rows, features):
+    if units == 'neighbours':
+        return rows * math.log2(rows + 1) * features
+    if units == 'epochs':
+        return rows * features * getattr(model, 'epoch_num', 1)
+    if units == 'cells':
+        return rows * features
+    return rows
+
+def load_costs(costs_file=None):
+    # {phase: {detector class: (fixed, per_unit, units)}} with the per_unit values saved by earlier runs
+    costs = {phase: dict(detectors) for phase, detectors in COST_MODEL.items()}
+    costs_file = DETECTOR_COSTS if costs_file is None else costs_file
+    if costs_file and os.path.exists(costs_file):
+        try:
+            with open(costs_file) as f:
+                for phase, detectors in json.load(f).items():
+                    for kind, per_unit in detectors.items():
+                        fixed, _, units = costs[phase].get(kind, DEFAULT_COST)
+                        costs[phase][kind] = (fixed, float(per_unit), units)
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            print(f"Error reading detector costs {costs_file}: {e}")
+    return costs
+
+def plan_detectors(file_paths, models, phase, features, budget=None, costs_file=None):
+    # Chooses the detectors to run on every meter from their estimated cost. Without a budget every detector runs
+    # on every meter long enough for it. With a budget every meter gets its cheapest detector, so none is left
+    # unscored, then the other detectors are added in the order of models, each to the cheapest meters first,
+    # while the estimated total stays within the budget. Meters are ordered longest first, so a long meter
+    # does not start last and hold up the end of the run.
+    budget = DETECTOR_BUDGET if budget is None else budget
+    costs = load_costs(costs_file)
+    kinds = {name: type(model).__name__ for name, model in models.items()}
+    meters = {}
+    for file_path in file_paths:
+        rows = series_rows(file_path)
+        meter = {'rows': rows, 'estimates': {}, 'units': {}, 'detectors': [], 'actual': {}}
+        for name, model in models.items():
+            if rows < min_rows(model, phase):
+                continue
+            fixed, per_unit, units = costs[phase].get(kinds[name], DEFAULT_COST)
+            meter['units'][name] = cost_units(units, model, rows, features)
+            meter['estimates'][name] = fixed + per_unit * meter['units'][name]
+        meters[file_path] = meter
+
+    if not budget:
+        for meter in meters.values():
+            meter['detectors'] = list(meter['estimates'])
+    else:
+        spent = 0.0
+        for meter in meters.values():
+            if meter['estimates']:
+                cheapest = min(meter['estimates'], key=meter['estimates'].get)
+                meter['detectors'].append(cheapest)
+                spent += meter['estimates'][cheapest]
+        for name in models:
+            candidates = sorted((file_path for file_path, meter in meters.items()
+                                 if name in meter['estimates'] and name not in meter['detectors']),
+                                key=lambda file_path: meters[file_path]['estimates'][name])
+            for file_path in candidates:
+                if spent + meters[file_path]['estimates'][name] > budget:
+                    break
+                meters[file_path]['detectors'].append(name)
+                spent += meters[file_path]['estimates'][name]
+        # Detectors of a meter run in the order of models
+        for meter in meters.values():
+            meter['detectors'] = [name for name in models if name in meter['detectors']]
+
+    plan = {'phase': phase, 'budget': budget, 'features': features, 'kinds': kinds, 'costs': costs, 'meters': meters,
+            'order': sorted(meters, key=lambda file_path: (-meters[file_path]['rows'], file_path))}
+    planned = planned_seconds(plan)
+    print(f"Detector plan: {len(meters)} meters, estimated {planned:.2f}s" + (f" of a {budget:.2f}s budget" if budget else ""))
+    for name in models:
+        print(f"  {name}: {sum(name in meter['detectors'] for meter in meters.values())} of {len(meters)} meters")
+    return plan
+
+def planned_seconds(plan, file_paths=None):
+    meters = plan['meters'] if file_paths is None else {file_path: plan['meters'][file_path] for file_path in file_paths}
+    return sum(meter['estimates'][name] for meter in meters.values() for name in meter['detectors'])
+
+def planned_models(plan, file_path, models):
+    # The models planned for a meter; every model for a file the plan does not know
+    meter = plan['meters'].get(file_path) if plan is not None else None
+    if meter is None:
+        return models
+    return {name: models[name] for name in meter['detectors']}
+
+def record_cost(plan, file_path, timings):
+    # timings: {detector name: measured seconds} of one meter
+    if plan is not None and file_path in plan['meters']:
+        plan['meters'][file_path]['actual'].update(timings)
+
+def report_plan(plan, costs_file=None):
+    # Planned against measured seconds per detector over the meters that ran, then the cost coefficients are
+    # corrected with the measured times for the next plan
+    if plan is None:
+        return None
+    ran = {file_path: meter for file_path, meter in plan['meters'].items() if meter['actual']}
+    if not ran:
+        return None
+    planned_total = 0.0
+    actual_total = 0.0
+    print(f"Detector cost, planned against actual ({len(ran)} of {len(plan['meters'])} meters ran):")
+    for name in plan['kinds']:
+        timed = [meter for meter in ran.values() if name in meter['actual'] and name in meter['estimates']]
+        if not timed:
+            continue
+        planned = sum(meter['estimates'][name] for meter in timed)
+        actual = sum(meter['actual'][name] for meter in timed)
+        planned_total += planned
+        actual_total += actual
+        print(f"  {name}: {len(timed)} meters, planned {planned:.2f}s, actual {actual:.2f}s ({actual / max(planned, 1e-9):.2f}x)")
+    skipped = sum(len(meter['estimates']) - len(meter['detectors']) for meter in ran.values())
+    print(f"  Total: planned {planned_total:.2f}s, actual {actual_total:.2f}s" +
+          (f", budget {plan['budget']:.2f}s" if plan['budget'] else "") + f", {skipped} detector runs skipped")
+    add_metrics(detector_budget_seconds=plan['budget'], planned_detector_seconds=round(planned_total, 6),
+                actual_detector_seconds=round(actual_total, 6), detector_runs_skipped=skipped)
+    return update_costs(plan, costs_file)
+
+def update_costs(plan, costs_file=None):
+    # The per_unit value of every detector class moves halfway to the one measured in this run
+    costs_file = DETECTOR_COSTS if costs_file is None else costs_file
+    if not costs_file:
+        return None
+    phase = plan['phase']
+    measured = {}
+    for meter in plan['meters'].values():
+        for name, seconds in meter['actual'].items():
+            if name not in meter['units']:
+                continue
+            kind = plan['kinds'][name]
+            fixed = plan['costs'][phase].get(kind, DEFAULT_COST)[0]
+            total = measured.setdefault(kind, [0.0, 0.0])
+            total[0] += max(seconds - fixed, 0.0)
+            total[1] += meter['units'][name]
+
+    try:
+        saved = {}
+        if os.path.exists(costs_file):
+            with open(costs_file) as f:
+                saved = json.load(f)
+        for kind, (seconds, units) in measured.items():
+            if units > 0:
+                current = plan['costs'][phase].get(kind, DEFAULT_COST)[1]
+                saved.setdefault(phase, {})[kind] = (current + seconds / units) / 2
+
+        costs_folder = os.path.dirname(costs_file)
+        if costs_folder:
+            os.makedirs(costs_folder, exist_ok=True)
+        # Workers of a sharded run save at the end of their run, each through its own temporary file
+        temp_file = f"{costs_file}.{os.getpid()}{TEMP_SUFFIX}"
+        with open(temp_file, 'w') as f:
+            json.dump(saved, f, indent=2)
+        os.replace(temp_file, costs_file)
+    except (OSError, ValueError) as e:
+        print(f"Error saving detector costs {costs_file}: {e}")
+        return None
+    return costs_file
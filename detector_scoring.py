@@ -0,0 +1,33 @@
+import numpy as np
+
+# Rows scored per block; the neighbour queries and network passes never hold more than this at once
+SCORE_BLOCK_ROWS = 65536
+
+def decision_scores(model, X, block_rows=SCORE_BLOCK_ROWS):
+    # Outlier scores of a fitted pyod detector, computed block by block
+    X = np.asarray(X)
+    if type(model).__name__ == 'AutoEncoder':
+        # Same reconstruction distance as AutoEncoder.decision_function, without its per-row data loader
+        from autoencoder_cpu import score_autoencoder
+        return score_autoencoder(model, X, block_rows, getattr(model, 'compute_dtype_', 'float32'))
+
+    scores = np.empty(len(X))
+    for start in range(0, len(X), block_rows):
+        scores[start:start + block_rows] = model.decision_function(X[start:start + block_rows])
+    return scores
+
+def labels_from_scores(model, scores):
+    # The labels pyod's predict would return for these scores, without scoring the rows again
+    if isinstance(model.contamination, (float, int)):
+        return (scores > model.threshold_).astype(int)
+    # PyThresh thresholding object
+    return model.contamination.predict(scores)
+
+def score_model(model, X, z_score=None, z_score_threshold=None, block_rows=SCORE_BLOCK_ROWS):
+    # One scoring pass per model: raw scores, binary labels and, when z-scores are given, validated flags
+    scores = decision_scores(model, X, block_rows)
+    labels = labels_from_scores(model, scores)
+    validated = None
+    if z_score is not None:
+        validated = (labels == 1) & (np.abs(np.asarray(z_score)) > z_score_threshold)
+    return scores, labels, validated
@@ -0,0 +1,283 @@
+import numpy as np
+import pandas as pd
+from date_parsing import parse_datetimes
+
+NS_PER_HOUR = 3600 * 10 ** 9
+NS_PER_DAY = 24 * NS_PER_HOUR
+
+# Rows read and processed per block; temporary arrays never grow beyond this
+CHUNK_ROWS = 65536
+
+# Timestamp column and format of the sorted per-meter files of each dataset
+DATETIME_COLUMNS = {
+    'datamill': ('READING_START_DATE', '%d/%m/%Y %H:%M'),
+    'helios': ('datetime', '%d/%m/%Y %H:%M:%S'),
+    'queensland': ('datetime', '%d/%m/%Y %H:%M:%S')
+}
+
+def load_series(file_path, dataset_type, value_column, sep=',', chunk_rows=CHUNK_ROWS):
+    # Read only the timestamp and value columns, in chunks so the timestamp strings of the
+    # whole file are never in memory at once, and return them sorted by time as plain arrays
+    time_column, time_format = DATETIME_COLUMNS[dataset_type]
+    timestamps = []
+    values = []
+    for chunk in pd.read_csv(file_path, sep=sep, usecols=[time_column, value_column], chunksize=chunk_rows):
+        timestamps.append(parse_datetimes(chunk[time_column], format=time_format).to_numpy(dtype='datetime64[ns]').view(np.int64))
+        values.append(chunk[value_column].to_numpy(dtype=np.float64))
+
+    if not timestamps:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    timestamps = np.concatenate(timestamps)
+    values = np.concatenate(values)
+
+    # Files from the sort stage are already in order and need no copy
+    if len(timestamps) > 1 and (timestamps[1:] < timestamps[:-1]).any():
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, values = timestamps[order], values[order]
+    return timestamps, values
+
+def calendar_features(timestamps):
+    # Hour and day of week (Monday=0) straight from int64 nanoseconds; 1970-01-01 was a Thursday
+    hour = ((timestamps // NS_PER_HOUR) % 24).astype(np.int8)
+    day_of_week = ((timestamps // NS_PER_DAY + 3) % 7).astype(np.int8)
+    return hour, day_of_week
+
+# Statistics of rolling_window_stats: mean, sample std, min, max and the z-score of the last value of the window
+ROLLING_STATS = ['mean', 'std', 'min', 'max', 'z']
+
+def sliding_extremes(x, windows):
+    # Maximum of every trailing window of x for several window lengths (sparse table): maxima over 1, 2, 4, ...
+    # rows are built once and shared, and every window is the larger of two overlapping power-of-two spans.
+    # Returns {window: array of len(x) - window + 1 maxima}.
+    n = len(x)
+    levels = {window: window.bit_length() - 1 for window in windows}
+    top = max(levels.values())
+    spans = {}
+    current = x
+    for level in range(top + 1):
+        if level in levels.values():
+            spans[level] = current
+        if level < top:
+            # Maxima over 2 ** (level + 1) rows
+            current = np.maximum(current[:-(1 << level)], current[1 << level:])
+    return {window: np.maximum(spans[level][:n - window + 1], spans[level][window - (1 << level):n - (1 << level) + 1])
+            for window, level in levels.items()}
+
+# Shortest block of block_sums; short windows share longer blocks, which keeps the per-block work vectorised
+MIN_BLOCK_ROWS = 256
+
+def block_sums(x, valid, block):
+    # Running sums of x - c and (x - c)**2 within blocks of block rows, c being the block mean, shared by every
+    # window of up to block rows: rounding errors grow with the block length and not with len(x), and the local
+    # centre keeps them small on trending series too. Missing values count as c; their windows are masked later.
+    n = len(x)
+    blocks = -(-n // block)
+    # Two extra empty blocks give the windows of the last block a next block
+    centred = np.zeros((blocks + 2, block))
+    flat = centred.ravel()
+    flat[:n] = x
+    missing = np.flatnonzero(~valid)
+    flat[missing] = 0.0
+    present = np.full(blocks + 2, block)
+    present[blocks - 1] = n - (blocks - 1) * block
+    present[blocks:] = 0
+    present -= np.bincount(missing // block, minlength=blocks + 2)
+    centres = centred.sum(axis=1) / np.maximum(present, 1)
+    centred -= centres[:, None]
+    flat[missing] = 0.0
+    flat[n:] = 0.0
+    squares = centred * centred
+
+    upto = np.cumsum(centred, axis=1)
+    squares_upto = np.cumsum(squares, axis=1)
+    return {
+        'block': block,
+        'blocks': blocks,
+        # Sums of the rows of the block up to and including each row, and before each row
+        'upto': upto.ravel(),
+        'before': (upto - centred).ravel(),
+        'squares_upto': squares_upto.ravel(),
+        'squares_before': (squares_upto - squares).ravel(),
+        # Per block: totals, centre and the step to the next block's centre
+        'totals': upto[:, -1],
+        'square_totals': squares_upto[:, -1],
+        'centres': centres,
+        'steps': np.diff(centres, append=centres[-1])
+    }
+
+def window_moments(sums, window, n):
+    # Sums of x - c and (x - c)**2 over every trailing window, c being the centre of the block the window starts
+    # in, and that centre. A window starting in one of the last window - 1 rows of a block is the end of its block
+    # plus the start of the next one, whose values are centred on the next block's centre and shifted back by the
+    # step between both. Windows are laid out one block per row, so the crossing windows are the last columns.
+    block, blocks = sums['block'], sums['blocks']
+    rows = blocks * block
+    window_sum = (sums['upto'][window - 1:window - 1 + rows] - sums['before'][:rows]).reshape(blocks, block)
+    square_sum = (sums['squares_upto'][window - 1:window - 1 + rows] - sums['squares_before'][:rows]).reshape(blocks, block)
+
+    first = block - window + 1
+    if first < block:
+        head = sums['upto'][window - 1:window - 1 + rows].reshape(blocks, block)[:, first:]
+        head_rows = np.arange(first, block) + window - block
+        step = sums['steps'][:blocks, None]
+        window_sum[:, first:] += sums['totals'][:blocks, None] + head_rows * step
+        square_sum[:, first:] += sums['square_totals'][:blocks, None] + (2 * head + head_rows * step) * step
+
+    count = n - window + 1
+    centre = np.repeat(sums['centres'][:blocks], block)
+    return window_sum.ravel()[:count], square_sum.ravel()[:count], centre[:count]
+
+def rolling_window_stats(x, windows, stats=ROLLING_STATS):
+    # Trailing rolling statistics of x for several window lengths, with the same NaN rules as pandas rolling(window).
+    # Block sums, missing-value counts and min/max spans are built once and shared by all windows, so an extra
+    # window costs a few vectorised passes instead of one pandas rolling call per statistic and window.
+    # Returns {window: {stat: array}}.
+    n = len(x)
+    valid = ~np.isnan(x)
+    all_valid = valid.all()
+    computed = [window for window in windows if window <= n]
+
+    if not all_valid:
+        nan_count = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(~valid, out=nan_count[1:])
+    if computed and ('mean' in stats or 'std' in stats or 'z' in stats):
+        sums = block_sums(x, valid, max(computed + [MIN_BLOCK_ROWS]))
+    # Missing values never win a comparison; their windows are set to NaN below
+    if computed and 'max' in stats:
+        highs = x.copy()
+        highs[~valid] = -np.inf
+        maxima = sliding_extremes(highs, computed)
+    if computed and 'min' in stats:
+        lows = -x
+        lows[~valid] = -np.inf
+        minima = sliding_extremes(lows, computed)
+
+    results = {}
+    for window in windows:
+        result = {stat: np.full(n, np.nan) for stat in stats}
+        results[window] = result
+        if window > n:
+            continue
+
+        if 'mean' in stats or 'std' in stats or 'z' in stats:
+            window_sum, variance, centre = window_moments(sums, window, n)
+            window_mean = window_sum / window
+            mean = window_mean + centre
+            if 'mean' in stats:
+                result['mean'][window - 1:] = mean
+        if window > 1 and ('std' in stats or 'z' in stats):
+            variance -= window_sum * window_mean
+            np.maximum(variance, 0.0, out=variance)
+            variance /= window - 1
+            std = np.sqrt(variance)
+            if 'std' in stats:
+                result['std'][window - 1:] = std
+            if 'z' in stats:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    result['z'][window - 1:] = (x[window - 1:] - mean) / std
+        if 'max' in stats:
+            result['max'][window - 1:] = maxima[window]
+        if 'min' in stats:
+            result['min'][window - 1:] = -minima[window]
+
+        # Windows that contain a missing value stay NaN
+        if not all_valid:
+            incomplete = nan_count[window:] != nan_count[:-window]
+            for column in result.values():
+                np.copyto(column[window - 1:], np.nan, where=incomplete)
+    return results
+
+def rolling_feature(feature, window_size):
+    # (statistic, window) of a rolling feature: 'rolling_mean' and 'rolling_std' use window_size, multi-scale
+    # features name their window, e.g. 'rolling_max_168' or 'z_score_720'. None for other features.
+    for prefix, stat in [('rolling_mean', 'mean'), ('rolling_std', 'std'), ('rolling_min', 'min'), ('rolling_max', 'max'),
+                         ('z_score', 'z')]:
+        if feature == prefix:
+            return stat, window_size
+        if feature.startswith(prefix + '_') and feature[len(prefix) + 1:].isdigit():
+            return stat, int(feature[len(prefix) + 1:])
+    return None
+
+def longest_window(features, window_size):
+    # Rows of history the rolling features need
+    return max([window_size] + [rolling_feature(feature, window_size)[1] for feature in features
+                                if rolling_feature(feature, window_size)])
+
+def max_z_score(window):
+    # The z-score of the last of n values against the mean and sample std of the same n values is at most (n - 1) / sqrt(n)
+    return (window - 1) / np.sqrt(window)
+
+def build_feature_matrix(timestamps, values, features, window_size, rolling_on='diff', out=None, chunk_rows=CHUNK_ROWS,
+                         fill_values=None, masked=None, z_window=None, z_on=None):
+    # Writes the requested feature columns straight into a float32 matrix and returns it with the z-scores.
+    # rolling_on='diff' computes rolling statistics of the consumption difference, 'value' of the raw values.
+    # Besides the window_size statistics, features such as 'rolling_mean_168' or 'z_score_720' add other windows,
+    # all computed in one rolling_window_stats call per block.
+    # Rows are processed in blocks that carry the longest window of history, so only the output is full length.
+    # Missing values are filled with fill_values (e.g. the training means) when given, else with the column means.
+    # masked marks rows whose difference to the previous row is not consumption (duplicates, gaps and counter
+    # resets from the quality sidecar, see data_quality.py); their differences are treated as missing.
+    # The returned z-scores use z_window rows of z_on ('diff' or 'value'), by default those of the rolling features.
+    z_window = z_window or window_size
+    z_on = z_on or rolling_on
+    n = len(values)
+    if out is None:
+        out = np.empty((n, len(features)), dtype=np.float32)
+    z_score = np.empty(n, dtype=np.float32)
+
+    column_sums = np.zeros(len(features))
+    column_counts = np.zeros(len(features), dtype=np.int64)
+    calendar = 'hour' in features or 'day_of_week' in features
+    rolling = {feature: rolling_feature(feature, window_size) for feature in features if rolling_feature(feature, window_size)}
+    windows = sorted({window_size} | {window for _, window in rolling.values()} | ({z_window} if z_on == rolling_on else set()))
+    stats = [stat for stat in ROLLING_STATS if stat in {'mean', 'std', 'z'} | {stat for stat, _ in rolling.values()}]
+    history = max(windows[-1], z_window)
+
+    for start in range(0, n, chunk_rows):
+        stop = min(start + chunk_rows, n)
+        low = max(start - history, 0)
+        block = values[low:stop]
+        offset = start - low
+
+        diff = np.empty(len(block))
+        diff[0] = values[low] - values[low - 1] if low > 0 else np.nan
+        np.subtract(block[1:], block[:-1], out=diff[1:])
+        if masked is not None:
+            diff[masked[low:stop]] = np.nan
+
+        base = diff if rolling_on == 'diff' else block
+        window_stats = rolling_window_stats(base, windows, stats)
+        if z_on == rolling_on:
+            z_score[start:stop] = window_stats[z_window]['z'][offset:]
+        else:
+            z_base = diff if z_on == 'diff' else block
+            z_score[start:stop] = rolling_window_stats(z_base, [z_window], ['mean', 'std', 'z'])[z_window]['z'][offset:]
+
+        columns = {'diff': diff[offset:]}
+        for feature, (stat, window) in rolling.items():
+            columns[feature] = window_stats[window][stat][offset:]
+        if calendar:
+            columns['hour'], columns['day_of_week'] = calendar_features(timestamps[start:stop])
+
+        for j, feature in enumerate(features):
+            column = columns[feature]
+            out[start:stop, j] = column
+            if column.dtype.kind == 'f':
+                present = ~np.isnan(column)
+                column_sums[j] += column[present].sum()
+                column_counts[j] += present.sum()
+            else:
+                column_sums[j] += column.sum(dtype=np.int64)
+                column_counts[j] += len(column)
+
+    # Fill missing values with the column mean, or 0 when the whole column is missing
+    for j in range(len(features)):
+        if column_counts[j] < n:
+            if fill_values is not None:
+                fill = fill_values[j]
+            else:
+                fill = column_sums[j] / column_counts[j] if column_counts[j] else 0.0
+            column = out[:, j]
+            column[np.isnan(column)] = fill
+
+    return out, z_score
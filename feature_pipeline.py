@@ -0,0 +1,114 @@
+import time
+import numpy as np
+import pandas as pd
+from feature_engine import CHUNK_ROWS, DATETIME_COLUMNS, build_feature_matrix, longest_window
+from detector_scoring import score_model
+from data_quality import masked_rows, row_mask
+from date_parsing import parse_datetimes
+
+# Feature definition of train_whole_dataset: rolling statistics of the consumption difference over 7 readings
+FEATURES = ['diff', 'day_of_week', 'rolling_mean', 'rolling_std']
+WINDOW_SIZE = 7
+
+# Z-score that validates anomalies, as in the per-file scripts: the raw values over 24 hourly readings for Helios and
+# over 7 readings otherwise. The window bounds the usable thresholds (see max_z_score): 4.69 for 24 rows, 2.27 for 7.
+Z_SCORE_WINDOWS = {'helios': 24, 'queensland': 7, 'datamill': 7}
+Z_SCORE_ON = 'value'
+
+# Layout version of the saved preprocessing; bump it when the keys or their meaning change
+PREPROCESSING_FORMAT = 2
+
+def dataset_for_column(value_column):
+    if value_column in ['GROSS_CONSUMPTION', 'DAILY_AVERAGE_CONSUMPTION']:
+        return 'datamill'
+    return 'queensland' if value_column in ['Pulse1', 'Pulse1_Total'] else 'helios'
+
+def z_score_settings(preprocessing):
+    # (window, series) of the validation z-score; preprocessing saved before format 2 gets the dataset defaults
+    return (preprocessing.get('z_window', Z_SCORE_WINDOWS.get(preprocessing['dataset_type'], WINDOW_SIZE)),
+            preprocessing.get('z_on', Z_SCORE_ON))
+
+def make_preprocessing(value_column, scaler, dataset_type=None, features=None):
+    # Everything needed to turn a sorted meter file into the scaled features the models were trained on.
+    # Missing features are filled with the training means, which the scaler maps to 0.
+    # features defaults to FEATURES; multi-scale features such as 'rolling_max_168' are also accepted.
+    dataset_type = dataset_type or dataset_for_column(value_column)
+    time_column, time_format = DATETIME_COLUMNS[dataset_type]
+    return {
+        'format': PREPROCESSING_FORMAT,
+        'dataset_type': dataset_type,
+        'value_column': value_column,
+        'time_column': time_column,
+        'time_format': time_format,
+        'features': list(features or FEATURES),
+        'window_size': WINDOW_SIZE,
+        'rolling_on': 'diff',
+        'z_window': Z_SCORE_WINDOWS[dataset_type],
+        'z_on': Z_SCORE_ON,
+        'fill_values': np.asarray(scaler.mean_, dtype=np.float64),
+        'scaler': scaler
+    }
+
+def read_series_chunks(preprocessing, file_path, value_column=None, chunk_rows=CHUNK_ROWS):
+    # Timestamps (int64 ns) and values of a time-sorted file, one block of rows at a time
+    value_column = value_column or preprocessing['value_column']
+    time_column = preprocessing['time_column']
+    last_time = None
+    for chunk in pd.read_csv(file_path, usecols=[time_column, value_column], chunksize=chunk_rows):
+        timestamps = parse_datetimes(chunk[time_column], format=preprocessing['time_format']).to_numpy(dtype='datetime64[ns]').view(np.int64)
+        values = chunk[value_column].to_numpy(dtype=np.float64)
+        if len(timestamps) and ((timestamps[1:] < timestamps[:-1]).any() or (last_time is not None and timestamps[0] < last_time)):
+            raise ValueError(f"{file_path} is not sorted by time, run sort_time.py first")
+        if len(timestamps):
+            last_time = timestamps[-1]
+        yield timestamps, values
+
+def transform_chunks(preprocessing, file_path, value_column=None, chunk_rows=CHUNK_ROWS):
+    # Yields (timestamps, values, scaled features, z-scores) per block of rows. Each block carries the last
+    # values of the previous one (the longest window), so the rolling features match a transform of the whole file.
+    window_size = preprocessing['window_size']
+    z_window, z_on = z_score_settings(preprocessing)
+    history = max(longest_window(preprocessing['features'], window_size), z_window)
+    scaler = preprocessing['scaler']
+    history_times = np.empty(0, dtype=np.int64)
+    history_values = np.empty(0, dtype=np.float64)
+    # Rows flagged by the sort stage (duplicates, gaps, counter resets)
+    rows = masked_rows(file_path)
+    row = 0
+    for timestamps, values in read_series_chunks(preprocessing, file_path, value_column, chunk_rows):
+        all_times = np.concatenate([history_times, timestamps])
+        all_values = np.concatenate([history_values, values])
+        masked = row_mask(rows, row - len(history_values), row + len(values)) if len(rows) else None
+        X, z_score = build_feature_matrix(all_times, all_values, preprocessing['features'], window_size,
+                                          preprocessing['rolling_on'], fill_values=preprocessing['fill_values'],
+                                          masked=masked, z_window=z_window, z_on=z_on)
+        X = X[len(history_values):]
+        X_scaled = (X - scaler.mean_) / scaler.scale_
+        yield timestamps, values, X_scaled, z_score[len(history_values):]
+
+        history_times = all_times[-history:]
+        history_values = all_values[-history:]
+        row += len(values)
+
+def score_chunks(preprocessing, models, file_path, value_column=None, chunk_rows=CHUNK_ROWS, z_score_threshold=None,
+                 transformed=None, timings=None):
+    # Single transform-and-score pass over a file of any size: one DataFrame of scores and labels per block,
+    # with validated flags when a z-score threshold is given. Blocks already built by transform_chunks
+    # (e.g. by a prefetching reader) can be passed as transformed. Seconds spent scoring with each model
+    # are added to timings when a dict is passed.
+    value_column = value_column or preprocessing['value_column']
+    if transformed is None:
+        transformed = transform_chunks(preprocessing, file_path, value_column, chunk_rows)
+    for timestamps, values, X_scaled, z_score in transformed:
+        df = pd.DataFrame({'datetime': pd.to_datetime(timestamps), value_column: values, 'z_score': z_score})
+        for model_name, model in models.items():
+            start = time.perf_counter()
+            scores, labels, validated = score_model(model, X_scaled, z_score if z_score_threshold is not None else None,
+                                                    z_score_threshold)
+            df[f'{model_name}_anomaly_score'] = scores
+            df[f'{model_name}_is_anomaly'] = labels
+            if validated is not None:
+                df[f'{model_name}_is_validated_anomaly'] = validated
+            if timings is not None:
+                timings[model_name] = timings.get(model_name, 0.0) + time.perf_counter() - start
+        yield df
@@ -0,0 +1,211 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Year files written for the Datamill dataset, in the same naming as the real archives
+DATAMILL_YEARS = ['201011', '201112', '201213', '201314']
+
+def ensure_dir(directory):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+def inject_anomalies(values, rng, anomaly_rate):
+    # Returns a copy of values with spikes and leaks injected, plus the anomaly positions and kinds
+    values = values.copy()
+    n = len(values)
+    n_anomalies = max(1, int(n * anomaly_rate)) if n > 10 else 0
+    positions = np.sort(rng.choice(np.arange(5, n), size=min(n_anomalies, n - 5), replace=False)) if n_anomalies else np.array([], dtype=int)
+
+    kinds = []
+    scale = max(float(np.mean(values)), 1.0)
+    for pos in positions:
+        if rng.random() < 0.7:
+            # Single large spike
+            values[pos] += scale * rng.uniform(8, 15)
+            kinds.append('spike')
+        else:
+            # Sustained leak over a few readings
+            length = int(rng.integers(3, 8))
+            values[pos:pos + length] += scale * rng.uniform(3, 5)
+            kinds.append('leak')
+
+    return values, positions, kinds
+
+def consumption_profile(timestamps, rng, base):
+    # Daily usage pattern with a morning and evening peak plus noise
+    hours = timestamps.hour.values + timestamps.minute.values / 60.0
+    daily = 1.0 + 0.8 * np.exp(-((hours - 7.5) ** 2) / 2.0) + 0.6 * np.exp(-((hours - 19.5) ** 2) / 3.0)
+    noise = rng.gamma(shape=4.0, scale=0.25, size=len(timestamps))
+    return base * daily * noise
+
+def generate_helios(output_root, meters, readings, rng, anomaly_rate=0.01):
+    output_folder = os.path.join(output_root, 'helios', 'org_dataset')
+    ensure_dir(output_folder)
+
+    timestamps = pd.date_range('2020-01-01', periods=readings, freq='h')
+    frames = []
+    truth = []
+
+    for meter in range(meters):
+        user_key = f'user{meter:05d}'
+        usage = consumption_profile(timestamps, rng, base=rng.uniform(5, 20))
+        usage, positions, kinds = inject_anomalies(usage, rng, anomaly_rate)
+        meter_reading = rng.uniform(1000, 50000) + np.cumsum(usage)
+
+        frames.append(pd.DataFrame({
+            'user key': user_key,
+            'datetime': timestamps.strftime('%d/%m/%Y %H:%M:%S'),
+            'meter reading': np.round(meter_reading, 3),
+            'diff': np.round(usage, 3)
+        }))
+        truth.extend({'dataset': 'helios', 'meter': user_key, 'datetime': timestamps[pos], 'kind': kind}
+                     for pos, kind in zip(positions, kinds))
+
+    output_file = os.path.join(output_folder, 'swm_trialA_1K.csv')
+    pd.concat(frames).to_csv(output_file, index=False, sep=';')
+    print(f"Created file: {output_file}")
+    return truth
+
+def generate_queensland(output_root, meters, readings, rng, anomaly_rate=0.01):
+    output_folder = os.path.join(output_root, 'queensland', 'org_dataset')
+    ensure_dir(output_folder)
+
+    frames = []
+    truth = []
+
+    for meter in range(meters):
+        object_id = str(1000000 + meter)
+
+        # Irregular reporting interval between 10 and 60 minutes
+        intervals = rng.integers(10, 61, size=readings)
+        timestamps = pd.Timestamp('2022-07-01') + pd.to_timedelta(np.cumsum(intervals), unit='min')
+        pulses = np.round(consumption_profile(timestamps, rng, base=rng.uniform(1, 4)) * intervals / 15.0)
+        pulses, positions, kinds = inject_anomalies(pulses, rng, anomaly_rate)
+        pulses = np.round(pulses)
+        totals = rng.integers(10000, 500000) + np.cumsum(pulses)
+
+        time_strings = timestamps.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        for series, values in (('P1', pulses), ('T1', totals)):
+            frames.append(pd.DataFrame({
+                'time': time_strings,
+                'ManagedObjectid': object_id,
+                'Series': series,
+                'Value': values.astype(np.int64)
+            }))
+        truth.extend({'dataset': 'queensland', 'meter': object_id, 'datetime': timestamps[pos], 'kind': kind}
+                     for pos, kind in zip(positions, kinds))
+
+    # Queensland exports are published as one file per month
+    all_data = pd.concat(frames)
+    months = pd.to_datetime(all_data['time'], format='%Y-%m-%dT%H:%M:%S.000Z').dt.strftime('%B_%Y')
+    for month, month_data in all_data.groupby(months, sort=False):
+        output_file = os.path.join(output_folder, f'Digital_Meter_Data_{month}.csv')
+        month_data.to_csv(output_file, index=False)
+        print(f"Created file: {output_file}")
+
+    return truth
+
+def generate_datamill(output_root, meters, readings, rng, anomaly_rate=0.01):
+    output_folder = os.path.join(output_root, 'datamill', 'org_dataset')
+    ensure_dir(output_folder)
+
+    year_frames = {year: [] for year in DATAMILL_YEARS}
+    truth = []
+    areas = ['LS', 'BD', 'HX', 'HD', 'WF', 'YO', 'HG', 'DN', 'S']
+
+    for meter in range(meters):
+        postcode = f'{areas[meter % len(areas)]}{meter // len(areas) + 1}'
+
+        # Billing periods of one to four months spread across the four reporting years
+        start_dates = pd.Timestamp('2010-04-01') + pd.to_timedelta(np.sort(rng.integers(0, 4 * 365 - 120, size=readings)), unit='D')
+        period_days = rng.integers(30, 121, size=readings)
+        end_dates = start_dates + pd.to_timedelta(period_days, unit='D')
+
+        daily_average = rng.gamma(shape=6.0, scale=0.05, size=readings) * rng.uniform(0.5, 2.0)
+        daily_average, positions, kinds = inject_anomalies(daily_average, rng, anomaly_rate)
+        gross = daily_average * period_days
+        start_reading = rng.uniform(0, 5000, size=readings)
+
+        data = pd.DataFrame({
+            'POSTCODE_OUTCODE': postcode,
+            'READING_START_DATE': start_dates.strftime('%d/%m/%Y %H:%M'),
+            'READING_END_DATE': end_dates.strftime('%d/%m/%Y %H:%M'),
+            'READING_START_READING': np.round(start_reading, 1),
+            'READING_END_READING': np.round(start_reading + gross, 1),
+            'GROSS_CONSUMPTION': np.round(gross, 3),
+            'DAILY_AVERAGE_CONSUMPTION': np.round(daily_average, 3)
+        })
+
+        # Reporting years run from April to March
+        years = np.where(start_dates.month >= 4, start_dates.year, start_dates.year - 1)
+        for year, year_data in data.groupby(years):
+            key = f'{year}{(year + 1) % 100:02d}'
+            if key in year_frames:
+                year_frames[key].append(year_data)
+
+        truth.extend({'dataset': 'datamill', 'meter': postcode, 'datetime': start_dates[pos], 'kind': kind}
+                     for pos, kind in zip(positions, kinds))
+
+    for year, frames in year_frames.items():
+        if frames:
+            output_file = os.path.join(output_folder, f'{year}_YW_Customer_Meter_Data.csv')
+            pd.concat(frames).to_csv(output_file, index=False)
+            print(f"Created file: {output_file}")
+
+    return truth
+
+def generate_meter_file(output_file, readings, seed=42, anomaly_rate=0.01):
+    # Single hourly meter in the sorted, comma-separated Helios layout, for benchmarks of the per-file stages
+    rng = np.random.default_rng(seed)
+    timestamps = pd.date_range('2015-01-01', periods=readings, freq='h')
+    usage, _, _ = inject_anomalies(consumption_profile(timestamps, rng, base=10.0), rng, anomaly_rate)
+
+    pd.DataFrame({
+        'datetime': timestamps.strftime('%d/%m/%Y %H:%M:%S'),
+        'meter reading': np.round(20000 + np.cumsum(usage), 3),
+        'diff': np.round(usage, 3)
+    }).to_csv(output_file, index=False)
+    return output_file
+
+def generate_datasets(output_root, meters=100, readings=1000, datasets=('datamill', 'queensland', 'helios'),
+                      anomaly_rate=0.01, seed=42):
+    rng = np.random.default_rng(seed)
+    generators = {
+        'datamill': generate_datamill,
+        'queensland': generate_queensland,
+        'helios': generate_helios
+    }
+
+    truth = []
+    for dataset in datasets:
+        truth.extend(generators[dataset](output_root, meters, readings, rng, anomaly_rate))
+
+    # Ground truth of the injected anomalies, one row per anomaly start
+    truth_file = os.path.join(output_root, 'ground_truth.csv')
+    pd.DataFrame(truth, columns=['dataset', 'meter', 'datetime', 'kind']).to_csv(truth_file, index=False)
+    print(f"Ground truth saved to {truth_file}")
+
+    return truth_file
+
+if __name__ == "__main__":
+    output_root = input("Enter output folder (default ./dataset_synthetic): ").strip() or './dataset_synthetic'
+
+    try:
+        meters = int(input("Enter number of meters per dataset (default 100): "))
+    except ValueError:
+        print("Invalid number of meters. Using default value of 100.")
+        meters = 100
+
+    try:
+        readings = int(input("Enter number of readings per meter (default 1000): "))
+    except ValueError:
+        print("Invalid number of readings. Using default value of 1000.")
+        readings = 1000
+
+    dataset_choice = input("Which dataset do you want to generate? (queensland/helios/datamill/all): ").strip().lower()
+    if dataset_choice in ['queensland', 'helios', 'datamill']:
+        datasets = (dataset_choice,)
+    else:
+        datasets = ('datamill', 'queensland', 'helios')
+
+    generate_datasets(output_root, meters, readings, datasets)
@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import resource
+import functools
+import threading
+from collections import Counter
+from datetime import datetime
+
+# Stage metrics are appended as JSON lines to this file; set WATER_METRICS_LOG to an empty string to disable
+METRICS_LOG = os.environ.get('WATER_METRICS_LOG', './logs/stage_metrics.jsonl')
+
+# Opt-in sampling profiler, enabled with WATER_PROFILE=1
+PROFILE = os.environ.get('WATER_PROFILE', '0') == '1'
+PROFILE_INTERVAL = float(os.environ.get('WATER_PROFILE_INTERVAL', '0.005'))
+PROFILE_FOLDER = os.environ.get('WATER_PROFILE_FOLDER', './logs/profiles')
+
+_local = threading.local()
+_active_stages = []
+_lock = threading.Lock()
+
+def configure_instrumentation(metrics_log=None, profile=None, profile_interval=None, profile_folder=None):
+    global METRICS_LOG, PROFILE, PROFILE_INTERVAL, PROFILE_FOLDER
+    if metrics_log is not None:
+        METRICS_LOG = metrics_log
+    if profile is not None:
+        PROFILE = profile
+    if profile_interval is not None:
+        PROFILE_INTERVAL = profile_interval
+    if profile_folder is not None:
+        PROFILE_FOLDER = profile_folder
+
+def read_io_counters():
+    # Bytes passed through read()/write() calls by this process, including page cache hits
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def read_peak_rss_mb():
+    # High water mark of the resident set size since the last reset
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+def reset_peak_rss():
+    # Linux lets a process reset its own high water mark, which gives a peak per stage.
+    # Stages that are still running keep the peak reached so far.
+    with _lock:
+        current_peak = read_peak_rss_mb()
+        for stage in _active_stages:
+            stage.peak_rss_mb = max(stage.peak_rss_mb, current_peak)
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+class SamplingProfiler(threading.Thread):
+    # Samples the stack of one thread at a fixed interval and counts where time is spent
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.self_counts[f"{frame.f_code.co_filename}:{frame.f_lineno} {frame.f_code.co_name}"] += 1
+
+            seen = set()
+            while frame is not None:
+                key = f"{frame.f_code.co_filename} {frame.f_code.co_name}"
+                if key not in seen:
+                    seen.add(key)
+                    self.total_counts[key] += 1
+                frame = frame.f_back
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def report(self, stage, top=25):
+        lines = [f"Sampling profile for {stage}: {self.samples} samples every {self.interval * 1000:.1f} ms", '']
+        for title, counts in (('Hot lines (self time)', self.self_counts), ('Hot functions (including callees)', self.total_counts)):
+            lines.append(title)
+            for key, count in counts.most_common(top):
+                lines.append(f"{100.0 * count / max(self.samples, 1):6.1f}% {count:8d}  {key}")
+            lines.append('')
+        return '\n'.join(lines)
+
+class StageMetrics:
+    # Context manager that measures one run of a pipeline stage and writes it as a JSON line
+    def __init__(self, stage, target=None):
+        self.stage = stage
+        self.target = target
+        self.rows = 0
+        self.peak_rss_mb = 0.0
+        self.profiler = None
+        self.extra = {}
+
+    def add_rows(self, rows):
+        self.rows += int(rows)
+
+    def add_metrics(self, **values):
+        self.extra.update(values)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+
+        reset_peak_rss()
+        with _lock:
+            _active_stages.append(self)
+
+        if PROFILE:
+            self.profiler = SamplingProfiler(threading.get_ident(), PROFILE_INTERVAL)
+            self.profiler.start()
+
+        self.bytes_read_start, self.bytes_written_start = read_io_counters()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall_seconds = time.perf_counter() - self.wall_start
+        cpu_seconds = time.process_time() - self.cpu_start
+        bytes_read, bytes_written = read_io_counters()
+
+        with _lock:
+            self.peak_rss_mb = max(self.peak_rss_mb, read_peak_rss_mb())
+            _active_stages.remove(self)
+        _local.stack.pop()
+
+        record = {
+            'timestamp': datetime.now().isoformat(timespec='milliseconds'),
+            'stage': self.stage,
+            'target': self.target,
+            'pid': os.getpid(),
+            'wall_seconds': round(wall_seconds, 6),
+            'cpu_seconds': round(cpu_seconds, 6),
+            'rows': self.rows,
+            'bytes_read': bytes_read - self.bytes_read_start if bytes_read is not None else None,
+            'bytes_written': bytes_written - self.bytes_written_start if bytes_written is not None else None,
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+            'status': 'ok' if exc_type is None else 'error'
+        }
+        record.update(self.extra)
+        if exc_type is not None:
+            record['error'] = str(exc)
+
+        if self.profiler is not None:
+            self.profiler.stop()
+            record['profile'] = save_profile(self.stage, self.profiler)
+
+        write_record(record)
+        return False
+
+def save_profile(stage, profiler):
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    profile_file = os.path.join(PROFILE_FOLDER, f"{stage}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}.txt")
+    with open(profile_file, 'w') as f:
+        f.write(profiler.report(stage))
+    return profile_file
+
+def write_record(record):
+    if not METRICS_LOG:
+        return
+    with _lock:
+        log_folder = os.path.dirname(METRICS_LOG)
+        if log_folder:
+            os.makedirs(log_folder, exist_ok=True)
+        with open(METRICS_LOG, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+def current_stage():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+def add_rows(rows):
+    # Adds to the row count of the innermost running stage in this thread
+    stage = current_stage()
+    if stage is not None:
+        stage.add_rows(rows)
+
+def add_metrics(**values):
+    # Extra fields for the record of the innermost running stage in this thread
+    stage = current_stage()
+    if stage is not None:
+        stage.add_metrics(**values)
+
+def stage_metrics(stage, target=None):
+    return StageMetrics(stage, target)
+
+def instrument_stage(stage=None):
+    # Decorator that records every call of a stage function; the stage name defaults to script.function
+    def decorator(function):
+        script = os.path.splitext(os.path.basename(function.__code__.co_filename))[0]
+        name = stage or f"{script}.{function.__name__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            target = args[0] if args and isinstance(args[0], str) else None
+            with StageMetrics(name, target):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
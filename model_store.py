@@ -0,0 +1,86 @@
+import os
+import re
+import joblib
+import numpy as np
+from checkpoint import file_fingerprint
+
+MODEL_NAMES = ['IForest', 'KNN', 'LOF', 'AutoEncoder']
+
+# Version 1 is the plain file written by a full training run (e.g. IForest_model.pkl).
+# Incremental updates are saved next to it as IForest_model_v2.pkl, IForest_model_v3.pkl, ...
+VERSION_PATTERN = re.compile(r'^IForest_model(?:_v(\d+))?\.pkl$')
+
+def versioned_file(model_save_path, name, version, extension='pkl'):
+    suffix = '' if version in (None, 1) else f'_v{version}'
+    return os.path.join(model_save_path, f'{name}{suffix}.{extension}')
+
+def model_versions(model_save_path):
+    if not os.path.isdir(model_save_path):
+        return []
+    versions = []
+    for file_name in os.listdir(model_save_path):
+        match = VERSION_PATTERN.match(file_name)
+        if match:
+            versions.append(int(match.group(1)) if match.group(1) else 1)
+    return sorted(versions)
+
+def latest_model_version(model_save_path):
+    versions = model_versions(model_save_path)
+    return versions[-1] if versions else None
+
+def save_model_version(model_save_path, version, models, scaler=None, reference=None, seen=None, preprocessing=None):
+    os.makedirs(model_save_path, exist_ok=True)
+
+    for model_name, model in models.items():
+        model_filename = versioned_file(model_save_path, f'{model_name}_model', version)
+        joblib.dump(model, model_filename)
+        print(f"Saved {model_name} model to {model_filename}")
+
+    if scaler is not None:
+        joblib.dump(scaler, versioned_file(model_save_path, 'scaler', version))
+    if preprocessing is not None:
+        # Feature definition, fill values and scaler of this version, used for scoring (see feature_pipeline.py)
+        joblib.dump(preprocessing, versioned_file(model_save_path, 'preprocessing', version))
+    if reference is not None:
+        # Bounded sample of raw training rows, used to refresh KNN/LOF and the thresholds on update
+        np.savez(versioned_file(model_save_path, 'reference_sample', version, 'npz'), reference=reference, seen=seen)
+
+def model_version_fingerprint(model_save_path, version=None):
+    # Version number plus size and modification time of its model and preprocessing files. A full retrain rewrites
+    # version 1 in place, so the number alone does not identify the models. Empty when no models are saved.
+    version = version or latest_model_version(model_save_path)
+    if version is None:
+        return []
+    fingerprint = [version]
+    for name in [f'{model_name}_model' for model_name in MODEL_NAMES] + ['preprocessing']:
+        model_file = versioned_file(model_save_path, name, version)
+        if os.path.exists(model_file):
+            fingerprint.extend(file_fingerprint(model_file))
+    return fingerprint
+
+def load_preprocessing(model_save_path, version=None):
+    # Preprocessing saved with the given model version, the latest one by default; None for older models
+    version = version or latest_model_version(model_save_path)
+    preprocessing_file = versioned_file(model_save_path, 'preprocessing', version)
+    return joblib.load(preprocessing_file) if version is not None and os.path.exists(preprocessing_file) else None
+
+def load_model_version(model_save_path, version=None):
+    # Returns (models, scaler, reference, seen) of the given version, the latest one by default
+    version = version or latest_model_version(model_save_path)
+    models = {}
+    for model_name in MODEL_NAMES:
+        model_file = versioned_file(model_save_path, f'{model_name}_model', version)
+        if os.path.exists(model_file):
+            models[model_name] = joblib.load(model_file)
+
+    scaler_file = versioned_file(model_save_path, 'scaler', version)
+    scaler = joblib.load(scaler_file) if os.path.exists(scaler_file) else None
+
+    reference_file = versioned_file(model_save_path, 'reference_sample', version, 'npz')
+    if os.path.exists(reference_file):
+        with np.load(reference_file) as data:
+            reference, seen = data['reference'], int(data['seen'])
+    else:
+        reference, seen = None, 0
+
+    return models, scaler, reference, seen
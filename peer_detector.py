@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import warnings
+import numpy as np
+import pandas as pd
+from resample_grid import load_grid, grid_times
+from instrumentation import instrument_stage, add_rows
+
+# Scale factor that makes the MAD of normal data comparable to its standard deviation
+MAD_SCALE = 0.6745
+# Fallback scale when more than half of a cohort shares the median value (MAD of 0)
+MEAN_AD_SCALE = 0.7979
+
+# Grid cells (meters x time bins) held in memory per block
+BLOCK_CELLS = 4000000
+
+def meter_cohorts(grid, cohort_file=None):
+    # Cohort of every meter of the grid. A CSV with 'meter' and 'cohort' columns overrides the default:
+    # Datamill meters are grouped by postcode area (LS, BD, ...), other datasets form one population.
+    meters = grid['meters']
+    if cohort_file:
+        mapping = pd.read_csv(cohort_file, dtype=str).set_index('meter')['cohort']
+        return np.array([mapping.get(meter, 'unassigned') for meter in meters], dtype=object)
+    if grid['dataset_type'] == 'datamill':
+        return np.array([re.match(r'[A-Za-z]*', meter).group(0).upper() or 'unknown' for meter in meters], dtype=object)
+    return np.array(['all'] * len(meters), dtype=object)
+
+def meter_levels(values, mask, chunk_meters=1024):
+    # Median of every meter over its observed bins, used to compare meters of different size
+    levels = np.full(values.shape[0], np.nan)
+    for low in range(0, values.shape[0], chunk_meters):
+        high = min(low + chunk_meters, values.shape[0])
+        block = np.where(mask[low:high], values[low:high], np.nan)
+        with np.errstate(all='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            levels[low:high] = np.nanmedian(block, axis=1) if block.size else np.nan
+    levels[~(levels > 0)] = np.nan
+    return levels
+
+def cohort_statistics(block, quantiles):
+    # Robust statistics per time bin over the meters of one cohort block (meters x bins, NaN for gaps).
+    # Returns count, median, scale and the requested quantiles as arrays over the bins.
+    count = (~np.isnan(block)).sum(axis=0)
+    # Bins where the whole cohort is missing give NaN statistics; their warnings are expected
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(block, axis=0)
+        deviation = np.abs(block - median)
+        scale = np.nanmedian(deviation, axis=0) / MAD_SCALE
+        fallback = ~(scale > 0)
+        if fallback.any():
+            scale[fallback] = np.nanmean(deviation[:, fallback], axis=0) / MEAN_AD_SCALE
+        quantile_values = np.nanquantile(block, quantiles, axis=0) if len(quantiles) else np.empty((0, block.shape[1]))
+    return count, median, scale, quantile_values
+
+@instrument_stage()
+def peer_scores(values, mask, cohorts, threshold=3.5, min_peers=5, normalize=True, quantiles=(0.05, 0.95),
+                scores_out=None, flags_out=None, block_cells=BLOCK_CELLS):
+    # Robust z-score of every meter against its cohort at the same time bin:
+    # (value - cohort median) / (MAD / 0.6745). Points beyond threshold are flagged; bins with fewer than
+    # min_peers observed meters in the cohort are never flagged. Cohorts are processed in blocks of time
+    # bins, so the cost grows linearly with the number of meters and the memory stays bounded.
+    meters, bins = values.shape
+    if scores_out is None:
+        scores_out = np.full((meters, bins), np.nan, dtype=np.float32)
+    if flags_out is None:
+        flags_out = np.zeros((meters, bins), dtype=bool)
+
+    levels = meter_levels(values, mask) if normalize else None
+    statistics = {}
+    for cohort in sorted(set(cohorts)):
+        rows = np.flatnonzero(cohorts == cohort)
+        block_bins = max(1, block_cells // len(rows))
+        stats = np.full((3 + len(quantiles), bins), np.nan)
+
+        for start in range(0, bins, block_bins):
+            stop = min(start + block_bins, bins)
+            block = np.asarray(values[rows, start:stop], dtype=np.float64)
+            observed = np.asarray(mask[rows, start:stop])
+            block[~observed] = np.nan
+            if normalize:
+                block /= levels[rows, None]
+            add_rows(observed.sum())
+
+            count, median, scale, quantile_values = cohort_statistics(block, quantiles)
+            with np.errstate(all='ignore'):
+                scores = (block - median) / scale
+            scores[:, count < min_peers] = np.nan
+
+            scores_out[rows, start:stop] = scores
+            with np.errstate(invalid='ignore'):
+                flags_out[rows, start:stop] = np.abs(scores) > threshold
+
+            stats[0, start:stop] = count
+            stats[1, start:stop] = median
+            stats[2, start:stop] = scale
+            stats[3:, start:stop] = quantile_values
+
+        statistics[cohort] = stats
+    return scores_out, flags_out, statistics
+
+def save_flagged_points(output_file, values, flags, scores, cohorts, grid, chunk_meters=1024):
+    # One CSV row per flagged grid cell, written in blocks of meters
+    times = grid_times(grid)
+    meters = np.array(grid['meters'], dtype=object)
+    header = True
+    for low in range(0, flags.shape[0], chunk_meters):
+        high = min(low + chunk_meters, flags.shape[0])
+        rows, columns = np.nonzero(flags[low:high])
+        pd.DataFrame({
+            'meter': meters[low + rows],
+            'cohort': cohorts[low + rows],
+            'datetime': times[columns],
+            'value': np.asarray(values[low:high])[rows, columns],
+            'peer_score': np.asarray(scores[low:high])[rows, columns]
+        }).to_csv(output_file, index=False, mode='w' if header else 'a', header=header)
+        header = False
+
+@instrument_stage()
+def detect_peer_anomalies(grid_folder, output_folder=None, threshold=3.5, min_peers=5, normalize=True,
+                          cohort_file=None, quantiles=(0.05, 0.95)):
+    # Runs the peer detector on a grid written by resample_grid.py and saves peer_scores.npy,
+    # peer_flags.npy, cohort_statistics.npz, peer_summary.csv (per meter) and peer_anomalies.csv
+    output_folder = output_folder or os.path.join(grid_folder, 'peer')
+    os.makedirs(output_folder, exist_ok=True)
+
+    values, mask, grid = load_grid(grid_folder)
+    cohorts = meter_cohorts(grid, cohort_file)
+    print(f"Comparing {values.shape[0]} meters in {len(set(cohorts))} cohorts over {values.shape[1]} time bins")
+
+    scores_out = np.lib.format.open_memmap(os.path.join(output_folder, 'peer_scores.npy'), mode='w+',
+                                           dtype=np.float32, shape=values.shape)
+    flags_out = np.lib.format.open_memmap(os.path.join(output_folder, 'peer_flags.npy'), mode='w+',
+                                          dtype=bool, shape=values.shape)
+    scores, flags, statistics = peer_scores(values, mask, cohorts, threshold, min_peers, normalize, quantiles,
+                                            scores_out, flags_out)
+    scores.flush()
+    flags.flush()
+
+    # Per cohort rows: observed meters, median, scale, then the quantiles
+    np.savez(os.path.join(output_folder, 'cohort_statistics.npz'), **{str(cohort): stats for cohort, stats in statistics.items()})
+    with open(os.path.join(output_folder, 'peer_settings.json'), 'w') as f:
+        json.dump({'threshold': threshold, 'min_peers': min_peers, 'normalize': normalize,
+                   'quantiles': list(quantiles), 'statistics_rows': ['count', 'median', 'scale'] + [f'q{q:g}' for q in quantiles]}, f, indent=2)
+
+    with np.errstate(all='ignore'):
+        summary = pd.DataFrame({
+            'meter': grid['meters'],
+            'cohort': cohorts,
+            'observed_bins': np.asarray(mask).sum(axis=1),
+            'flagged_bins': np.asarray(flags).sum(axis=1),
+            'max_abs_peer_score': np.nanmax(np.abs(scores), axis=1, initial=0)
+        }).sort_values('flagged_bins', ascending=False)
+    summary_file = os.path.join(output_folder, 'peer_summary.csv')
+    summary.to_csv(summary_file, index=False)
+    save_flagged_points(os.path.join(output_folder, 'peer_anomalies.csv'), values, flags, scores, cohorts, grid)
+
+    print(f"Flagged {int(summary['flagged_bins'].sum())} points on {int((summary['flagged_bins'] > 0).sum())} meters")
+    print(summary.head(10).to_string(index=False))
+    print(f"Peer detection results saved to {output_folder}")
+    return summary
+
+if __name__ == "__main__":
+    dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
+    while dataset_type not in ['helios', 'queensland', 'datamill']:
+        dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
+
+    option = input("Enter option (daily/total): ").lower()
+    while option not in ['daily', 'total']:
+        option = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+
+    try:
+        threshold = float(input("Enter peer score threshold (default 3.5): "))
+    except ValueError:
+        print("Invalid threshold. Using default value of 3.5.")
+        threshold = 3.5
+
+    try:
+        min_peers = int(input("Enter minimum number of observed peers per time bin (default 5): "))
+    except ValueError:
+        print("Invalid number of peers. Using default value of 5.")
+        min_peers = 5
+
+    cohort_file = input("Enter a meter to cohort CSV (meter,cohort), or leave empty for the default cohorts: ").strip() or None
+
+    grid_folder = f'./dataset/{dataset_type}/grid_{option}'
+    if not os.path.exists(os.path.join(grid_folder, 'grid.json')):
+        print(f"No grid found in {grid_folder}. Run resample_grid.py or pipeline.py first.")
+    else:
+        detect_peer_anomalies(grid_folder, threshold=threshold, min_peers=min_peers, cohort_file=cohort_file)
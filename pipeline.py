@@ -0,0 +1,195 @@
+import os
+import json
+import shutil
+from datetime import datetime
+
+from split_datasets import preprocess_queensland, split_queensland, process_helios_dataset, process_datamill_dataset
+from sort_time import sort_and_save_datamill, sort_and_save_queensland, sort_and_save_helios
+from replace_semicolon import replace_semicolons
+from resample_grid import resample_folder
+from checkpoint import file_fingerprint, TEMP_SUFFIX
+
+MANIFEST_FILE = '.pipeline_manifest.json'
+
+# Pipeline stages for each dataset. Folders are relative to the dataset root.
+# 'per_file' stages write one output per input file and only reprocess new or changed files.
+# 'aggregate' stages spread every input file over many outputs: new input files are appended,
+# while a changed or removed input file rebuilds the stage outputs from all inputs.
+# 'full' stages combine all inputs into one output and are rebuilt whenever any input changes.
+PIPELINES = {
+    'datamill': [
+        {'name': 'split', 'mode': 'aggregate', 'input': 'org_dataset', 'outputs': ['user_dataset'],
+         'function': process_datamill_dataset, 'kwargs': {'append': True}},
+        {'name': 'sort', 'mode': 'per_file', 'input': 'user_dataset', 'outputs': ['user_datamill_sorted'],
+         'function': sort_and_save_datamill},
+        {'name': 'resample', 'mode': 'full', 'input': 'user_datamill_sorted', 'outputs': ['grid_daily'],
+         'function': resample_folder, 'kwargs': {'dataset_type': 'datamill', 'option': 'daily'}}
+    ],
+    'queensland': [
+        {'name': 'preprocess', 'mode': 'per_file', 'input': 'org_dataset', 'outputs': ['dataset_correct'],
+         'function': preprocess_queensland, 'output_prefix': 'processed_'},
+        {'name': 'split', 'mode': 'aggregate', 'input': 'dataset_correct', 'outputs': ['pulse', 'pulsetotal'],
+         'function': split_queensland},
+        {'name': 'sort_pulse', 'mode': 'per_file', 'input': 'pulse', 'outputs': ['user_sorted_pulse'],
+         'function': sort_and_save_queensland},
+        {'name': 'sort_pulsetotal', 'mode': 'per_file', 'input': 'pulsetotal', 'outputs': ['user_sorted_pulsetot'],
+         'function': sort_and_save_queensland},
+        {'name': 'resample', 'mode': 'full', 'input': 'user_sorted_pulse', 'outputs': ['grid_daily'],
+         'function': resample_folder, 'kwargs': {'dataset_type': 'queensland', 'option': 'daily'}}
+    ],
+    'helios': [
+        {'name': 'split', 'mode': 'aggregate', 'input': 'org_dataset', 'outputs': ['user_dataset'],
+         'function': process_helios_dataset, 'kwargs': {'append': True}},
+        {'name': 'sort', 'mode': 'per_file', 'input': 'user_dataset', 'outputs': ['user_helios_sorted_semicol'],
+         'function': sort_and_save_helios},
+        {'name': 'replace_semicolon', 'mode': 'per_file', 'input': 'user_helios_sorted_semicol', 'outputs': ['user_helios_sorted'],
+         'function': replace_semicolons},
+        {'name': 'resample', 'mode': 'full', 'input': 'user_helios_sorted', 'outputs': ['grid_daily'],
+         'function': resample_folder, 'kwargs': {'dataset_type': 'helios', 'option': 'daily'}}
+    ]
+}
+
+def folder_fingerprints(folder):
+    if not os.path.isdir(folder):
+        return {}
+    return {file_name: file_fingerprint(os.path.join(folder, file_name))
+            for file_name in sorted(os.listdir(folder)) if file_name.endswith(('.csv', '.zip'))}
+
+def load_manifest(dataset_root):
+    manifest_path = os.path.join(dataset_root, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_manifest(dataset_root, manifest):
+    # Write to a temporary file first so an interrupted run never leaves a broken manifest
+    manifest_path = os.path.join(dataset_root, MANIFEST_FILE)
+    temp_path = manifest_path + TEMP_SUFFIX
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+def order_stages(stages):
+    # Topological order: a stage runs after every stage that writes its input folder
+    producers = {output: stage['name'] for stage in stages for output in stage['outputs']}
+    dependencies = {stage['name']: {producers[stage['input']]} if stage['input'] in producers else set()
+                    for stage in stages}
+    by_name = {stage['name']: stage for stage in stages}
+
+    ordered = []
+    done = set()
+    while len(ordered) < len(stages):
+        ready = [name for name in dependencies if name not in done and dependencies[name] <= done]
+        if not ready:
+            raise ValueError("Pipeline stages contain a dependency cycle")
+        for name in ready:
+            ordered.append(by_name[name])
+            done.add(name)
+    return ordered
+
+def outputs_changed(dataset_root, stage, stage_manifest):
+    # Outputs edited or removed outside the pipeline invalidate the recorded state
+    recorded = stage_manifest.get('outputs', {})
+    current = {}
+    for output in stage['outputs']:
+        current.update({f'{output}/{name}': fp for name, fp in folder_fingerprints(os.path.join(dataset_root, output)).items()})
+    return recorded != current
+
+def plan_stage(dataset_root, stage, stage_manifest, force=False):
+    # Returns (action, file names) where action is 'skip', 'update' or 'rebuild'
+    inputs = folder_fingerprints(os.path.join(dataset_root, stage['input']))
+    recorded = stage_manifest.get('inputs', {})
+
+    new_files = [name for name in inputs if name not in recorded]
+    changed_files = [name for name in inputs if name in recorded and inputs[name] != recorded[name]]
+    removed_files = [name for name in recorded if name not in inputs]
+
+    if force or not stage_manifest:
+        return 'rebuild', list(inputs)
+
+    if stage['mode'] == 'full':
+        missing_outputs = any(not os.path.isdir(os.path.join(dataset_root, output)) for output in stage['outputs'])
+        if new_files or changed_files or removed_files or missing_outputs:
+            return 'rebuild', list(inputs)
+        return 'skip', []
+
+    if stage['mode'] == 'aggregate':
+        if changed_files or removed_files or outputs_changed(dataset_root, stage, stage_manifest):
+            return 'rebuild', list(inputs)
+        return ('update', new_files) if new_files else ('skip', [])
+
+    # Per-file stages also redo inputs whose output went missing or was modified
+    prefix = stage.get('output_prefix', '')
+    output_folder = os.path.join(dataset_root, stage['outputs'][0])
+    recorded_outputs = stage_manifest.get('outputs', {})
+    stale_files = [name for name in inputs if name not in new_files and name not in changed_files and
+                   (not os.path.exists(os.path.join(output_folder, prefix + name)) or
+                    file_fingerprint(os.path.join(output_folder, prefix + name)) != recorded_outputs.get(f"{stage['outputs'][0]}/{prefix + name}"))]
+
+    for name in removed_files:
+        output_path = os.path.join(output_folder, prefix + name)
+        if os.path.exists(output_path):
+            os.remove(output_path)
+            print(f"Removed output of deleted input: {output_path}")
+
+    files = sorted(new_files + changed_files + stale_files)
+    if files:
+        return 'update', files
+    return ('update', []) if removed_files else ('skip', [])
+
+def run_stage(dataset_root, stage, manifest, force=False):
+    stage_manifest = manifest.get(stage['name'], {})
+    action, files = plan_stage(dataset_root, stage, stage_manifest, force)
+    input_folder = os.path.join(dataset_root, stage['input'])
+    output_folders = [os.path.join(dataset_root, output) for output in stage['outputs']]
+
+    if action == 'skip':
+        print(f"Stage {stage['name']}: up to date")
+        return False
+
+    if action == 'rebuild':
+        print(f"Stage {stage['name']}: rebuilding from {len(files)} input files")
+        for output_folder in output_folders:
+            shutil.rmtree(output_folder, ignore_errors=True)
+    else:
+        print(f"Stage {stage['name']}: processing {len(files)} new or changed input files")
+
+    if files:
+        stage['function'](input_folder, *output_folders, file_names=files, **stage.get('kwargs', {}))
+
+    # Record the state the outputs were built from
+    outputs = {}
+    for output in stage['outputs']:
+        outputs.update({f'{output}/{name}': fp for name, fp in folder_fingerprints(os.path.join(dataset_root, output)).items()})
+    manifest[stage['name']] = {
+        'inputs': folder_fingerprints(input_folder),
+        'outputs': outputs,
+        'completed': datetime.now().isoformat(timespec='seconds')
+    }
+    save_manifest(dataset_root, manifest)
+    return True
+
+def run_pipeline(dataset_root, dataset_type, force=False):
+    manifest = load_manifest(dataset_root)
+
+    for stage in order_stages(PIPELINES[dataset_type]):
+        if not os.path.isdir(os.path.join(dataset_root, stage['input'])):
+            print(f"Stage {stage['name']}: input folder {stage['input']} not found, stopping")
+            return False
+        run_stage(dataset_root, stage, manifest, force)
+
+    print(f"{dataset_type} pipeline complete.")
+    return True
+
+if __name__ == "__main__":
+    dataset_choice = input("Which dataset do you want to process? (queensland/helios/datamill/all): ").strip().lower()
+    force = input("Rebuild every stage from scratch? (yes/no, default no): ").strip().lower() in ['y', 'yes']
+
+    if dataset_choice == 'all':
+        for dataset_type in PIPELINES:
+            run_pipeline(f'./dataset/{dataset_type}', dataset_type, force)
+    elif dataset_choice in PIPELINES:
+        run_pipeline(f'./dataset/{dataset_choice}', dataset_choice, force)
+    else:
+        print("Invalid choice. Please choose 'queensland', 'helios', 'datamill' or 'all'.")
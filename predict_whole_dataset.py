@@ -1,18 +1,28 @@
 import os
+import time
+import functools
 import pandas as pd
 import numpy as np
-from pyod.models.iforest import IForest
-from pyod.models.knn import KNN
-from pyod.models.lof import LOF
-from pyod.models.auto_encoder import AutoEncoder
-from sklearn.preprocessing import StandardScaler
-import matplotlib.pyplot as plt
 import joblib
+from instrumentation import instrument_stage, add_rows
+from date_parsing import parse_datetimes
+from model_store import versioned_file, latest_model_version, load_preprocessing
+from feature_pipeline import score_chunks, transform_chunks, z_score_settings
+from feature_engine import max_z_score
+from prefetch import prefetch_files
+from detector_scoring import score_model
+from results_store import open_results_store, start_run, store_results
+from detector_routing import plan_detectors, planned_models, record_cost, report_plan
+
+def load_models(models_path, version=None):
+    # Use the newest saved model version unless a specific one is requested
+    version = version or latest_model_version(models_path)
+    if version is not None:
+        print(f"Loading model version {version}")
 
-def load_models(models_path):
     models = {}
     for model_name in ['IForest_model', 'KNN_model', 'LOF_model', 'AutoEncoder_model']:
-        model_file = os.path.join(models_path, f'{model_name}.pkl')
+        model_file = versioned_file(models_path, model_name, version)
         if os.path.exists(model_file):
             try:
                 models[model_name] = joblib.load(model_file)
@@ -23,59 +33,107 @@ def load_models(models_path):
             print(f"Model file {model_file} does not exist.")
     return models
 
-def process_file(file_path, contamination, models, dataset_type, value_type, value_column):
-    print(f"Processing file: {file_path}")
-    try:
-        # Read the CSV file
-        df = pd.read_csv(file_path)
-        df['datetime'] = pd.to_datetime(df['datetime'], format='%d/%m/%Y %H:%M:%S')
-        df = df.sort_values('datetime')
+def prepare_features(file_path, dataset_type, value_column):
+    from sklearn.preprocessing import StandardScaler
+
+    # Read the CSV file
+    df = pd.read_csv(file_path)
+    add_rows(len(df))
+    df['datetime'] = parse_datetimes(df['datetime'], format='%d/%m/%Y %H:%M:%S')
+    df = df.sort_values('datetime')
 
-        print(f"DataFrame shape: {df.shape}")
-        print(f"Columns: {df.columns}")
+    print(f"DataFrame shape: {df.shape}")
+    print(f"Columns: {df.columns}")
 
-        # Extract hour and day of week
-        df['hour'] = df['datetime'].dt.hour
-        df['day_of_week'] = df['datetime'].dt.dayofweek
+    # Extract hour and day of week
+    df['hour'] = df['datetime'].dt.hour
+    df['day_of_week'] = df['datetime'].dt.dayofweek
 
-        # Calculate rolling statistics
-        window_size = 24 if dataset_type == 'helios' else 7
-        df['diff'] = df[value_column].diff()
-        df['rolling_mean'] = df[value_column].rolling(window=window_size).mean()
-        df['rolling_std'] = df[value_column].rolling(window=window_size).std()
+    # Calculate rolling statistics
+    window_size = 24 if dataset_type == 'helios' else 7
+    df['diff'] = df[value_column].diff()
+    df['rolling_mean'] = df[value_column].rolling(window=window_size).mean()
+    df['rolling_std'] = df[value_column].rolling(window=window_size).std()
 
-        # Calculate Z-scores
-        df['z_score'] = (df[value_column] - df['rolling_mean']) / df['rolling_std']
+    # Calculate Z-scores
+    df['z_score'] = (df[value_column] - df['rolling_mean']) / df['rolling_std']
 
-        # Prepare features for anomaly detection
-        features = ['hour', 'day_of_week', 'rolling_mean', 'rolling_std']
+    # Prepare features for anomaly detection
+    features = ['hour', 'day_of_week', 'rolling_mean', 'rolling_std']
 
-        # Handle NaN values
-        df[features] = df[features].fillna(df[features].mean())
+    # Handle NaN values
+    df[features] = df[features].fillna(df[features].mean())
 
-        X = df[features].values
+    X = df[features].values
 
-        # Standardize the features
-        scaler = StandardScaler()
-        X_scaled = scaler.fit_transform(X)
+    # Standardize the features
+    scaler = StandardScaler()
+    X_scaled = scaler.fit_transform(X)
 
+    return df, X_scaled
+
+def load_file(file_path, dataset_type, value_column, preprocessing=None):
+    # Reading and feature building of one file, run ahead of the scoring by the prefetching reader.
+    # Returns None when the file cannot be read, so the loop skips it.
+    try:
+        if preprocessing is not None:
+            return list(transform_chunks(preprocessing, file_path, value_column))
+        return prepare_features(file_path, dataset_type, value_column)
+    except Exception as e:
+        print(f"Error reading file {file_path}: {str(e)}")
+        return None
+
+def score_with_preprocessing(file_path, models, preprocessing, value_column, z_score_threshold, transformed=None,
+                             timings=None):
+    # Features are built with the saved training preprocessing and scored block by block
+    df = pd.concat(score_chunks(preprocessing, models, file_path, value_column, z_score_threshold=z_score_threshold,
+                                transformed=transformed, timings=timings), ignore_index=True)
+    add_rows(len(df))
+    return df
+
+@instrument_stage()
+def process_file(file_path, contamination, models, dataset_type, value_type, value_column, preprocessing=None, prepared=None,
+                 timings=None):
+    # Seconds spent scoring with each model are added to timings when a dict is passed
+    print(f"Processing file: {file_path}")
+    try:
         # Initialize results dictionary
         results = {}
+        z_score_threshold = 3 if dataset_type == 'helios' else 1
 
-        # Anomaly Detection Models
-        for model_name, model in models.items():
-            try:
-                outlier_scores = model.decision_function(X_scaled)
-                df[f'{model_name}_anomaly_score'] = outlier_scores
-                df[f'{model_name}_is_anomaly'] = model.predict(X_scaled)
-                z_score_threshold = 3 if dataset_type == 'helios' else 1
-                df[f'{model_name}_is_validated_anomaly'] = (df[f'{model_name}_is_anomaly'] == 1) & (abs(df['z_score']) > z_score_threshold)
+        if preprocessing is not None:
+            z_window = z_score_settings(preprocessing)[0]
+            if z_score_threshold >= max_z_score(z_window):
+                print(f"Z-score threshold {z_score_threshold} is out of reach with a {z_window} row window "
+                      f"(at most {max_z_score(z_window):.2f}), no anomaly can be validated")
+            df = score_with_preprocessing(file_path, models, preprocessing, value_column, z_score_threshold, prepared, timings)
+            for model_name in models:
                 results[model_name] = df[f'{model_name}_is_validated_anomaly'].sum()
-            except Exception as e:
-                print(f"Error applying {model_name} model: {str(e)}")
+        else:
+            # Models saved without preprocessing: features are scaled per file
+            if prepared is not None:
+                df, X_scaled = prepared
+                add_rows(len(df))
+            else:
+                df, X_scaled = prepare_features(file_path, dataset_type, value_column)
+
+            # Anomaly Detection Models
+            for model_name, model in models.items():
+                start = time.perf_counter()
+                try:
+                    # Scores, labels and validated flags from one scoring pass
+                    scores, labels, validated = score_model(model, X_scaled, df['z_score'].to_numpy(), z_score_threshold)
+                    df[f'{model_name}_anomaly_score'] = scores
+                    df[f'{model_name}_is_anomaly'] = labels
+                    df[f'{model_name}_is_validated_anomaly'] = validated
+                    results[model_name] = df[f'{model_name}_is_validated_anomaly'].sum()
+                except Exception as e:
+                    print(f"Error applying {model_name} model: {str(e)}")
+                if timings is not None:
+                    timings[model_name] = time.perf_counter() - start
 
-        # Create a new column for points that are anomalies according to all methods
-        df['all_methods_anomaly'] = df[[f'{model_name}_is_validated_anomaly' for model_name in models]].all(axis=1)
+        # Create a new column for points that are anomalies according to all methods; none without models
+        df['all_methods_anomaly'] = df[[f'{model_name}_is_validated_anomaly' for model_name in models]].all(axis=1) if models else False
         results['all_methods'] = df['all_methods_anomaly'].sum()
 
         return df, results
@@ -85,6 +143,8 @@ def process_file(file_path, contamination, models, dataset_type, value_type, val
     
     
 def plot_results(df, user_key, dataset_type, value_type, value_column, results):
+    import matplotlib.pyplot as plt
+
     try:
         plt.figure(figsize=(12, 6))
         x = df['datetime']
@@ -106,7 +166,8 @@ def plot_results(df, user_key, dataset_type, value_type, value_column, results):
     except Exception as e:
         print(f"Error plotting results: {str(e)}")
 
-def main(folder_path, model_save_path, dataset_type, value_type, value_column, contamination=0.01):
+@instrument_stage()
+def main(folder_path, model_save_path, dataset_type, value_type, value_column, contamination=0.01, budget=None):
     print(f"Starting main function with folder_path: {folder_path} and model_save_path: {model_save_path}")
 
     # Load pre-trained models
@@ -117,61 +178,92 @@ def main(folder_path, model_save_path, dataset_type, value_type, value_column, c
         print("No models loaded. Exiting.")
         return
 
+    preprocessing = load_preprocessing(model_save_path)
+    if preprocessing is None:
+        print("No preprocessing saved with these models, features are scaled per file. Retrain to save it.")
+
+    # Every run is kept in the results store for later meter and time queries
+    store = open_results_store()
+    run_id = start_run(store, 'predict', dataset_type, value_type, {'contamination': contamination, 'models_path': model_save_path,
+                                                                    'value_column': value_column}) if store else None
+
     try:
         file_list = os.listdir(folder_path)
         print(f"Files in directory: {file_list}")
         
-        for filename in file_list:
-            if filename.endswith('.csv'):
-                file_path = os.path.join(folder_path, filename)
+        # Detectors per meter from their estimated cost (within budget seconds if one is set), longest meters first
+        file_paths = [os.path.join(folder_path, filename) for filename in file_list if filename.endswith('.csv')]
+        features = len(preprocessing['features']) if preprocessing is not None else 4
+        plan = plan_detectors(file_paths, models, 'score', features, budget)
 
-                df, results = process_file(file_path, contamination, models, dataset_type, value_type, value_column)
+        # The next files are read while the current one is scored
+        load = functools.partial(load_file, dataset_type=dataset_type, value_column=value_column, preprocessing=preprocessing)
+        for file_path, prepared in prefetch_files(plan['order'], load):
+            filename = os.path.basename(file_path)
+            meter_models = planned_models(plan, file_path, models)
+            if not meter_models:
+                print(f"Skipping file {filename}: no detector planned")
+                continue
+            timings = {}
+            df, results = process_file(file_path, contamination, meter_models, dataset_type, value_type, value_column,
+                                       preprocessing, prepared, timings) if prepared is not None else (None, None)
+            record_cost(plan, file_path, timings)
 
-                if df is not None and results is not None:
-                    user_key = df['user key'].iloc[0] if dataset_type == 'helios' else filename.split('.')[0]
+            if df is not None and results is not None:
+                add_rows(len(df))
+                user_key = df['user key'].iloc[0] if 'user key' in df else filename.split('.')[0]
 
-                    print(f"Processing data for file: {filename}")
-                    print(f"Total data points: {len(df)}")
-                    for model_name, count in results.items():
-                        print(f"{model_name} validated anomalies: {count}")
+                print(f"Processing data for file: {filename}")
+                print(f"Total data points: {len(df)}")
+                for model_name, count in results.items():
+                    print(f"{model_name} validated anomalies: {count}")
+                store_results(store, run_id, dataset_type, filename[:-len('.csv')], df, meter_models, value_column)
 
-                    # Plot the results
-                    plot_results(df, user_key, dataset_type, value_type, value_column, results)
-                else:
-                    print(f"Skipping file {filename} due to processing error")
+                # Plot the results
+                plot_results(df, user_key, dataset_type, value_type, value_column, results)
+            else:
+                print(f"Skipping file {filename} due to processing error")
+        report_plan(plan)
     except Exception as e:
         print(f"Error in main function: {str(e)}")
 
-# Get user input for dataset type and value type
-dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
-while dataset_type not in ['helios', 'queensland', 'datamill']:
-    dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
-
-value_type = input("Enter data type (daily/total): ").lower()
-while value_type not in ['daily', 'total']:
-    value_type = input("Invalid input. Please enter 'daily' or 'total': ").lower()
-
-# Set the folder path, model save path, and value column based on the dataset type and value type
-if dataset_type == 'helios':
-    folder_path = './dataset/helios/user_helios_sorted'
-    model_save_path = f'./models/helios/{value_type}'
-    value_column = 'diff' if value_type == 'daily' else 'meter reading'
-elif dataset_type == 'queensland':
-    folder_path = f'./dataset/queensland/user_sorted_pulse{"tot" if value_type == "total" else ""}'
-    model_save_path = f'./models/queensland/{value_type}'
-    value_column = 'Pulse1' if value_type == 'daily' else 'Pulse1_Total'
-else:  # datamill
-    folder_path = './dataset/datamill/user_datamill_sorted'
-    model_save_path = f'./models/datamill/{value_type}'
-    value_column = 'DAILY_AVERAGE_CONSUMPTION' if value_type == 'daily' else 'GROSS_CONSUMPTION'
-
-print(f"Selected dataset type: {dataset_type}")
-print(f"Selected value type: {value_type}")
-print(f"Value column: {value_column}")
-print(f"Folder path: {folder_path}")
-print(f"Model save path: {model_save_path}")
-
-try:
-    main(folder_path, model_save_path, dataset_type, value_type, value_column, contamination=0.01)
-except Exception as e:
-    print(f"An error occurred: {str(e)}")
\ No newline at end of file
+if __name__ == "__main__":
+    # Get user input for dataset type and value type
+    dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
+    while dataset_type not in ['helios', 'queensland', 'datamill']:
+        dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
+
+    value_type = input("Enter data type (daily/total): ").lower()
+    while value_type not in ['daily', 'total']:
+        value_type = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+
+    # Set the folder path, model save path, and value column based on the dataset type and value type
+    if dataset_type == 'helios':
+        folder_path = './dataset/helios/user_helios_sorted'
+        model_save_path = f'./models/helios/{value_type}'
+        value_column = 'diff' if value_type == 'daily' else 'meter reading'
+    elif dataset_type == 'queensland':
+        folder_path = f'./dataset/queensland/user_sorted_pulse{"tot" if value_type == "total" else ""}'
+        model_save_path = f'./models/queensland/{value_type}'
+        value_column = 'Pulse1' if value_type == 'daily' else 'Pulse1_Total'
+    else:  # datamill
+        folder_path = './dataset/datamill/user_datamill_sorted'
+        model_save_path = f'./models/datamill/{value_type}'
+        value_column = 'DAILY_AVERAGE_CONSUMPTION' if value_type == 'daily' else 'GROSS_CONSUMPTION'
+
+    print(f"Selected dataset type: {dataset_type}")
+    print(f"Selected value type: {value_type}")
+    print(f"Value column: {value_column}")
+    print(f"Folder path: {folder_path}")
+    print(f"Model save path: {model_save_path}")
+
+    try:
+        budget = float(input("Enter detector time budget in seconds (default WATER_DETECTOR_BUDGET, 0 runs every detector): "))
+    except ValueError:
+        print("Invalid detector budget. Using the default budget.")
+        budget = None
+
+    try:
+        main(folder_path, model_save_path, dataset_type, value_type, value_column, contamination=0.01, budget=budget)
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
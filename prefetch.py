@@ -0,0 +1,56 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import add_metrics
+
+# Number of files loaded ahead of the one being processed. Loaded files wait in memory until their turn, so this
+# also bounds the extra memory. Set WATER_PREFETCH_FILES=0 to load every file in the loop, one after the other.
+PREFETCH_FILES = int(os.environ.get('WATER_PREFETCH_FILES', '2'))
+
+def prefetch_files(file_paths, load, depth=None, stats=None):
+    # Yields (file_path, load(file_path)) in order while background threads load the next files, so reading and
+    # parsing overlap with the computation on the current file. A failed load raises when its file's turn comes.
+    # Time spent waiting for a file and time spent by the caller between files are printed at the end and added
+    # to the record of the running stage; pass a dict as stats to get them back.
+    depth = PREFETCH_FILES if depth is None else depth
+    file_paths = list(file_paths)
+    stats = {} if stats is None else stats
+    stats.update({'files': 0, 'prefetch_depth': depth, 'io_wait_seconds': 0.0, 'compute_seconds': 0.0})
+
+    pool = ThreadPoolExecutor(max_workers=depth, thread_name_prefix='prefetch') if depth > 0 else None
+    pending = deque()
+    next_file = 0
+    try:
+        while next_file < len(file_paths) or pending:
+            # Keep at most depth files loading or loaded ahead of the current one
+            while pool is not None and next_file < len(file_paths) and len(pending) < depth:
+                pending.append((file_paths[next_file], pool.submit(load, file_paths[next_file])))
+                next_file += 1
+
+            start = time.perf_counter()
+            if pool is not None:
+                file_path, future = pending.popleft()
+                data = future.result()
+            else:
+                file_path = file_paths[next_file]
+                next_file += 1
+                data = load(file_path)
+            stats['io_wait_seconds'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            yield file_path, data
+            stats['compute_seconds'] += time.perf_counter() - start
+            stats['files'] += 1
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        report_prefetch(stats)
+
+def report_prefetch(stats):
+    total = stats['io_wait_seconds'] + stats['compute_seconds']
+    if not stats['files']:
+        return
+    print(f"Prefetch ({stats['prefetch_depth']} files ahead): {stats['files']} files, waited {stats['io_wait_seconds']:.2f}s "
+          f"for reading, computed {stats['compute_seconds']:.2f}s ({100 * stats['io_wait_seconds'] / max(total, 1e-9):.0f}% waiting)")
+    add_metrics(**{key: round(value, 6) if isinstance(value, float) else value for key, value in stats.items()})
@@ -1,12 +1,20 @@
 import os
 import pandas as pd
 import shutil
-def replace_semicolons(input_folder, output_folder):
+from instrumentation import instrument_stage, add_rows
+from time_index import build_time_index
+from data_quality import copy_quality
+
+@instrument_stage()
+def replace_semicolons(input_folder, output_folder, file_names=None):
     # Create output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
 
-    # Iterate over all files in the input folder
-    for filename in os.listdir(input_folder):
+    # Iterate over all files in the input folder, or only the given ones
+    if file_names is None:
+        file_names = os.listdir(input_folder)
+
+    for filename in file_names:
         if filename.endswith('.csv'):
             # Construct full file path
             input_file_path = os.path.join(input_folder, filename)
@@ -14,19 +22,28 @@ def replace_semicolons(input_folder, output_folder):
 
             # Read the CSV file with semicolons as delimiter
             df = pd.read_csv(input_file_path, delimiter=';')
+            add_rows(len(df))
 
             # Save the DataFrame to a new CSV file with commas as delimiter
             df.to_csv(output_file_path, index=False, sep=',')
+            # The byte offsets change with the delimiter, so the time index is rebuilt for the new file
+            build_time_index(output_file_path, 'helios')
+            # Same rows in the same order, so the quality flags of the sort stage still apply
+            copy_quality(input_file_path, output_file_path)
 
             print(f"Processed file: {filename}")
 
-# Example usage
-input_folder = './dataset/helios/user_helios_sorted_semicol'
-output_folder = './dataset/helios/user_helios_sorted'
+if __name__ == "__main__":
+    # Example usage
+    input_folder = './dataset/helios/user_helios_sorted_semicol'
+    output_folder = './dataset/helios/user_helios_sorted'
+
+    replace_semicolons(input_folder, output_folder)
 
-replace_semicolons(input_folder, output_folder)
-try:
-        shutil.rmtree('./dataset/helios/user_helios_sorted_semicol')
-        print("Helios files removed successfully.")
-except:
-        print("Helios files couldn't be removed")
\ No newline at end of file
+    remove_inputs = input("Remove the semicolon-delimited files afterwards? (yes/no, default no): ").strip().lower() in ['y', 'yes']
+    if remove_inputs:
+        try:
+                shutil.rmtree('./dataset/helios/user_helios_sorted_semicol')
+                print("Helios files removed successfully.")
+        except:
+                print("Helios files couldn't be removed")
@@ -0,0 +1,271 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from feature_engine import CHUNK_ROWS, DATETIME_COLUMNS, load_series
+from instrumentation import instrument_stage, add_rows
+from date_parsing import parse_datetimes
+from checkpoint import TEMP_SUFFIX
+
+# Grid step, longest reading interval that is still trusted, and the value column of each option.
+# 'interval' values are consumption since the previous reading, 'level' values are cumulative counters
+# and 'period' values are consumption over a billing period from READING_START_DATE to READING_END_DATE.
+RESAMPLE_SETTINGS = {
+    'helios': {'step': '1h', 'max_gap': '6h',
+               'columns': {'daily': ('diff', 'interval'), 'total': ('meter reading', 'level')}},
+    'queensland': {'step': '1h', 'max_gap': '6h',
+                   'columns': {'daily': ('Pulse1', 'interval'), 'total': ('Pulse1_Total', 'level')}},
+    'datamill': {'step': '1D', 'max_gap': None,
+                 'columns': {'daily': ('DAILY_AVERAGE_CONSUMPTION', 'period_rate'), 'total': ('GROSS_CONSUMPTION', 'period')}}
+}
+
+DATAMILL_END_COLUMN = 'READING_END_DATE'
+
+def parse_times(column, time_format):
+    return parse_datetimes(column, format=time_format).to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+def time_bounds(file_path, dataset_type, chunk_rows=CHUNK_ROWS):
+    # First and last timestamp of a file, reading only the time columns
+    time_column, time_format = DATETIME_COLUMNS[dataset_type]
+    columns = [time_column, DATAMILL_END_COLUMN] if dataset_type == 'datamill' else [time_column]
+    first, last = None, None
+    for chunk in pd.read_csv(file_path, usecols=columns, chunksize=chunk_rows):
+        for column in columns:
+            times = parse_times(chunk[column], time_format)
+            if len(times):
+                first = times.min() if first is None else min(first, times.min())
+                last = times.max() if last is None else max(last, times.max())
+    return first, last
+
+def load_periods(file_path, value_column, chunk_rows=CHUNK_ROWS):
+    # Billing periods of a Datamill file as (starts, ends, values)
+    time_column, time_format = DATETIME_COLUMNS['datamill']
+    starts, ends, values = [], [], []
+    for chunk in pd.read_csv(file_path, usecols=[time_column, DATAMILL_END_COLUMN, value_column], chunksize=chunk_rows):
+        starts.append(parse_times(chunk[time_column], time_format))
+        ends.append(parse_times(chunk[DATAMILL_END_COLUMN], time_format))
+        values.append(chunk[value_column].to_numpy(dtype=np.float64))
+    if not starts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    return np.concatenate(starts), np.concatenate(ends), np.concatenate(values)
+
+def cumulative_at(edges, starts, ends, amounts):
+    # Total amount up to each edge when every amount is spread evenly over its interval [start, end).
+    # The running total is piecewise linear, its slope changes by +rate at a start and -rate at an end.
+    rate = amounts / (ends - starts)
+    events = np.concatenate([starts, ends])
+    slope_change = np.concatenate([rate, -rate])
+    order = np.argsort(events, kind='stable')
+    events = events[order]
+    slope = np.cumsum(slope_change[order])
+
+    total = np.zeros(len(events))
+    np.cumsum(slope[:-1] * np.diff(events), out=total[1:])
+    return np.interp(edges, events, total)
+
+def resample_intervals(edges, starts, ends, amounts, min_coverage=1.0):
+    # Amount per bin and the mask of bins whose time span is covered by the intervals
+    keep = (ends > starts) & ~np.isnan(amounts)
+    starts, ends, amounts = starts[keep], ends[keep], amounts[keep]
+    if not len(starts):
+        return np.full(len(edges) - 1, np.nan), np.zeros(len(edges) - 1, dtype=bool)
+
+    values = np.diff(cumulative_at(edges, starts, ends, amounts))
+    covered = np.diff(cumulative_at(edges, starts, ends, ends - starts)) / np.diff(edges)
+    mask = covered >= min_coverage - 1e-9
+    values[~mask] = np.nan
+    return values, mask
+
+def resample_levels(edges, times, levels, max_gap=None):
+    # Counter value at the end of each bin, interpolated between the readings around it
+    keep = ~np.isnan(levels)
+    times, levels = times[keep], levels[keep]
+    bin_ends = edges[1:]
+    if not len(times):
+        return np.full(len(bin_ends), np.nan), np.zeros(len(bin_ends), dtype=bool)
+
+    mask = (bin_ends >= times[0]) & (bin_ends <= times[-1])
+    if max_gap is not None and len(times) > 1:
+        after = np.clip(np.searchsorted(times, bin_ends), 1, len(times) - 1)
+        mask &= (times[after] - times[after - 1]) <= max_gap
+
+    values = np.interp(bin_ends, times, levels)
+    values[~mask] = np.nan
+    return values, mask
+
+def resample_meter(file_path, dataset_type, option, edges, origin, max_gap=None, min_coverage=1.0):
+    # Returns the values and gap mask of one meter on the grid given by edges (seconds after origin)
+    value_column, kind = RESAMPLE_SETTINGS[dataset_type]['columns'][option]
+
+    if dataset_type == 'datamill':
+        starts, ends, amounts = load_periods(file_path, value_column)
+        starts = (starts - origin) / 1e9
+        ends = (ends - origin) / 1e9
+        if kind == 'period_rate':
+            # Daily averages become the consumption of the whole period
+            amounts = amounts * (ends - starts) / 86400
+        add_rows(len(amounts))
+        return resample_intervals(edges, starts, ends, amounts, min_coverage)
+
+    timestamps, values = load_series(file_path, dataset_type, value_column)
+    add_rows(len(values))
+    times = (timestamps - origin) / 1e9
+    if kind == 'level':
+        return resample_levels(edges, times, values, max_gap)
+
+    # Each reading is the consumption since the previous one; longer intervals than max_gap are gaps
+    starts, ends, amounts = times[:-1], times[1:], values[1:]
+    if max_gap is not None:
+        short = (ends - starts) <= max_gap
+        starts, ends, amounts = starts[short], ends[short], amounts[short]
+    return resample_intervals(edges, starts, ends, amounts, min_coverage)
+
+@instrument_stage()
+def resample_folder(input_folder, output_folder, file_names=None, dataset_type='helios', option='daily',
+                    step=None, max_gap=None, min_coverage=1.0, start=None, end=None):
+    # Aligns every meter file of a folder onto one fixed time grid and writes it as
+    # values.npy (meters x bins, float32, NaN in gaps), mask.npy (True where observed) and grid.json.
+    # Always rebuilds from all files of the folder because new meters can widen the grid.
+    settings = RESAMPLE_SETTINGS[dataset_type]
+    step_ns = pd.Timedelta(step or settings['step']).value
+    max_gap = max_gap or settings['max_gap']
+    max_gap_seconds = pd.Timedelta(max_gap).total_seconds() if max_gap else None
+
+    file_names = sorted(name for name in os.listdir(input_folder) if name.endswith('.csv'))
+    if not file_names:
+        print(f"No CSV files found in {input_folder}")
+        return None
+
+    # First pass over the time columns only, to size the grid
+    if start is None or end is None:
+        bounds = [time_bounds(os.path.join(input_folder, name), dataset_type) for name in file_names]
+        bounds = [bound for bound in bounds if bound[0] is not None]
+        if not bounds:
+            print(f"No readings found in {input_folder}")
+            return None
+    origin = pd.Timestamp(start).value if start is not None else min(bound[0] for bound in bounds)
+    origin = origin - origin % step_ns
+    last = pd.Timestamp(end).value if end is not None else max(bound[1] for bound in bounds)
+    bins = max(int(-(-(last - origin) // step_ns)), 1)
+    edges = np.arange(bins + 1) * (step_ns / 1e9)
+
+    # Write straight into arrays on disk; temporary names keep a half written grid from being used
+    os.makedirs(output_folder, exist_ok=True)
+    values_file = os.path.join(output_folder, 'values.npy')
+    mask_file = os.path.join(output_folder, 'mask.npy')
+    values = np.lib.format.open_memmap(values_file + TEMP_SUFFIX, mode='w+', dtype=np.float32, shape=(len(file_names), bins))
+    mask = np.lib.format.open_memmap(mask_file + TEMP_SUFFIX, mode='w+', dtype=bool, shape=(len(file_names), bins))
+
+    for row, file_name in enumerate(file_names):
+        file_path = os.path.join(input_folder, file_name)
+        try:
+            values[row], mask[row] = resample_meter(file_path, dataset_type, option, edges, origin,
+                                                    max_gap_seconds, min_coverage)
+        except Exception as e:
+            print(f"Error resampling file {file_name}: {e}")
+            values[row] = np.nan
+            mask[row] = False
+
+    values.flush()
+    mask.flush()
+    del values, mask
+    os.replace(values_file + TEMP_SUFFIX, values_file)
+    os.replace(mask_file + TEMP_SUFFIX, mask_file)
+
+    value_column, kind = settings['columns'][option]
+    grid = {
+        'dataset_type': dataset_type,
+        'option': option,
+        'value_column': value_column,
+        'kind': kind,
+        'start': pd.Timestamp(origin).isoformat(),
+        'step_seconds': step_ns / 1e9,
+        'bins': bins,
+        'max_gap_seconds': max_gap_seconds,
+        'min_coverage': min_coverage,
+        'meters': [os.path.splitext(name)[0] for name in file_names]
+    }
+    grid_file = os.path.join(output_folder, 'grid.json')
+    with open(grid_file + TEMP_SUFFIX, 'w') as f:
+        json.dump(grid, f, indent=2)
+    os.replace(grid_file + TEMP_SUFFIX, grid_file)
+
+    print(f"Resampled {len(file_names)} meters onto {bins} bins of {step or settings['step']} in {output_folder}")
+    return grid
+
+def load_grid(grid_folder, mmap=True):
+    # Returns (values, mask, grid); the arrays are memory mapped unless mmap is False
+    with open(os.path.join(grid_folder, 'grid.json')) as f:
+        grid = json.load(f)
+    mmap_mode = 'r' if mmap else None
+    values = np.load(os.path.join(grid_folder, 'values.npy'), mmap_mode=mmap_mode)
+    mask = np.load(os.path.join(grid_folder, 'mask.npy'), mmap_mode=mmap_mode)
+    return values, mask, grid
+
+def grid_times(grid):
+    # Start time of every bin
+    return pd.date_range(grid['start'], periods=grid['bins'], freq=pd.Timedelta(seconds=grid['step_seconds']))
+
+def rolling_grid_stats(values, mask, window, min_periods=None, chunk_meters=256):
+    # Trailing rolling mean and std over window bins for all meters at once. Because every meter is on
+    # the same grid the window covers the same real time span everywhere; gaps are left out of the sums.
+    min_periods = min_periods or window
+    meters, bins = values.shape
+    mean = np.full((meters, bins), np.nan, dtype=np.float32)
+    std = np.full((meters, bins), np.nan, dtype=np.float32)
+
+    for low in range(0, meters, chunk_meters):
+        high = min(low + chunk_meters, meters)
+        observed = np.asarray(mask[low:high])
+        x = np.where(observed, np.asarray(values[low:high], dtype=np.float64), 0.0)
+
+        # Centre each meter on its mean so the prefix sums stay small
+        shift = x.sum(axis=1, keepdims=True) / np.maximum(observed.sum(axis=1, keepdims=True), 1)
+        x = np.where(observed, x - shift, 0.0)
+
+        s0 = np.zeros((high - low, bins + 1))
+        s1 = np.zeros((high - low, bins + 1))
+        s2 = np.zeros((high - low, bins + 1))
+        np.cumsum(observed, axis=1, out=s0[:, 1:])
+        np.cumsum(x, axis=1, out=s1[:, 1:])
+        np.cumsum(x * x, axis=1, out=s2[:, 1:])
+
+        lag = np.maximum(np.arange(1, bins + 1) - window, 0)
+        n = s0[:, 1:] - s0[:, lag]
+        total = s1[:, 1:] - s1[:, lag]
+        squares = s2[:, 1:] - s2[:, lag]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            window_mean = total / n
+            variance = np.maximum(squares - total * window_mean, 0.0) / (n - 1)
+        enough = n >= max(min_periods, 1)
+        mean[low:high] = np.where(enough, window_mean + shift, np.nan)
+        std[low:high] = np.where(enough & (n > 1), np.sqrt(variance), np.nan)
+
+    return mean, std
+
+if __name__ == "__main__":
+    dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
+    while dataset_type not in RESAMPLE_SETTINGS:
+        dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
+
+    option = input("Enter option (daily/total): ").lower()
+    while option not in ['daily', 'total']:
+        option = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+
+    step = input(f"Enter grid step (default {RESAMPLE_SETTINGS[dataset_type]['step']}): ").strip() or None
+    try:
+        if step is not None:
+            pd.Timedelta(step)
+    except ValueError:
+        print(f"Invalid grid step. Using default value of {RESAMPLE_SETTINGS[dataset_type]['step']}.")
+        step = None
+
+    if dataset_type == 'helios':
+        input_folder = './dataset/helios/user_helios_sorted/'
+    elif dataset_type == 'queensland':
+        input_folder = f'./dataset/queensland/user_sorted_pulse{"tot" if option == "total" else ""}/'
+    else:
+        input_folder = './dataset/datamill/user_datamill_sorted/'
+
+    resample_folder(input_folder, f'./dataset/{dataset_type}/grid_{option}', dataset_type=dataset_type, option=option, step=step)
@@ -0,0 +1,230 @@
+import os
+import json
+import sqlite3
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# Detection results are written to this SQLite file; set WATER_RESULTS_DB to an empty string to disable
+RESULTS_DB = os.environ.get('WATER_RESULTS_DB', './results/anomalies.db')
+
+# Name used for the points flagged by every model of a run
+CONSENSUS = 'all_methods'
+
+# detections is clustered on (meter, time) so the rows of one meter and period are read from one place.
+# occurrence numbers rows of a meter that share a timestamp (0 for the first), e.g. the meters of a Datamill
+# postcode that share a start date, so none of them overwrites another.
+# meter_counts holds the per-meter totals of each run, so rankings never scan the detections.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    detector TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    option TEXT,
+    created TEXT NOT NULL,
+    settings TEXT
+);
+CREATE TABLE IF NOT EXISTS meters (
+    meter_id INTEGER PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    meter TEXT NOT NULL,
+    UNIQUE (dataset, meter)
+);
+CREATE TABLE IF NOT EXISTS models (
+    model_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS detections (
+    meter_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    occurrence INTEGER NOT NULL,
+    run_id INTEGER NOT NULL,
+    model_id INTEGER NOT NULL,
+    value REAL,
+    z_score REAL,
+    score REAL,
+    anomaly INTEGER NOT NULL,
+    validated INTEGER NOT NULL,
+    PRIMARY KEY (meter_id, ts, occurrence, run_id, model_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS detections_validated ON detections (run_id, model_id, meter_id, ts) WHERE validated = 1;
+CREATE TABLE IF NOT EXISTS meter_counts (
+    run_id INTEGER NOT NULL,
+    meter_id INTEGER NOT NULL,
+    model_id INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    anomalies INTEGER NOT NULL,
+    validated INTEGER NOT NULL,
+    PRIMARY KEY (run_id, model_id, meter_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS meter_counts_ranking ON meter_counts (run_id, model_id, validated);
+"""
+
+def open_store(db_path=None):
+    db_path = db_path or RESULTS_DB
+    folder = os.path.dirname(db_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    # WAL lets queries run while a detection script is writing
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    migrate_store(conn)
+    conn.executescript(SCHEMA)
+    return conn
+
+def migrate_store(conn):
+    # Stores written before rows had an occurrence kept one row per (meter, time), so their rows are occurrence 0
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(detections)')]
+    if not columns or 'occurrence' in columns:
+        return
+    conn.execute('ALTER TABLE detections RENAME TO detections_old')
+    conn.execute('DROP INDEX IF EXISTS detections_validated')
+    conn.executescript(SCHEMA)
+    conn.execute('INSERT INTO detections SELECT meter_id, ts, 0, run_id, model_id, value, z_score, score, anomaly, validated '
+                 'FROM detections_old')
+    conn.execute('DROP TABLE detections_old')
+    conn.commit()
+
+def open_results_store():
+    # Store used by the detection scripts, or None when disabled or not writable
+    if not RESULTS_DB:
+        return None
+    try:
+        return open_store(RESULTS_DB)
+    except sqlite3.Error as e:
+        print(f"Results store {RESULTS_DB} could not be opened: {e}")
+        return None
+
+def start_run(conn, detector, dataset, option=None, settings=None):
+    with conn:
+        cursor = conn.execute('INSERT INTO runs (detector, dataset, option, created, settings) VALUES (?, ?, ?, ?, ?)',
+                              (detector, dataset, option, datetime.now().isoformat(timespec='seconds'),
+                               json.dumps(settings or {})))
+    return cursor.lastrowid
+
+def lookup_id(conn, table, key_columns, values):
+    id_column = 'meter_id' if table == 'meters' else 'model_id'
+    where = ' AND '.join(f'{column} = ?' for column in key_columns)
+    conn.execute(f"INSERT OR IGNORE INTO {table} ({', '.join(key_columns)}) VALUES ({', '.join('?' * len(values))})", values)
+    return conn.execute(f'SELECT {id_column} FROM {table} WHERE {where}', values).fetchone()[0]
+
+def to_seconds(timestamps):
+    return pd.to_datetime(timestamps).to_numpy(dtype='datetime64[s]').astype(np.int64)
+
+def nullable(array):
+    # SQLite stores NaN as NULL
+    array = np.asarray(array, dtype=np.float64)
+    return [None if value != value else value for value in array.tolist()]
+
+def insert_detections(conn, run_id, dataset, meter, timestamps, model_results, values=None, z_scores=None):
+    # Bulk insert of one meter's rows. model_results maps a model name to (scores, anomaly flags, validated flags);
+    # scores may be None for detectors without a score. All rows go in one transaction.
+    ts = to_seconds(timestamps)
+    occurrence = pd.Series(ts).groupby(ts).cumcount().tolist()
+    ts = ts.tolist()
+    n = len(ts)
+    values = nullable(values) if values is not None else [None] * n
+    z_scores = nullable(z_scores) if z_scores is not None else [None] * n
+
+    with conn:
+        meter_id = lookup_id(conn, 'meters', ['dataset', 'meter'], (dataset, str(meter)))
+        for model_name, (scores, anomaly, validated) in model_results.items():
+            model_id = lookup_id(conn, 'models', ['name'], (model_name,))
+            scores = nullable(scores) if scores is not None else [None] * n
+            anomaly = np.asarray(anomaly, dtype=bool)
+            validated = np.asarray(validated, dtype=bool)
+
+            # Storing a meter again in the same run replaces all of its earlier rows
+            conn.execute('DELETE FROM detections WHERE meter_id = ? AND run_id = ? AND model_id = ?', (meter_id, run_id, model_id))
+            conn.executemany('INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             zip([meter_id] * n, ts, occurrence, [run_id] * n, [model_id] * n, values, z_scores, scores,
+                                 anomaly.astype(int).tolist(), validated.astype(int).tolist()))
+            conn.execute('INSERT OR REPLACE INTO meter_counts VALUES (?, ?, ?, ?, ?, ?)',
+                         (run_id, meter_id, model_id, n, int(anomaly.sum()), int(validated.sum())))
+
+def insert_frame(conn, run_id, dataset, meter, df, model_names, value_column=None, time_column='datetime'):
+    # Rows of a detection DataFrame with the {model}_anomaly_score, {model}_is_anomaly,
+    # {model}_is_validated_anomaly and all_methods_anomaly columns of the pyod scripts
+    model_results = {}
+    for model_name in model_names:
+        if f'{model_name}_is_validated_anomaly' not in df:
+            continue
+        model_results[model_name] = (df[f'{model_name}_anomaly_score'].to_numpy(), df[f'{model_name}_is_anomaly'].to_numpy() == 1,
+                                     df[f'{model_name}_is_validated_anomaly'].to_numpy())
+    if 'all_methods_anomaly' in df:
+        consensus = df['all_methods_anomaly'].to_numpy()
+    else:
+        consensus = np.logical_and.reduce([validated for _, _, validated in model_results.values()]) if model_results else np.zeros(len(df), dtype=bool)
+    model_results[CONSENSUS] = (None, consensus, consensus)
+
+    insert_detections(conn, run_id, dataset, meter, df[time_column], model_results,
+                      df[value_column].to_numpy() if value_column in df else None,
+                      df['z_score'].to_numpy() if 'z_score' in df else None)
+
+def store_results(conn, run_id, dataset, meter, df, model_names, value_column=None, time_column='datetime'):
+    # Used by the detection scripts: a failed write is reported and the detection run goes on
+    if conn is None:
+        return
+    try:
+        insert_frame(conn, run_id, dataset, meter, df, model_names, value_column, time_column)
+    except (sqlite3.Error, KeyError, ValueError) as e:
+        print(f"Error saving results of {meter} to {RESULTS_DB}: {e}")
+
+def latest_run(conn, dataset, detector=None):
+    query = 'SELECT MAX(run_id) FROM runs WHERE dataset = ?' + (' AND detector = ?' if detector else '')
+    return conn.execute(query, (dataset, detector) if detector else (dataset,)).fetchone()[0]
+
+def meter_anomalies(conn, dataset, meter, start=None, end=None, model=CONSENSUS, run_id=None, validated_only=True):
+    # Anomalies of one meter between start and end (inclusive), from the latest run of the dataset by default
+    run_id = run_id or latest_run(conn, dataset)
+    start = int(pd.Timestamp(start).timestamp()) if start is not None else -2 ** 62
+    end = int(pd.Timestamp(end).timestamp()) if end is not None else 2 ** 62
+    query = """
+        SELECT d.ts, d.value, d.z_score, d.score, d.anomaly, d.validated
+        FROM detections d
+        JOIN meters m ON m.meter_id = d.meter_id
+        JOIN models o ON o.model_id = d.model_id
+        WHERE m.dataset = ? AND m.meter = ? AND d.ts BETWEEN ? AND ? AND d.run_id = ? AND o.name = ?
+    """ + (' AND d.validated = 1' if validated_only else '') + ' ORDER BY d.ts, d.occurrence'
+    result = pd.read_sql_query(query, conn, params=(dataset, str(meter), start, end, run_id, model))
+    result.insert(0, 'datetime', pd.to_datetime(result.pop('ts'), unit='s'))
+    return result
+
+def top_meters(conn, dataset, n=10, model=CONSENSUS, run_id=None):
+    # Meters with the most validated anomalies in a run, from the per-meter totals
+    run_id = run_id or latest_run(conn, dataset)
+    query = """
+        SELECT m.meter, c.validated, c.anomalies, c.rows
+        FROM meter_counts c
+        JOIN meters m ON m.meter_id = c.meter_id
+        JOIN models o ON o.model_id = c.model_id
+        WHERE c.run_id = ? AND o.name = ?
+        ORDER BY c.validated DESC
+        LIMIT ?
+    """
+    return pd.read_sql_query(query, conn, params=(run_id, model, n))
+
+if __name__ == "__main__":
+    conn = open_store()
+    dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
+    while dataset_type not in ['helios', 'queensland', 'datamill']:
+        dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
+
+    query = input("Enter query (meter/top): ").strip().lower()
+    while query not in ['meter', 'top']:
+        query = input("Invalid input. Please enter 'meter' or 'top': ").strip().lower()
+
+    model = input(f"Enter model name (default {CONSENSUS}): ").strip() or CONSENSUS
+    if query == 'top':
+        try:
+            n = int(input("Enter number of meters (default 10): "))
+        except ValueError:
+            print("Invalid number of meters. Using default value of 10.")
+            n = 10
+        print(top_meters(conn, dataset_type, n, model).to_string(index=False))
+    else:
+        meter = input("Enter meter (file name without .csv): ").strip()
+        start = input("Enter start date (e.g. 2020-01-01, default all): ").strip() or None
+        end = input("Enter end date (e.g. 2020-01-31, default all): ").strip() or None
+        print(meter_anomalies(conn, dataset_type, meter, start, end, model).to_string(index=False))
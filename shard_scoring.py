@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import threading
+import multiprocessing as mp
+import pandas as pd
+from instrumentation import instrument_stage, stage_metrics
+from detector_routing import DETECTOR_BUDGET, plan_detectors, planned_models, planned_seconds, record_cost, report_plan
+
+# Shared work directory layout:
+#   plan.json                 number of shards and the settings every worker must agree on
+#   shard_0003.lock           claim of a running worker, its mtime is the heartbeat
+#   shard_0003.done           written once the shard outputs are complete
+#   results/shard_0003_*.csv  per-shard outputs, merged by merge_shards()
+PLAN_FILE = 'plan.json'
+LEASE_TIMEOUT = 300
+
+def shard_of(meter, shards):
+    # Stable across processes and machines, unlike the built-in hash() of a string
+    return int.from_bytes(hashlib.md5(meter.encode('utf-8')).digest()[:8], 'big') % shards
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def shard_path(work_folder, shard, suffix):
+    return os.path.join(work_folder, f'shard_{shard:04d}.{suffix}')
+
+def create_exclusive(path, content):
+    # Atomic create that fails if the file exists; this is the only claim primitive, so no broker is needed
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    return True
+
+def load_plan(work_folder, shards, settings):
+    # The first worker writes the plan; later workers must use the same number of shards and settings
+    os.makedirs(os.path.join(work_folder, 'results'), exist_ok=True)
+    plan_path = os.path.join(work_folder, PLAN_FILE)
+    create_exclusive(plan_path, json.dumps({'shards': shards, 'settings': settings}))
+    for _ in range(50):
+        try:
+            with open(plan_path) as f:
+                plan = json.load(f)
+            break
+        except ValueError:
+            # Another worker is still writing the plan
+            time.sleep(0.1)
+    else:
+        raise ValueError(f"Shard plan {plan_path} could not be read; remove it if the worker that wrote it crashed")
+    if plan['settings'] != settings:
+        raise ValueError(f"Work folder {work_folder} belongs to a run with other settings: {plan['settings']}")
+    return plan
+
+def claim_shard(work_folder, shard, lease_timeout=LEASE_TIMEOUT):
+    # Returns True when this worker now owns the shard. A lock whose heartbeat is older than
+    # lease_timeout belongs to a crashed worker: it is renamed away, which only one worker can do.
+    lock_path = shard_path(work_folder, shard, 'lock')
+    if os.path.exists(shard_path(work_folder, shard, 'done')):
+        return False
+    if create_exclusive(lock_path, worker_id()):
+        return True
+
+    try:
+        age = time.time() - os.path.getmtime(lock_path)
+    except FileNotFoundError:
+        return create_exclusive(lock_path, worker_id())
+    if age <= lease_timeout:
+        return False
+
+    stale_path = f"{lock_path}.stale.{worker_id().replace(':', '_')}"
+    try:
+        os.rename(lock_path, stale_path)
+    except FileNotFoundError:
+        return False
+    os.remove(stale_path)
+    print(f"Reclaimed shard {shard} from a worker silent for {age:.0f}s")
+    return create_exclusive(lock_path, worker_id())
+
+def owns_shard(work_folder, shard):
+    try:
+        with open(shard_path(work_folder, shard, 'lock')) as f:
+            return f.read() == worker_id()
+    except FileNotFoundError:
+        return False
+
+class Heartbeat(threading.Thread):
+    # Touches the lock file of the claimed shard so other workers see that it is still alive
+    def __init__(self, lock_path, interval):
+        super().__init__(daemon=True)
+        self.lock_path = lock_path
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                os.utime(self.lock_path)
+            except FileNotFoundError:
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def score_shard(file_paths, models, dataset_type, value_type, value_column, contamination=0.01, preprocessing=None, plan=None):
+    # Scores the files of one shard with predict_whole_dataset and returns (summary, anomalies) tables.
+    # With a detector plan each file is scored with its planned models only.
+    from predict_whole_dataset import process_file
+
+    summary = []
+    anomalies = []
+    for file_path in file_paths:
+        meter_models = planned_models(plan, file_path, models)
+        if not meter_models:
+            summary.append({'file': os.path.basename(file_path), 'rows': 0, 'model': 'skipped', 'validated_anomalies': 0})
+            continue
+        timings = {}
+        df, results = process_file(file_path, contamination, meter_models, dataset_type, value_type, value_column,
+                                   preprocessing, timings=timings)
+        record_cost(plan, file_path, timings)
+        if df is None or results is None:
+            summary.append({'file': os.path.basename(file_path), 'rows': 0, 'model': 'error', 'validated_anomalies': 0})
+            continue
+
+        for model_name, count in results.items():
+            summary.append({'file': os.path.basename(file_path), 'rows': len(df), 'model': model_name,
+                            'validated_anomalies': int(count)})
+
+        flag_columns = [column for column in df.columns if column.endswith('_is_validated_anomaly')]
+        flagged = df[df[flag_columns].any(axis=1)] if flag_columns else df.iloc[:0]
+        score_columns = [column for column in df.columns if column.endswith('_anomaly_score')]
+        flagged = flagged[['datetime', value_column, 'z_score'] + score_columns + flag_columns + ['all_methods_anomaly']].copy()
+        flagged.insert(0, 'file', os.path.basename(file_path))
+        anomalies.append(flagged)
+
+    summary = pd.DataFrame(summary, columns=['file', 'rows', 'model', 'validated_anomalies'])
+    anomalies = pd.concat(anomalies, ignore_index=True) if anomalies else pd.DataFrame(columns=['file'])
+    return summary, anomalies
+
+def write_shard_outputs(work_folder, shard, summary, anomalies):
+    # Temporary names first, so a crashed worker never leaves a half written shard output
+    results_folder = os.path.join(work_folder, 'results')
+    for name, table in (('summary', summary), ('anomalies', anomalies)):
+        output_file = os.path.join(results_folder, f'shard_{shard:04d}_{name}.csv')
+        table.to_csv(output_file + '.part', index=False)
+        os.replace(output_file + '.part', output_file)
+
+@instrument_stage()
+def run_worker(folder_path, work_folder, model_save_path, dataset_type, value_type, value_column, shards=16,
+               lease_timeout=LEASE_TIMEOUT, contamination=0.01, wait=True, poll_interval=5, budget=None):
+    # Claims and scores shards until every shard is done. With wait=True the worker keeps polling while
+    # other workers hold shards, so it can take over the shards of a worker that stops sending heartbeats.
+    # budget is the detector time budget of the whole run, shared by all workers.
+    from predict_whole_dataset import load_models
+    from model_store import load_preprocessing
+
+    budget = DETECTOR_BUDGET if budget is None else budget
+    settings = {'folder_path': os.path.abspath(folder_path), 'model_save_path': os.path.abspath(model_save_path),
+                'dataset_type': dataset_type, 'value_type': value_type, 'value_column': value_column, 'budget': budget,
+                'contamination': contamination}
+    shards = load_plan(work_folder, shards, settings)['shards']
+
+    models = load_models(model_save_path)
+    if not models:
+        print("No models loaded. Exiting.")
+        return 0
+    preprocessing = load_preprocessing(model_save_path)
+
+    # Workers planning from the same cost estimates make the same plan over the whole dataset, so they share the
+    # budget without talking to each other
+    file_names = sorted(name for name in os.listdir(folder_path) if name.endswith('.csv'))
+    features = len(preprocessing['features']) if preprocessing is not None else 4
+    plan = plan_detectors([os.path.join(folder_path, file_name) for file_name in file_names], models, 'score', features, budget)
+
+    # Longest meters first within a shard, and the shards with the most planned work are claimed first,
+    # so no worker is left with a long shard at the end of the run
+    shard_files = {shard: [] for shard in range(shards)}
+    for file_path in plan['order']:
+        shard_files[shard_of(os.path.splitext(os.path.basename(file_path))[0], shards)].append(file_path)
+    shard_costs = {shard: planned_seconds(plan, shard_files[shard]) for shard in range(shards)}
+
+    # Workers start at different shards among shards of equal cost so they rarely race for the same lock
+    first = shard_of(worker_id(), shards)
+    order = sorted(range(shards), key=lambda shard: (-shard_costs[shard], (shard - first) % shards))
+    scored = 0
+
+    while True:
+        pending = [shard for shard in order if not os.path.exists(shard_path(work_folder, shard, 'done'))]
+        if not pending:
+            break
+
+        claimed_any = False
+        for shard in pending:
+            if not claim_shard(work_folder, shard, lease_timeout):
+                continue
+            claimed_any = True
+            lock_path = shard_path(work_folder, shard, 'lock')
+            heartbeat = Heartbeat(lock_path, max(lease_timeout / 3, 0.1))
+            heartbeat.start()
+            try:
+                print(f"Worker {worker_id()} scoring shard {shard} ({len(shard_files[shard])} files)")
+                with stage_metrics('shard_scoring.shard', f'shard_{shard:04d}') as metrics:
+                    summary, anomalies = score_shard(shard_files[shard], models, dataset_type, value_type,
+                                                     value_column, contamination, preprocessing, plan)
+                    metrics.add_rows(summary.drop_duplicates('file')['rows'].sum())
+            finally:
+                heartbeat.stop()
+
+            # A worker that lost its lease while scoring leaves the shard to the new owner
+            if not owns_shard(work_folder, shard):
+                print(f"Lost the lease on shard {shard}, discarding its results")
+                continue
+            write_shard_outputs(work_folder, shard, summary, anomalies)
+            create_exclusive(shard_path(work_folder, shard, 'done'), worker_id())
+            os.remove(lock_path)
+            scored += 1
+
+        if not claimed_any:
+            if not wait:
+                break
+            time.sleep(poll_interval)
+
+    print(f"Worker {worker_id()} finished after scoring {scored} shards")
+    report_plan(plan)
+    return scored
+
+def shard_status(work_folder):
+    plan_path = os.path.join(work_folder, PLAN_FILE)
+    if not os.path.exists(plan_path):
+        return None
+    with open(plan_path) as f:
+        shards = json.load(f)['shards']
+    done = [shard for shard in range(shards) if os.path.exists(shard_path(work_folder, shard, 'done'))]
+    running = [shard for shard in range(shards) if shard not in done and os.path.exists(shard_path(work_folder, shard, 'lock'))]
+    return {'shards': shards, 'done': done, 'running': running}
+
+@instrument_stage()
+def merge_shards(work_folder, output_folder=None):
+    # Combines the per-shard outputs into scores_summary.csv and anomalies.csv once every shard is done
+    status = shard_status(work_folder)
+    if status is None:
+        print(f"No sharded run found in {work_folder}")
+        return None
+    if len(status['done']) < status['shards']:
+        print(f"{status['shards'] - len(status['done'])} of {status['shards']} shards are not done yet "
+              f"({len(status['running'])} running)")
+        return None
+
+    output_folder = output_folder or work_folder
+    results_folder = os.path.join(work_folder, 'results')
+    merged = {}
+    for name in ('summary', 'anomalies'):
+        tables = []
+        for shard in range(status['shards']):
+            table = pd.read_csv(os.path.join(results_folder, f'shard_{shard:04d}_{name}.csv'))
+            if len(table):
+                tables.append(table)
+        merged[name] = pd.concat(tables, ignore_index=True).sort_values('file', kind='stable') if tables else pd.DataFrame()
+        merged[name].to_csv(os.path.join(output_folder, f'{"scores_summary" if name == "summary" else name}.csv'), index=False)
+
+    totals = merged['summary'].groupby('model')['validated_anomalies'].sum() if len(merged['summary']) else pd.Series(dtype=int)
+    print(f"Merged {status['shards']} shards: {merged['summary']['file'].nunique() if len(merged['summary']) else 0} files")
+    for model_name, count in totals.items():
+        print(f"{model_name} validated anomalies: {count}")
+    return merged
+
+def run_local(folder_path, work_folder, model_save_path, dataset_type, value_type, value_column, workers=4,
+              shards=16, lease_timeout=LEASE_TIMEOUT, contamination=0.01, budget=None):
+    # Several worker processes on this machine, the same way several nodes would share work_folder
+    context = mp.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(folder_path, work_folder, model_save_path, dataset_type,
+                                                          value_type, value_column, shards, lease_timeout, contamination),
+                                 kwargs={'budget': budget})
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return merge_shards(work_folder)
+
+if __name__ == "__main__":
+    mode = input("Enter mode (worker/merge/local): ").strip().lower()
+    while mode not in ['worker', 'merge', 'local']:
+        mode = input("Invalid input. Please enter 'worker', 'merge' or 'local': ").strip().lower()
+
+    work_folder = input("Enter shared work folder (default ./shard_work): ").strip() or './shard_work'
+    if mode == 'merge':
+        merge_shards(work_folder)
+        sys.exit()
+
+    dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
+    while dataset_type not in ['helios', 'queensland', 'datamill']:
+        dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
+
+    value_type = input("Enter data type (daily/total): ").lower()
+    while value_type not in ['daily', 'total']:
+        value_type = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+
+    try:
+        shards = int(input("Enter number of shards (default 16): "))
+    except ValueError:
+        print("Invalid number of shards. Using default value of 16.")
+        shards = 16
+
+    if dataset_type == 'helios':
+        folder_path = './dataset/helios/user_helios_sorted'
+        value_column = 'diff' if value_type == 'daily' else 'meter reading'
+    elif dataset_type == 'queensland':
+        folder_path = f'./dataset/queensland/user_sorted_pulse{"tot" if value_type == "total" else ""}'
+        value_column = 'Pulse1' if value_type == 'daily' else 'Pulse1_Total'
+    else:
+        folder_path = './dataset/datamill/user_datamill_sorted'
+        value_column = 'DAILY_AVERAGE_CONSUMPTION' if value_type == 'daily' else 'GROSS_CONSUMPTION'
+    model_save_path = f'./models/{dataset_type}/{value_type}'
+
+    try:
+        contamination = float(input("Enter contamination factor (default 0.01): "))
+    except ValueError:
+        print("Invalid contamination factor. Using default value of 0.01.")
+        contamination = 0.01
+
+    try:
+        budget = float(input("Enter detector time budget in seconds (default WATER_DETECTOR_BUDGET, 0 runs every detector): "))
+    except ValueError:
+        print("Invalid detector budget. Using the default budget.")
+        budget = None
+
+    if mode == 'local':
+        try:
+            workers = int(input("Enter number of local worker processes (default 4): "))
+        except ValueError:
+            print("Invalid number of workers. Using default value of 4.")
+            workers = 4
+        run_local(folder_path, work_folder, model_save_path, dataset_type, value_type, value_column, workers, shards,
+                  contamination=contamination, budget=budget)
+    else:
+        run_worker(folder_path, work_folder, model_save_path, dataset_type, value_type, value_column, shards,
+                   contamination=contamination, budget=budget)
+        merge_shards(work_folder)
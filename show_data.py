@@ -1,9 +1,10 @@
 import os
 import glob
 import pandas as pd
-import matplotlib.pyplot as plt
+from time_index import read_time_window
+from date_parsing import parse_datetimes
 
-def plot_water_usage_from_files(csv_folder, dataset_type, consumption_type=None):
+def plot_water_usage_from_files(csv_folder, dataset_type, consumption_type=None, start=None, end=None):
     # Find all CSV files in the specified folder
     csv_files = glob.glob(os.path.join(csv_folder, '*.csv'))
 
@@ -16,8 +17,10 @@ def plot_water_usage_from_files(csv_folder, dataset_type, consumption_type=None)
         print(f"Processing file: {csv_file}")
         
         try:
-            # Read the CSV file into a DataFrame
-            if dataset_type == 'helios':
+            # Read the CSV file into a DataFrame; a time window is read through the time index of the file
+            if start is not None or end is not None:
+                df = read_time_window(csv_file, dataset_type, start, end)
+            elif dataset_type == 'helios':
                 df = pd.read_csv(csv_file, sep=',')
             else:
                 df = pd.read_csv(csv_file)
@@ -36,6 +39,8 @@ def plot_water_usage_from_files(csv_folder, dataset_type, consumption_type=None)
 
             
 def process_queensland_data(df, csv_file, queensland_type):
+    import matplotlib.pyplot as plt
+
     print(f"Columns in the dataframe: {df.columns.tolist()}")
     
     # Check if 'datetime' column exists
@@ -44,7 +49,7 @@ def process_queensland_data(df, csv_file, queensland_type):
         return
 
     # Convert datetime column to datetime format
-    df['datetime'] = pd.to_datetime(df['datetime'])
+    df['datetime'] = parse_datetimes(df['datetime'])
 
     # Determine the value column based on queensland_type
     if queensland_type == 'pulse':
@@ -78,8 +83,10 @@ def process_queensland_data(df, csv_file, queensland_type):
 
 
 def process_helios_data(df, csv_file, consumption_type):
+    import matplotlib.pyplot as plt
+
     # Convert 'datetime' column to datetime format
-    df['datetime'] = pd.to_datetime(df['datetime'], format='%d/%m/%Y %H:%M:%S')
+    df['datetime'] = parse_datetimes(df['datetime'], format='%d/%m/%Y %H:%M:%S')
 
     # Sort the dataframe by datetime
     df = df.sort_values('datetime')
@@ -107,8 +114,10 @@ def process_helios_data(df, csv_file, consumption_type):
     plt.show()
 
 def process_datamill_data(df, csv_file,consumption_type):
+    import matplotlib.pyplot as plt
+
     # Convert date columns to datetime format
-    df['READING_START_DATE'] = pd.to_datetime(df['READING_START_DATE'], format='%d/%m/%Y %H:%M')
+    df['READING_START_DATE'] = parse_datetimes(df['READING_START_DATE'], format='%d/%m/%Y %H:%M')
     # Sort the dataframe by start date
 
     df = df.sort_values('READING_START_DATE')
@@ -142,6 +151,10 @@ if __name__ == '__main__':
     
     dataset_type = input("Enter the dataset type you want to display: ").lower()
 
+    # Optional time window, e.g. one week of a multi-year file
+    start = input("Enter start time (e.g. 2020-01-01, default whole file): ").strip() or None
+    end = input("Enter end time (e.g. 2020-01-08 00:00, default whole file): ").strip() or None
+
     if dataset_type in dataset_folders:
         if dataset_type == 'queensland':
             print("Queensland dataset options:")
@@ -150,7 +163,7 @@ if __name__ == '__main__':
             queensland_type = input("Enter the Queensland dataset type (pulse or pulsetotal): ").lower()
             if queensland_type in dataset_folders['queensland']:
                 csv_folder = dataset_folders['queensland'][queensland_type]
-                plot_water_usage_from_files(csv_folder, dataset_type, queensland_type)
+                plot_water_usage_from_files(csv_folder, dataset_type, queensland_type, start, end)
             else:
                 print("Invalid Queensland dataset type. Please choose 'pulse' or 'pulsetotal'.")
         elif dataset_type == 'helios':
@@ -159,7 +172,7 @@ if __name__ == '__main__':
             print("- total")
             consumption_type = input("Enter the Helios consumption type (daily or total): ").lower()
             csv_folder = dataset_folders[dataset_type]
-            plot_water_usage_from_files(csv_folder, dataset_type, consumption_type)
+            plot_water_usage_from_files(csv_folder, dataset_type, consumption_type, start, end)
         else:
             print("Datamill consumption options:")
             print("- daily")
@@ -171,6 +184,6 @@ if __name__ == '__main__':
             else:
                 consumption_type = 'GROSS_CONSUMPTION'
 
-            plot_water_usage_from_files(csv_folder, dataset_type,consumption_type)
+            plot_water_usage_from_files(csv_folder, dataset_type,consumption_type, start, end)
     else:
         print("Invalid dataset type. Please choose from the available options.")
@@ -2,6 +2,11 @@ import os
 import pandas as pd
 import sys
 import shutil
+from instrumentation import instrument_stage, add_rows
+from checkpoint import start_progress, unit_done, complete_unit, finish_progress, atomic_to_csv
+from time_index import build_time_index
+from data_quality import DATAMILL_READING_COLUMNS, frame_quality, save_quality
+from date_parsing import parse_datetimes
 
 def replace_semicolons_with_commas(file_path):
     # Read the CSV file
@@ -12,139 +17,207 @@ def replace_semicolons_with_commas(file_path):
     
     return df
 
-def sort_and_save_datamill(input_folder, output_folder):
+@instrument_stage()
+def sort_and_save_datamill(input_folder, output_folder, file_names=None, resume=True):
     # Ensure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
+    progress = start_progress(output_folder, f'sort_and_save_datamill:{os.path.abspath(input_folder)}', resume=resume)
+    failed = []
 
-    # Iterate over all CSV files in the input folder
-    for file_name in os.listdir(input_folder):
+    # Iterate over all CSV files in the input folder, or only the given ones
+    if file_names is None:
+        file_names = os.listdir(input_folder)
+
+    for file_name in file_names:
         if file_name.endswith('.csv'):
             file_path = os.path.join(input_folder, file_name)
+            output_file_path = os.path.join(output_folder, file_name)
+            if unit_done(progress, file_name, file_path):
+                continue
             
             try:
                 # Read the CSV file
-                df = pd.read_csv(file_path, parse_dates=['READING_START_DATE'], dayfirst=True)
+                df = pd.read_csv(file_path)
+                add_rows(len(df))
+                df['READING_START_DATE'] = parse_datetimes(df['READING_START_DATE'], dayfirst=True)
                 
                 # Sort the DataFrame by 'READING_START_DATE' column
                 df_sorted = df.sort_values(by='READING_START_DATE')
                 
+                # Duplicates found while the sorted data is in memory; meters of a postcode share start dates
+                quality = frame_quality(df_sorted, 'READING_START_DATE', file_name, DATAMILL_READING_COLUMNS)
+
                 # Format the 'READING_START_DATE' column
                 df_sorted['READING_START_DATE'] = df_sorted['READING_START_DATE'].dt.strftime('%d/%m/%Y %H:%M')
                 
                 # Save the sorted DataFrame to a new CSV file
-                output_file_path = os.path.join(output_folder, file_name)
-                df_sorted.to_csv(output_file_path, index=False)
+                atomic_to_csv(df_sorted, output_file_path, index=False)
+                # Sparse time index so readers can seek to a time window
+                index_file = build_time_index(output_file_path, 'datamill')
+                quality_file = save_quality(output_file_path, *quality)
+                complete_unit(progress, file_name, [output_file_path, index_file, quality_file], file_path)
                 
                 print(f"Successfully processed and sorted {file_name}")
             
             except Exception as e:
                 print(f"Error processing file {file_name}: {e}")
+                failed.append(file_name)
+
+    return finish_progress(progress, failed)
 
 
 # Function to sort data and save to specified folder for Queensland dataset
-def sort_and_save_queensland(input_folder, output_folder):
+@instrument_stage()
+def sort_and_save_queensland(input_folder, output_folder, file_names=None, resume=True):
     # Ensure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
+    progress = start_progress(output_folder, f'sort_and_save_queensland:{os.path.abspath(input_folder)}', resume=resume)
+    failed = []
+
+    # Iterate over all CSV files in the input folder, or only the given ones
+    if file_names is None:
+        file_names = os.listdir(input_folder)
 
-    # Iterate over all CSV files in the input folder
-    for file_name in os.listdir(input_folder):
+    for file_name in file_names:
         if file_name.endswith('.csv'):
             file_path = os.path.join(input_folder, file_name)
+            output_file_path = os.path.join(output_folder, file_name)
+            if unit_done(progress, file_name, file_path):
+                continue
             
             # Read the CSV file
-            df = pd.read_csv(file_path, parse_dates=['datetime'], dayfirst=True)
+            df = pd.read_csv(file_path)
+            add_rows(len(df))
+            df['datetime'] = parse_datetimes(df['datetime'], dayfirst=True)
             
             # Sort the DataFrame by 'datetime' column
             df_sorted = df.sort_values(by='datetime')
             
+            # Duplicates, gaps and counter resets found while the sorted data is in memory
+            quality = frame_quality(df_sorted, 'datetime', file_name)
+
             # Format the 'datetime' column
             df_sorted['datetime'] = df_sorted['datetime'].dt.strftime('%d/%m/%Y %H:%M:%S')
             
             # Save the sorted DataFrame to a new CSV file
-            output_file_path = os.path.join(output_folder, file_name)
-            df_sorted.to_csv(output_file_path, index=False)
+            atomic_to_csv(df_sorted, output_file_path, index=False)
+            # Sparse time index so readers can seek to a time window
+            index_file = build_time_index(output_file_path, 'queensland')
+            quality_file = save_quality(output_file_path, *quality)
+            complete_unit(progress, file_name, [output_file_path, index_file, quality_file], file_path)
             
             print(f"Successfully sorted {file_name}")
 
+    return finish_progress(progress, failed)
+
 # Function to sort data and save to specified folder for Helios dataset
-def sort_and_save_helios(input_folder, output_folder):
+@instrument_stage()
+def sort_and_save_helios(input_folder, output_folder, file_names=None, resume=True):
     # Ensure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
+    progress = start_progress(output_folder, f'sort_and_save_helios:{os.path.abspath(input_folder)}', resume=resume)
+    failed = []
+
+    # Iterate over all CSV files in the input folder, or only the given ones
+    if file_names is None:
+        file_names = os.listdir(input_folder)
 
-    # Iterate over all CSV files in the input folder
-    for file_name in os.listdir(input_folder):
+    for file_name in file_names:
         if file_name.endswith('.csv'):
             file_path = os.path.join(input_folder, file_name)
+            output_file_path = os.path.join(output_folder, file_name)
+            if unit_done(progress, file_name, file_path):
+                continue
             
             try:
                 # Read the CSV file with proper column names and delimiter
-                df = pd.read_csv(file_path, delimiter=';', parse_dates=['datetime'], dayfirst=True,
-                                 names=['datetime', 'meter reading', 'diff'], header=0)
+                df = pd.read_csv(file_path, delimiter=';', names=['datetime', 'meter reading', 'diff'], header=0)
+                add_rows(len(df))
+                # Users share their timestamps, so each distinct string is parsed once across all files
+                df['datetime'] = parse_datetimes(df['datetime'], dayfirst=True)
                 
                 # Sort the DataFrame by 'datetime' column
                 df_sorted = df.sort_values(by='datetime')
                 
+                # Duplicates, gaps and counter resets found while the sorted data is in memory
+                quality = frame_quality(df_sorted, 'datetime', file_name)
+
                 # Format the 'datetime' column
                 df_sorted['datetime'] = df_sorted['datetime'].dt.strftime('%d/%m/%Y %H:%M:%S')
                 
                 # Save the sorted DataFrame to a new CSV file
-                output_file_path = os.path.join(output_folder, file_name)
-                df_sorted.to_csv(output_file_path, index=False, sep=';')
+                atomic_to_csv(df_sorted, output_file_path, index=False, sep=';')
+                # Sparse time index so readers can seek to a time window
+                index_file = build_time_index(output_file_path, 'helios', sep=';')
+                quality_file = save_quality(output_file_path, *quality)
+                complete_unit(progress, file_name, [output_file_path, index_file, quality_file], file_path)
                 
                 print(f"Successfully sorted {file_name}")
             
             except ValueError as e:
                 print(f"Error processing file {file_name}: {e}")
+                failed.append(file_name)
+
+    return finish_progress(progress, failed)
 
-# Prompt user to select the dataset to sort
-dataset_choice = input("Which dataset would you like to sort? Enter 'Queensland', 'Helios', or 'DataMill': ").strip().lower()
+def main():
+    # Prompt user to select the dataset to sort
+    dataset_choice = input("Which dataset would you like to sort? Enter 'Queensland', 'Helios', or 'DataMill': ").strip().lower()
+    remove_inputs = input("Remove the unsorted files after sorting? (yes/no, default no): ").strip().lower() in ['y', 'yes']
 
-if dataset_choice == 'queensland':
-    # Directories for Queensland dataset
-    pulse_input_folder = './dataset/queensland/pulse'
-    pulse_total_input_folder = './dataset/queensland/pulsetotal'
-    sorted_pulse_output_folder = './dataset/queensland/user_sorted_pulse'
-    sorted_pulse_total_output_folder = './dataset/queensland/user_sorted_pulsetot'
+    if dataset_choice == 'queensland':
+        # Directories for Queensland dataset
+        pulse_input_folder = './dataset/queensland/pulse'
+        pulse_total_input_folder = './dataset/queensland/pulsetotal'
+        sorted_pulse_output_folder = './dataset/queensland/user_sorted_pulse'
+        sorted_pulse_total_output_folder = './dataset/queensland/user_sorted_pulsetot'
 
-    # Sort and save the files for Queensland dataset
-    sort_and_save_queensland(pulse_input_folder, sorted_pulse_output_folder)
-    sort_and_save_queensland(pulse_total_input_folder, sorted_pulse_total_output_folder)
+        # Sort and save the files for Queensland dataset
+        complete = sort_and_save_queensland(pulse_input_folder, sorted_pulse_output_folder)
+        complete = sort_and_save_queensland(pulse_total_input_folder, sorted_pulse_total_output_folder) and complete
     
-    try:
-        shutil.rmtree("./dataset/queensland/pulse")
-        shutil.rmtree("./dataset/queensland/pulsetotal")
-        print("Queensland files removed successfully.")
-    except:
-        print("Queensland files couldn't be removed")
+        # Inputs are only removed when every file was sorted, so a failed run can be resumed
+        if remove_inputs and complete:
+            try:
+                shutil.rmtree("./dataset/queensland/pulse")
+                shutil.rmtree("./dataset/queensland/pulsetotal")
+                print("Queensland files removed successfully.")
+            except:
+                print("Queensland files couldn't be removed")
         
-elif dataset_choice == 'helios':
-    # Directories for Helios dataset
-    helios_input_folder = './dataset/helios/user_dataset/'
-    helios_output_folder = './dataset/helios/user_helios_sorted_semicol/'
+    elif dataset_choice == 'helios':
+        # Directories for Helios dataset
+        helios_input_folder = './dataset/helios/user_dataset/'
+        helios_output_folder = './dataset/helios/user_helios_sorted_semicol/'
 
-    # Sort and save the files for Helios dataset
-    sort_and_save_helios(helios_input_folder, helios_output_folder)
+        # Sort and save the files for Helios dataset
+        complete = sort_and_save_helios(helios_input_folder, helios_output_folder)
     
     
-    try:
-        shutil.rmtree("./dataset/helios/user_dataset")
-        print("Helios files removed successfully.")
-    except:
-        print("Helios files couldn't be removed")
+        if remove_inputs and complete:
+            try:
+                shutil.rmtree("./dataset/helios/user_dataset")
+                print("Helios files removed successfully.")
+            except:
+                print("Helios files couldn't be removed")
     
 
-elif dataset_choice == 'datamill':
-    # Directories for DataMill dataset
-    datamill_input_folder = './dataset/datamill/user_dataset'
-    datamill_output_folder = './dataset/datamill/user_datamill_sorted'
-
-    # Sort and save the files for DataMill dataset
-    sort_and_save_datamill(datamill_input_folder, datamill_output_folder)
-
-    try:
-        shutil.rmtree("./dataset/datamill/user_dataset")
-        print("DataMill files removed successfully.")
-    except:
-        print("DataMill files couldn't be removed")
-else:
-    print("Invalid choice. Please enter 'Queensland', 'Helios', or 'DataMill'.")
\ No newline at end of file
+    elif dataset_choice == 'datamill':
+        # Directories for DataMill dataset
+        datamill_input_folder = './dataset/datamill/user_dataset'
+        datamill_output_folder = './dataset/datamill/user_datamill_sorted'
+
+        # Sort and save the files for DataMill dataset
+        complete = sort_and_save_datamill(datamill_input_folder, datamill_output_folder)
+
+        if remove_inputs and complete:
+            try:
+                shutil.rmtree("./dataset/datamill/user_dataset")
+                print("DataMill files removed successfully.")
+            except:
+                print("DataMill files couldn't be removed")
+    else:
+        print("Invalid choice. Please enter 'Queensland', 'Helios', or 'DataMill'.")
+
+if __name__ == "__main__":
+    main()
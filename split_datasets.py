@@ -2,10 +2,15 @@ import csv
 import os
 import sys
 import shutil
+import zipfile
+import threading
 import pandas as pd
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pytz
+from instrumentation import instrument_stage, add_rows
+from checkpoint import file_fingerprint, start_progress, unit_done, begin_append, complete_unit, finish_progress, atomic_to_csv
 
 def ensure_dir(directory):
     if not os.path.exists(directory):
@@ -28,32 +33,42 @@ def convert_time_format(time_str):
 
     return dt.strftime('%d/%m/%Y %H:%M:%S')
 
-def preprocess_queensland(input_folder, output_folder):
+@instrument_stage()
+def preprocess_queensland(input_folder, output_folder, file_names=None):
     ensure_dir(input_folder)
     ensure_dir(output_folder)
 
-    for filename in os.listdir(input_folder):
+    # Process only the given files when a subset is passed (used for incremental runs)
+    if file_names is None:
+        file_names = os.listdir(input_folder)
+
+    for filename in file_names:
         if filename.endswith('.csv'):
             input_path = os.path.join(input_folder, filename)
             output_path = os.path.join(output_folder, f'processed_{filename}')
             
             df = pd.read_csv(input_path)
+            add_rows(len(df))
             df['time'] = df['time'].apply(convert_time_format)
             df = df.rename(columns={'time': 'datetime'})
-            df.to_csv(output_path, index=False)
+            atomic_to_csv(df, output_path, index=False)
 
             print(f"Processed file: {output_path}")
 
     print("Queensland preprocessing complete. Check the output folder for processed files.")
 
-def split_queensland(input_folder, pulse_folder, pulsetotal_folder):
+@instrument_stage()
+def split_queensland(input_folder, pulse_folder, pulsetotal_folder, file_names=None):
     ensure_dir(pulse_folder)
     ensure_dir(pulsetotal_folder)
 
     pulse_files = {}
     pulsetotal_files = {}
 
-    for filename in sorted(os.listdir(input_folder)):
+    if file_names is None:
+        file_names = os.listdir(input_folder)
+
+    for filename in sorted(file_names):
         if filename.endswith('.csv'):
             data = defaultdict(lambda: defaultdict(list))
             
@@ -63,6 +78,7 @@ def split_queensland(input_folder, pulse_folder, pulsetotal_folder):
                     object_id = row['ManagedObjectid']
                     series = row['Series']
                     data[object_id][series].append(row)
+                add_rows(max(reader.line_num - 1, 0))
             
             for object_id, series_data in data.items():
                 for series, rows in series_data.items():
@@ -107,50 +123,135 @@ def split_queensland(input_folder, pulse_folder, pulsetotal_folder):
 
     print("Queensland dataset processing complete.")
 
-def process_helios_dataset(input_folder, output_folder):
+@instrument_stage()
+def process_helios_dataset(input_folder, output_folder, file_names=None, append=False, resume=True):
     ensure_dir(output_folder)
     all_data = pd.DataFrame()
 
-    for file_name in os.listdir(input_folder):
+    if file_names is None:
+        file_names = os.listdir(input_folder)
+
+    # Every user file is a checkpointed unit; a rerun after a failure skips the users already written
+    sources = {file_name: file_fingerprint(os.path.join(input_folder, file_name))
+               for file_name in sorted(file_names) if file_name.endswith('.csv')}
+    progress = start_progress(output_folder, f"process_helios_dataset:{'append' if append else 'write'}", sources, resume)
+
+    for file_name in file_names:
         if (file_name.endswith('.csv')):
             file_path = os.path.join(input_folder, file_name)
             data = pd.read_csv(file_path, delimiter=';')
             all_data = pd.concat([all_data, data])
 
     all_data = all_data[['user key', 'datetime', 'meter reading', 'diff']]
+    add_rows(len(all_data))
     user_keys = all_data['user key'].unique()
 
     for user_key in user_keys:
         user_data = all_data[all_data['user key'] == user_key]
         user_data = user_data[['datetime', 'meter reading', 'diff']]
         output_file = os.path.join(output_folder, f'{user_key}.csv')
-        user_data.to_csv(output_file, index=False, sep=';')
+        if unit_done(progress, str(user_key)):
+            continue
+        if append and os.path.exists(output_file):
+            # Add the rows of new source files to the existing user file
+            begin_append(progress, str(user_key), output_file)
+            user_data.to_csv(output_file, index=False, sep=';', mode='a', header=False)
+        else:
+            atomic_to_csv(user_data, output_file, index=False, sep=';')
+        complete_unit(progress, str(user_key), [output_file])
         print(f"Created file: {output_file}")
 
+    finish_progress(progress)
     print("Helios dataset files created successfully.")
 
-def process_datamill_dataset(input_folder, output_folder):
-    ensure_dir(output_folder)
+# Columns kept in the per-postcode Datamill files
+DATAMILL_COLUMNS = ['READING_START_DATE', 'READING_END_DATE', 'READING_START_READING', 'READING_END_READING',
+                    'GROSS_CONSUMPTION', 'DAILY_AVERAGE_CONSUMPTION']
 
-    for file_name in os.listdir(input_folder):
-        if file_name.endswith('.csv'):
-            file_path = os.path.join(input_folder, file_name)
-            data = pd.read_csv(file_path)
+# Rows decompressed and parsed at a time, per archive
+DATAMILL_CHUNK_ROWS = 100000
+
+def datamill_members(file_path):
+    # CSV members of a yearly Datamill archive, skipping macOS metadata entries
+    with zipfile.ZipFile(file_path) as archive:
+        return [member.filename for member in archive.infolist()
+                if member.filename.lower().endswith('.csv') and not os.path.basename(member.filename).startswith('._')
+                and '__MACOSX' not in member.filename]
+
+def split_datamill_stream(stream, output_folder, written, lock, append=False, chunk_rows=DATAMILL_CHUNK_ROWS):
+    # Splits one CSV stream by postcode, chunk by chunk. The CSV text is formatted outside the lock,
+    # only the file writes are serialised so several sources can append to the same postcode file.
+    rows = 0
+    postcodes = set()
+    for chunk in pd.read_csv(stream, chunksize=chunk_rows):
+        rows += len(chunk)
+        chunk = chunk.dropna(subset=['POSTCODE_OUTCODE'])
 
-            data = data.dropna(subset=['POSTCODE_OUTCODE'])
-            postcodes = data['POSTCODE_OUTCODE'].unique()
+        for postcode, postcode_data in chunk.groupby('POSTCODE_OUTCODE', sort=False):
+            text = postcode_data[DATAMILL_COLUMNS].to_csv(index=False, header=False)
+            output_file = os.path.join(output_folder, f'{postcode}.csv')
+            postcodes.add(postcode)
 
-            for postcode in postcodes:
-                postcode_data = data[data['POSTCODE_OUTCODE'] == postcode]
-                selected_columns = postcode_data[['READING_START_DATE', 'READING_END_DATE', 
-                                                  'READING_START_READING', 'READING_END_READING', 
-                                                  'GROSS_CONSUMPTION', 'DAILY_AVERAGE_CONSUMPTION']]
-                output_file = os.path.join(output_folder, f'{postcode}.csv')
-                selected_columns.to_csv(output_file, index=False)
-                print(f"Processed postcode {postcode}: {output_file}")
+            with lock:
+                # The first write of this run starts a new file, unless appending to the rows of earlier years
+                if output_file in written or (append and os.path.exists(output_file)):
+                    mode, header = 'a', ''
+                else:
+                    mode, header = 'w', ','.join(DATAMILL_COLUMNS) + '\n'
+                written.add(output_file)
+                with open(output_file, mode, newline='') as f:
+                    f.write(header + text)
+    return rows, postcodes
+
+def split_datamill_source(file_path, output_folder, written, lock, append=False, chunk_rows=DATAMILL_CHUNK_ROWS):
+    # A source is a plain CSV file or a zip archive whose CSV members are decompressed while they are read
+    rows = 0
+    postcodes = set()
+    try:
+        if file_path.endswith('.zip'):
+            with zipfile.ZipFile(file_path) as archive:
+                for member in datamill_members(file_path):
+                    with archive.open(member) as stream:
+                        member_rows, member_postcodes = split_datamill_stream(stream, output_folder, written, lock, append, chunk_rows)
+                    rows += member_rows
+                    postcodes |= member_postcodes
+        else:
+            rows, postcodes = split_datamill_stream(file_path, output_folder, written, lock, append, chunk_rows)
+        print(f"Processed {os.path.basename(file_path)}: {rows} rows, {len(postcodes)} postcodes")
+    except Exception as e:
+        # A broken or partly read source must fail the stage, so the pipeline does not record it as done
+        print(f"Error processing file {file_path}: {e}")
+        raise
+    return rows
+
+@instrument_stage()
+def process_datamill_dataset(input_folder, output_folder, file_names=None, append=False, workers=None,
+                             chunk_rows=DATAMILL_CHUNK_ROWS):
+    # Reads the yearly CSV files or the original zip archives directly, several sources at a time
+    ensure_dir(output_folder)
+
+    if file_names is None:
+        file_names = os.listdir(input_folder)
+    sources = [os.path.join(input_folder, file_name) for file_name in sorted(file_names)
+               if file_name.endswith('.csv') or file_name.endswith('.zip')]
+    if not sources:
+        print(f"No Datamill CSV or zip files found in {input_folder}")
+        return
+
+    written = set()
+    lock = threading.Lock()
+    workers = workers or min(len(sources), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(lambda file_path: split_datamill_source(file_path, output_folder, written, lock, append, chunk_rows),
+                                 sources))
+    add_rows(sum(rows))
 
     print("Datamill dataset files created successfully.")
 
+def ask_remove_inputs():
+    answer = input("Remove intermediate files after processing? (yes/no, default no): ").strip().lower()
+    return answer in ['y', 'yes']
+
 def main():
     dataset_choice = input("Which dataset do you want to process? (queensland/helios/datamill): ").strip().lower()
 
@@ -162,7 +263,8 @@ def main():
         
         preprocess_queensland(queensland_input_folder, queensland_preprocessed_folder)
         split_queensland(queensland_preprocessed_folder, pulse_folder, pulsetotal_folder)
-        shutil.rmtree("./dataset/queensland/dataset_correct")
+        if ask_remove_inputs():
+            shutil.rmtree("./dataset/queensland/dataset_correct")
         
     elif dataset_choice == 'helios':
         input_folder = './dataset/helios/org_dataset'
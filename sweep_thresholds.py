@@ -0,0 +1,298 @@
+import os
+import numpy as np
+import pandas as pd
+from checkpoint import file_fingerprint, TEMP_SUFFIX
+from feature_engine import CHUNK_ROWS
+from instrumentation import instrument_stage, stage_metrics, add_rows
+from detector_scoring import score_model
+
+ADTK_DETECTORS = ['Threshold', 'IQR', 'Persist', 'LevelShift', 'VolatilityShift']
+
+def parse_grid(text, default):
+    # Comma separated list of numbers, e.g. "0.005,0.01,0.02"
+    try:
+        values = [float(value) for value in text.split(',') if value.strip()]
+    except ValueError:
+        print(f"Invalid grid. Using default values {default}.")
+        return list(default)
+    return values or list(default)
+
+def scores_file(scores_folder, file_path):
+    return os.path.join(scores_folder, os.path.basename(file_path) + '.npz')
+
+def load_cached_scores(cache_file, file_path, models_fingerprint=()):
+    # Cached scores are reused while the source file keeps its size and modification time and, for saved models,
+    # while the scoring model version is the same (see model_store.model_version_fingerprint)
+    if not os.path.exists(cache_file):
+        return None
+    with np.load(cache_file) as data:
+        if list(data['fingerprint']) != file_fingerprint(file_path):
+            return None
+        if 'models_fingerprint' not in data.files or list(data['models_fingerprint']) != list(models_fingerprint):
+            return None
+        return {key: data[key] for key in data.files if key not in ('fingerprint', 'models_fingerprint')}
+
+def save_scores(cache_file, file_path, scores, models_fingerprint=()):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temp_file = cache_file + TEMP_SUFFIX
+    with open(temp_file, 'wb') as f:
+        np.savez(f, fingerprint=np.array(file_fingerprint(file_path)),
+                 models_fingerprint=np.array(models_fingerprint, dtype=np.int64), **scores)
+    os.replace(temp_file, cache_file)
+
+def pyod_scores(file_path, dataset_type, option):
+    # Fits the models of anomaly_with_pyod once per file. Contamination only moves the threshold
+    # over the training scores (IForest scores shift by a constant), so one fit serves the whole grid.
+    from anomaly_with_pyod import prepare_features
+    from pyod.models.iforest import IForest
+    from pyod.models.knn import KNN
+    from pyod.models.lof import LOF
+    from pyod.models.auto_encoder import AutoEncoder
+
+    df, X_scaled = prepare_features(file_path, dataset_type, option)
+    models = {
+        'IForest': IForest(random_state=42),
+        'KNN': KNN(n_neighbors=5),
+        'LOF': LOF(),
+        'AutoEncoder': AutoEncoder(epoch_num=10)
+    }
+
+    scores = {'z_score': df['z_score'].to_numpy(dtype=np.float64)}
+    for model_name, model in models.items():
+        with stage_metrics(f'sweep_thresholds.{model_name}.fit', file_path) as metrics:
+            metrics.add_rows(len(X_scaled))
+            model.fit(X_scaled)
+        scores[f'{model_name}_scores'] = score_model(model, X_scaled)[0]
+        scores[f'{model_name}_train_scores'] = model.decision_scores_
+    return scores
+
+def saved_model_scores(file_path, dataset_type, value_column, models, preprocessing=None):
+    # Scores of the models saved by train_whole_dataset, thresholds come from their training scores
+    from predict_whole_dataset import prepare_features
+    from feature_pipeline import transform_chunks
+
+    if preprocessing is not None:
+        # Features of the saved training preprocessing, transformed and scored block by block
+        z_scores = []
+        model_scores = {model_name: [] for model_name in models}
+        for _, _, X_scaled, z_score in transform_chunks(preprocessing, file_path, value_column):
+            z_scores.append(z_score)
+            for model_name, model in models.items():
+                # Same blocked scoring as predict_whole_dataset, including the AutoEncoder path
+                model_scores[model_name].append(score_model(model, X_scaled)[0])
+        scores = {'z_score': np.concatenate(z_scores).astype(np.float64) if z_scores else np.empty(0)}
+        for model_name, model in models.items():
+            scores[f'{model_name}_scores'] = np.concatenate(model_scores[model_name]) if z_scores else np.empty(0)
+            scores[f'{model_name}_train_scores'] = model.decision_scores_
+        return scores
+
+    df, X_scaled = prepare_features(file_path, dataset_type, value_column)
+    scores = {'z_score': df['z_score'].to_numpy(dtype=np.float64)}
+    for model_name, model in models.items():
+        try:
+            scores[f'{model_name}_scores'] = score_model(model, X_scaled)[0]
+            scores[f'{model_name}_train_scores'] = model.decision_scores_
+        except Exception as e:
+            print(f"Error applying {model_name} model: {str(e)}")
+    return scores
+
+def adtk_scores(file_path, dataset_type, option):
+    # Only ThresholdAD depends on the z-score, the other detectors are run once
+    from adtk.data import validate_series
+    from anomaly_with_adtk import process_datamill, process_helios, process_queensland
+    from adtk.detector import InterQuartileRangeAD, PersistAD, LevelShiftAD, VolatilityShiftAD
+
+    if dataset_type == 'datamill':
+        s = process_datamill(file_path)
+    elif dataset_type == 'helios':
+        s = process_helios(file_path, option)
+    else:
+        s = process_queensland(file_path, option)
+    s = validate_series(s)
+
+    flags = {
+        'IQR': InterQuartileRangeAD(c=1.5).fit_detect(s).fillna(False),
+        'Persist': PersistAD(c=3.0, side='positive').fit_detect(s).fillna(False),
+        'LevelShift': LevelShiftAD(c=2.0, side='both', window=5).fit_detect(s).fillna(False)
+    }
+    try:
+        flags['VolatilityShift'] = VolatilityShiftAD(c=1.5, side='positive', window=30).fit_detect(s).fillna(False)
+    except RuntimeError as e:
+        print(f"VolatilityShiftAD could not be applied: {e}")
+        flags['VolatilityShift'] = pd.Series(False, index=s.index)
+
+    # ThresholdAD flags values outside mean +- z * std, the same as |value - mean| / std > z
+    values = s.to_numpy(dtype=np.float64)
+    scores = {'z_score': (values - s.mean()) / s.std()}
+    for name, flag in flags.items():
+        scores[f'{name}_flags'] = flag.to_numpy(dtype=bool)
+    return scores
+
+def count_grid(z_score, label_mask, label_count, z_grid, chunk_rows=CHUNK_ROWS):
+    # Validated anomaly counts for every (label setting, z) pair as one matrix product per block of rows:
+    # (label_count, rows) label masks x (rows, z values) z masks. NaN z-scores are never validated.
+    # label_mask(start, stop) returns the label masks of one block of rows.
+    z_abs = np.abs(z_score)
+    z_grid = np.asarray(z_grid, dtype=np.float64)
+    counts = np.zeros((label_count, len(z_grid)), dtype=np.float64)
+
+    n = len(z_abs)
+    for start in range(0, n, chunk_rows):
+        stop = min(start + chunk_rows, n)
+        with np.errstate(invalid='ignore'):
+            z_mask = (z_abs[None, start:stop] > z_grid[:, None]).astype(np.float32)
+        labels = label_mask(start, stop).astype(np.float32)
+        counts += labels @ z_mask.T
+    return counts.astype(np.int64)
+
+def label_blocks(model_scores, model_thresholds):
+    # Returns a function that builds the (thresholds, rows) label mask of one block of rows
+    def labels(start, stop):
+        return model_scores[None, start:stop] > model_thresholds[:, None]
+    return labels
+
+def sweep_file_models(scores, model_names, contamination_grid, z_grid):
+    # Rows of (contamination, z, model, count) for the pyod and saved model modes
+    contamination_grid = np.asarray(contamination_grid, dtype=np.float64)
+    z_score = scores['z_score']
+    thresholds = {}
+    for model_name in model_names:
+        if f'{model_name}_scores' in scores:
+            thresholds[model_name] = np.percentile(scores[f'{model_name}_train_scores'], 100 * (1 - contamination_grid))
+
+    rows = []
+    for model_name, model_thresholds in thresholds.items():
+        counts = count_grid(z_score, label_blocks(scores[f'{model_name}_scores'], model_thresholds),
+                            len(contamination_grid), z_grid)
+        rows.extend(grid_rows(model_name, contamination_grid, z_grid, counts))
+
+    # Points flagged by every model, for every contamination value at once
+    def consensus(start, stop):
+        mask = np.ones((len(contamination_grid), stop - start), dtype=bool)
+        for model_name, model_thresholds in thresholds.items():
+            mask &= label_blocks(scores[f'{model_name}_scores'], model_thresholds)(start, stop)
+        return mask
+    if thresholds:
+        rows.extend(grid_rows('all_methods', contamination_grid, z_grid, count_grid(z_score, consensus, len(contamination_grid), z_grid)))
+    return rows
+
+def sweep_file_adtk(scores, z_grid):
+    # ADTK has no contamination setting; the counts only vary with the ThresholdAD z value
+    n = len(scores['z_score'])
+    fixed = {name: scores[f'{name}_flags'] for name in ADTK_DETECTORS[1:]}
+    everywhere = np.ones((1, n), dtype=bool)
+
+    rows = grid_rows('Threshold', [None], z_grid, count_grid(scores['z_score'], lambda start, stop: everywhere[:, start:stop], 1, z_grid))
+    for name, flags in fixed.items():
+        rows.extend(grid_rows(name, [None], z_grid, np.full((1, len(z_grid)), int(flags.sum()))))
+
+    # Consensus needs all fixed detectors to agree and the z-score to pass the threshold
+    agreed = np.logical_and.reduce(list(fixed.values()))[None, :]
+    counts = count_grid(scores['z_score'], lambda start, stop: agreed[:, start:stop], 1, z_grid)
+    rows.extend(grid_rows('all_methods', [None], z_grid, counts))
+    return rows
+
+def grid_rows(model_name, contamination_grid, z_grid, counts):
+    return [{'contamination': contamination, 'z_score_threshold': z, 'model': model_name, 'count': int(counts[i, j])}
+            for i, contamination in enumerate(contamination_grid) for j, z in enumerate(z_grid)]
+
+@instrument_stage()
+def sweep(folder_path, mode, dataset_type, option, contamination_grid, z_grid, scores_folder, output_folder,
+          model_save_path=None, value_column=None):
+    # mode is 'pyod' (per file fits of anomaly_with_pyod), 'models' (saved models of train_whole_dataset) or 'adtk'
+    models = None
+    preprocessing = None
+    models_fingerprint = []
+    if mode == 'models':
+        from predict_whole_dataset import load_models
+        from model_store import load_preprocessing, model_version_fingerprint
+        models = load_models(model_save_path)
+        if not models:
+            print("No models loaded. Exiting.")
+            return None
+        preprocessing = load_preprocessing(model_save_path)
+        # Scores cached for another model version are computed again
+        models_fingerprint = model_version_fingerprint(model_save_path)
+
+    model_names = ['IForest', 'KNN', 'LOF', 'AutoEncoder'] if models is None else list(models)
+    rows = []
+    for filename in sorted(os.listdir(folder_path)):
+        if not filename.endswith('.csv'):
+            continue
+        file_path = os.path.join(folder_path, filename)
+        cache_file = scores_file(scores_folder, file_path)
+
+        try:
+            scores = load_cached_scores(cache_file, file_path, models_fingerprint)
+            if scores is None:
+                print(f"Scoring file: {file_path}")
+                if mode == 'pyod':
+                    scores = pyod_scores(file_path, dataset_type, option)
+                elif mode == 'models':
+                    scores = saved_model_scores(file_path, dataset_type, value_column, models, preprocessing)
+                else:
+                    scores = adtk_scores(file_path, dataset_type, option)
+                save_scores(cache_file, file_path, scores, models_fingerprint)
+            else:
+                print(f"Using cached scores for: {file_path}")
+        except Exception as e:
+            print(f"Error scoring file {file_path}: {str(e)}")
+            continue
+
+        add_rows(len(scores['z_score']))
+        if mode == 'adtk':
+            file_rows = sweep_file_adtk(scores, z_grid)
+        else:
+            file_rows = sweep_file_models(scores, model_names, contamination_grid, z_grid)
+        rows.extend(dict(row, file=filename) for row in file_rows)
+
+    if not rows:
+        print("No files were scored.")
+        return None
+
+    os.makedirs(output_folder, exist_ok=True)
+    table = pd.DataFrame(rows, columns=['file', 'contamination', 'z_score_threshold', 'model', 'count'])
+    table_file = os.path.join(output_folder, f'sweep_{mode}_{dataset_type}_{option}.csv')
+    table.to_csv(table_file, index=False)
+
+    totals = table.groupby(['contamination', 'z_score_threshold', 'model'], dropna=False, sort=False)['count'].sum().reset_index()
+    totals_file = os.path.join(output_folder, f'sweep_{mode}_{dataset_type}_{option}_totals.csv')
+    totals.to_csv(totals_file, index=False)
+
+    print(f"Sweep table saved to {table_file}")
+    print(f"Totals saved to {totals_file}")
+    print(totals.pivot_table(index=['contamination', 'z_score_threshold'], columns='model', values='count', dropna=False).to_string())
+    return table
+
+if __name__ == "__main__":
+    mode = input("Which detector do you want to sweep? (pyod/models/adtk): ").strip().lower()
+    while mode not in ['pyod', 'models', 'adtk']:
+        mode = input("Invalid input. Please enter 'pyod', 'models' or 'adtk': ").strip().lower()
+
+    dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
+    while dataset_type not in ['helios', 'queensland', 'datamill']:
+        dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
+
+    option = input("Enter option (daily/total): ").lower()
+    while option not in ['daily', 'total']:
+        option = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+
+    contamination_grid = [0.01]
+    if mode != 'adtk':
+        contamination_grid = parse_grid(input("Enter contamination values (default 0.005,0.01,0.02,0.05): "), [0.005, 0.01, 0.02, 0.05])
+    z_grid = parse_grid(input("Enter Z-score thresholds (default 1,2,3): "), [1, 2, 3])
+
+    if dataset_type == 'helios':
+        folder_path = './dataset/helios/user_helios_sorted/'
+        value_column = 'diff' if option == 'daily' else 'meter reading'
+    elif dataset_type == 'queensland':
+        folder_path = f'./dataset/queensland/user_sorted_pulse{"tot" if option == "total" else ""}/'
+        value_column = 'Pulse1' if option == 'daily' else 'Pulse1_Total'
+    else:
+        folder_path = './dataset/datamill/user_datamill_sorted/'
+        value_column = 'DAILY_AVERAGE_CONSUMPTION' if option == 'daily' else 'GROSS_CONSUMPTION'
+
+    # Scores are cached per detector so repeated sweeps only redo the threshold step
+    scores_folder = f'./sweep_results/scores/{mode}_{dataset_type}_{option}'
+    sweep(folder_path, mode, dataset_type, option, contamination_grid, z_grid, scores_folder, './sweep_results',
+          model_save_path=f'./models/{dataset_type}/{option}', value_column=value_column)
@@ -0,0 +1,75 @@
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from checkpoint import (PROGRESS_FILE, TEMP_SUFFIX, start_progress, begin_append, complete_unit, unit_done,
+                        finish_progress)
+
+def write(path, text, mode='w'):
+    with open(path, mode) as f:
+        f.write(text)
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+def test_interrupted_append_is_rolled_back(tmp_path):
+    output_folder = str(tmp_path)
+    existing = os.path.join(output_folder, 'meter_1.csv')
+    new = os.path.join(output_folder, 'meter_2.csv')
+    write(existing, 'a,b\n1,2\n')
+
+    progress = start_progress(output_folder, 'sort')
+    begin_append(progress, 'meter_1', existing)
+    write(existing, '3,4\n', 'a')
+    begin_append(progress, 'meter_2', new)
+    write(new, 'a,b\n5,6\n')
+    write(os.path.join(output_folder, 'meter_3.csv' + TEMP_SUFFIX), 'partial')
+    # Interrupted before complete_unit: the next run puts both files back as they were before their units
+
+    progress = start_progress(output_folder, 'sort')
+    assert read(existing) == 'a,b\n1,2\n'
+    assert not os.path.exists(new)
+    assert not os.path.exists(os.path.join(output_folder, 'meter_3.csv' + TEMP_SUFFIX))
+    assert progress['done'] == {}
+
+def test_completed_unit_is_resumed(tmp_path):
+    output_folder = str(tmp_path)
+    input_file = os.path.join(output_folder, 'input.txt')
+    output_file = os.path.join(output_folder, 'meter_1.csv')
+    write(input_file, 'source')
+
+    progress = start_progress(output_folder, 'split')
+    begin_append(progress, 'chunk_0', output_file)
+    write(output_file, 'a,b\n1,2\n')
+    complete_unit(progress, 'chunk_0', [output_file], input_file)
+
+    progress = start_progress(output_folder, 'split')
+    assert progress['resumed']
+    assert unit_done(progress, 'chunk_0', input_file)
+    assert read(output_file) == 'a,b\n1,2\n'
+
+    # A changed output file means the unit has to be redone
+    write(output_file, '3,4\n', 'a')
+    assert not unit_done(progress, 'chunk_0', input_file)
+
+def test_journal_of_another_job_is_discarded(tmp_path):
+    output_folder = str(tmp_path)
+    output_file = os.path.join(output_folder, 'meter_1.csv')
+    progress = start_progress(output_folder, 'split')
+    write(output_file, 'a,b\n')
+    complete_unit(progress, 'chunk_0', [output_file])
+
+    progress = start_progress(output_folder, 'sort')
+    assert not progress['resumed']
+    assert not unit_done(progress, 'chunk_0')
+
+def test_finish_progress_keeps_journal_of_failed_units(tmp_path):
+    output_folder = str(tmp_path)
+    progress = start_progress(output_folder, 'sort')
+    assert not finish_progress(progress, failed=['chunk_1'])
+    assert os.path.exists(os.path.join(output_folder, PROGRESS_FILE))
+    assert finish_progress(progress)
+    assert not os.path.exists(os.path.join(output_folder, PROGRESS_FILE))
@@ -0,0 +1,60 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from data_quality import (DUPLICATE, GAP, RESET, DATAMILL_READING_COLUMNS, detect_quality, frame_quality, save_quality,
+                          load_quality, mask_differences, quality_counts)
+
+def hourly(hours):
+    return pd.Timestamp('2020-01-01') + pd.to_timedelta(hours, unit='h')
+
+def flags_by_row(rows, flags):
+    return dict(zip(rows.tolist(), flags.tolist()))
+
+def test_duplicate_timestamps_are_flagged():
+    rows, flags = detect_quality(hourly([0, 1, 1, 2, 3]))
+    assert flags_by_row(rows, flags) == {2: DUPLICATE}
+
+def test_gap_and_reset_of_a_counter_are_flagged():
+    # Hourly readings with a 10 hour gap before row 4 and a counter that restarts at row 6
+    times = hourly([0, 1, 2, 3, 13, 14, 15, 16])
+    counter = [100, 101, 103, 104, 120, 121, 2, 3]
+    rows, flags = detect_quality(times, counter)
+    assert flags_by_row(rows, flags) == {4: GAP, 6: RESET}
+
+def test_flags_of_one_row_combine():
+    rows, flags = detect_quality(hourly([0, 1, 2, 3, 20]), [10, 11, 12, 13, 5])
+    assert flags_by_row(rows, flags) == {4: GAP | RESET}
+    assert quality_counts(flags) == {'duplicates': 0, 'gaps': 1, 'resets': 1}
+
+def test_gaps_and_resets_need_a_counter():
+    rows, flags = detect_quality(hourly([0, 1, 2, 3, 13]))
+    assert len(rows) == 0
+
+def test_datamill_duplicates_need_the_same_reading():
+    # Two meters of a postcode file share a start date; only the repeated reading of one meter is a duplicate
+    df = pd.DataFrame({
+        'READING_START_DATE': pd.to_datetime(['2020-01-01', '2020-01-01', '2020-01-01', '2020-02-01']),
+        'READING_END_DATE': ['31/01/2020', '31/01/2020', '31/01/2020', '29/02/2020'],
+        'READING_START_READING': [10, 55, 10, 20]
+    })
+    rows, flags = frame_quality(df, 'READING_START_DATE', reading_columns=DATAMILL_READING_COLUMNS)
+    assert flags_by_row(rows, flags) == {2: DUPLICATE}
+
+def test_sidecar_masks_differences_until_the_file_changes(tmp_path):
+    csv_path = str(tmp_path / 'meter.csv')
+    pd.DataFrame({'meter reading': [1, 2, 3, 4]}).to_csv(csv_path, index=False)
+    save_quality(csv_path, np.array([2]), np.array([RESET], dtype=np.uint8))
+
+    df = pd.read_csv(csv_path)
+    df['diff'] = df['meter reading'].diff()
+    mask_differences(df, csv_path)
+    assert df['diff'].isna().tolist() == [True, False, True, False]
+
+    # A sidecar of an older version of the file is ignored
+    pd.DataFrame({'meter reading': [1, 2, 3, 4, 5]}).to_csv(csv_path, index=False)
+    assert load_quality(csv_path) is None
@@ -0,0 +1,60 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from feature_engine import rolling_window_stats, max_z_score
+
+WINDOWS = [1, 7, 24, 300, 5000]
+
+def reference_stats(x, window):
+    # pandas rolling for the NaN layout, mean, min and max. The std and z-score are computed two-pass per window,
+    # because pandas' running sums lose the variance of large counter readings (about 4e-5 relative at 7 rows).
+    rolling = pd.Series(x).rolling(window)
+    expected = {'mean': rolling.mean().to_numpy(), 'min': rolling.min().to_numpy(), 'max': rolling.max().to_numpy(),
+                'std': np.full(len(x), np.nan), 'z': np.full(len(x), np.nan)}
+    if 1 < window <= len(x):
+        windows = np.lib.stride_tricks.sliding_window_view(x, window)
+        mean = windows.mean(axis=1)
+        std = np.sqrt(((windows - mean[:, None]) ** 2).sum(axis=1) / (window - 1))
+        expected['std'][window - 1:] = std
+        expected['z'][window - 1:] = (x[window - 1:] - mean) / std
+    return expected
+
+def series(kind, n=2000):
+    rng = np.random.default_rng(0)
+    if kind == 'noise':
+        return rng.normal(50, 10, n)
+    if kind == 'trend':
+        # A meter counter: large and growing, where uncentred sums lose the variance to rounding
+        return 1e7 + np.cumsum(rng.uniform(0, 5, n))
+    x = rng.normal(50, 10, n)
+    x[rng.choice(n, 40, replace=False)] = np.nan
+    x[1000:1030] = np.nan
+    return x
+
+@pytest.mark.parametrize('kind', ['noise', 'trend', 'missing'])
+def test_rolling_window_stats_match_reference(kind):
+    x = series(kind)
+    results = rolling_window_stats(x, WINDOWS, ['mean', 'std', 'min', 'max', 'z'])
+    for window in WINDOWS:
+        for stat, values in reference_stats(x, window).items():
+            np.testing.assert_allclose(results[window][stat], values, rtol=1e-9, atol=1e-9, equal_nan=True,
+                                       err_msg=f"{stat} of window {window}")
+
+def test_rolling_window_stats_of_a_short_series_are_nan():
+    results = rolling_window_stats(np.arange(5.0), [7], ['mean', 'std'])
+    assert np.isnan(results[7]['mean']).all()
+    assert np.isnan(results[7]['std']).all()
+
+@pytest.mark.parametrize('window', [7, 24])
+def test_max_z_score_bounds_the_trailing_z_score(window):
+    x = np.zeros(100)
+    x[-1] = 1e6
+    z = rolling_window_stats(x, [window], ['z'])[window]['z']
+    assert np.nanmax(z) <= max_z_score(window) + 1e-9
+    assert np.nanmax(z) == pytest.approx(max_z_score(window))
@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+
+# Startup regression check: the CLI and the module of every command must import within their time budget and
+# without loading a detector or plotting backend. The same measurement as the imports benchmark.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmark_pipeline import measure_import, CLI_IMPORT_BUDGET, COMMAND_IMPORT_BUDGET
+from cli import COMMAND_MODULES
+
+def test_cli_import_within_budget():
+    result = measure_import('cli')
+    assert result['loaded'] == []
+    assert result['seconds'] <= CLI_IMPORT_BUDGET
+
+@pytest.mark.parametrize('module', sorted({module for modules in COMMAND_MODULES.values() for module in modules}))
+def test_command_module_import_within_budget(module):
+    result = measure_import(module)
+    assert result['loaded'] == []
+    assert result['seconds'] <= COMMAND_IMPORT_BUDGET
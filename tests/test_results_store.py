@@ -0,0 +1,85 @@
+import os
+import sys
+import sqlite3
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from results_store import CONSENSUS, open_store, start_run, insert_detections, meter_anomalies, top_meters
+
+def store_meter(conn, run_id, meter, times, validated, values=None):
+    validated = np.asarray(validated, dtype=bool)
+    insert_detections(conn, run_id, 'helios', meter, pd.to_datetime(times),
+                      {'IForest': (np.arange(len(times), dtype=float), validated, validated),
+                       CONSENSUS: (None, validated, validated)}, values)
+
+def test_meter_anomalies_between_dates(tmp_path):
+    conn = open_store(str(tmp_path / 'anomalies.db'))
+    run_id = start_run(conn, 'pyod', 'helios', 'total')
+    store_meter(conn, run_id, 'meter_1', ['2020-01-01', '2020-01-02', '2020-01-03', '2020-01-04'],
+                [True, False, True, True], [1.0, 2.0, np.nan, 4.0])
+
+    result = meter_anomalies(conn, 'helios', 'meter_1', '2020-01-02', '2020-01-03')
+    assert result['datetime'].tolist() == [pd.Timestamp('2020-01-03')]
+    assert result['value'].isna().tolist() == [True]
+
+    result = meter_anomalies(conn, 'helios', 'meter_1', model='IForest', validated_only=False)
+    assert len(result) == 4
+    assert result['score'].tolist() == [0.0, 1.0, 2.0, 3.0]
+
+def test_rows_sharing_a_timestamp_are_all_kept(tmp_path):
+    conn = open_store(str(tmp_path / 'anomalies.db'))
+    run_id = start_run(conn, 'pyod', 'helios')
+    store_meter(conn, run_id, 'meter_1', ['2020-01-01', '2020-01-01', '2020-01-02'], [True, True, False], [1.0, 2.0, 3.0])
+    assert meter_anomalies(conn, 'helios', 'meter_1')['value'].tolist() == [1.0, 2.0]
+
+    # Storing the meter again in the same run replaces its rows instead of adding to them
+    store_meter(conn, run_id, 'meter_1', ['2020-01-01', '2020-01-02'], [False, True], [5.0, 6.0])
+    assert meter_anomalies(conn, 'helios', 'meter_1')['value'].tolist() == [6.0]
+    assert meter_anomalies(conn, 'helios', 'meter_1', validated_only=False)['value'].tolist() == [5.0, 6.0]
+
+def test_top_meters_of_the_latest_run(tmp_path):
+    conn = open_store(str(tmp_path / 'anomalies.db'))
+    old_run = start_run(conn, 'pyod', 'helios')
+    store_meter(conn, old_run, 'meter_1', ['2020-01-01', '2020-01-02'], [True, True])
+    run_id = start_run(conn, 'pyod', 'helios')
+    times = ['2020-01-01', '2020-01-02', '2020-01-03']
+    store_meter(conn, run_id, 'meter_1', times, [False, False, True])
+    store_meter(conn, run_id, 'meter_2', times, [True, True, False])
+    store_meter(conn, run_id, 'meter_3', times, [False, False, False])
+
+    result = top_meters(conn, 'helios', n=2)
+    assert result['meter'].tolist() == ['meter_2', 'meter_1']
+    assert result['validated'].tolist() == [2, 1]
+    assert result['rows'].tolist() == [3, 3]
+    assert top_meters(conn, 'helios', run_id=old_run)['validated'].tolist() == [2]
+
+def test_store_without_occurrence_is_migrated(tmp_path):
+    db_path = str(tmp_path / 'anomalies.db')
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE runs (run_id INTEGER PRIMARY KEY, detector TEXT NOT NULL, dataset TEXT NOT NULL, option TEXT,
+                           created TEXT NOT NULL, settings TEXT);
+        CREATE TABLE meters (meter_id INTEGER PRIMARY KEY, dataset TEXT NOT NULL, meter TEXT NOT NULL, UNIQUE (dataset, meter));
+        CREATE TABLE models (model_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+        CREATE TABLE detections (meter_id INTEGER NOT NULL, ts INTEGER NOT NULL, run_id INTEGER NOT NULL,
+                                 model_id INTEGER NOT NULL, value REAL, z_score REAL, score REAL, anomaly INTEGER NOT NULL,
+                                 validated INTEGER NOT NULL, PRIMARY KEY (meter_id, ts, run_id, model_id)) WITHOUT ROWID;
+        CREATE INDEX detections_validated ON detections (run_id, model_id, meter_id, ts) WHERE validated = 1;
+        INSERT INTO runs VALUES (1, 'pyod', 'helios', 'total', '2020-01-01T00:00:00', '{}');
+        INSERT INTO meters VALUES (1, 'helios', 'meter_1');
+        INSERT INTO models VALUES (1, 'all_methods');
+        INSERT INTO detections VALUES (1, 1577836800, 1, 1, 7.0, NULL, NULL, 1, 1);
+    """)
+    conn.close()
+
+    conn = open_store(db_path)
+    result = meter_anomalies(conn, 'helios', 'meter_1')
+    assert result['datetime'].tolist() == [pd.Timestamp('2020-01-01')]
+    assert result['value'].tolist() == [7.0]
+    # New rows sharing a timestamp can be stored in the migrated table
+    run_id = start_run(conn, 'pyod', 'helios')
+    store_meter(conn, run_id, 'meter_1', ['2020-01-01', '2020-01-01'], [True, True], [1.0, 2.0])
+    assert meter_anomalies(conn, 'helios', 'meter_1')['value'].tolist() == [1.0, 2.0]
@@ -0,0 +1,92 @@
+import io
+import os
+import numpy as np
+import pandas as pd
+from checkpoint import file_fingerprint, TEMP_SUFFIX
+from feature_engine import DATETIME_COLUMNS
+from date_parsing import parse_datetimes
+
+# Sparse time index written next to every sorted meter file: the timestamp and byte offset of every
+# INDEX_EVERY-th row. A time window is then read by seeking to the nearest indexed rows around it.
+INDEX_SUFFIX = '.tidx'
+INDEX_EVERY = 1000
+
+def index_path(csv_path):
+    return csv_path + INDEX_SUFFIX
+
+def build_time_index(csv_path, dataset_type, sep=',', every=INDEX_EVERY):
+    # Scans a time-sorted CSV once and saves (timestamps in seconds, byte offsets) of every 'every'-th row.
+    # The CSV fingerprint is saved with them, so an index of an older version of the file is never used.
+    time_column, time_format = DATETIME_COLUMNS[dataset_type]
+    offsets = []
+    times = []
+    with open(csv_path, 'rb') as f:
+        header = f.readline().decode().rstrip('\r\n').split(sep)
+        position = header.index(time_column)
+        offset = f.tell()
+        row = 0
+        for line in f:
+            if row % every == 0:
+                offsets.append(offset)
+                times.append(line.decode().split(sep, position + 1)[position].strip().strip('"'))
+            offset += len(line)
+            row += 1
+
+    times = pd.to_datetime(pd.Series(times, dtype=object), format=time_format).to_numpy(dtype='datetime64[s]').astype(np.int64)
+    temp_file = index_path(csv_path) + TEMP_SUFFIX
+    with open(temp_file, 'wb') as f:
+        np.savez(f, times=times, offsets=np.array(offsets, dtype=np.int64), rows=np.array([row, every]),
+                 fingerprint=np.array(file_fingerprint(csv_path), dtype=np.int64))
+    os.replace(temp_file, index_path(csv_path))
+    return index_path(csv_path)
+
+def load_time_index(csv_path):
+    # Returns (times, offsets), or None when the index is missing or belongs to another version of the file
+    path = index_path(csv_path)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as index:
+        if list(index['fingerprint']) != file_fingerprint(csv_path):
+            return None
+        return index['times'], index['offsets']
+
+def indexed_row_count(csv_path):
+    # Number of data rows of the file, or None when the index is missing or belongs to another version of the file
+    path = index_path(csv_path)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as index:
+        if list(index['fingerprint']) != file_fingerprint(csv_path):
+            return None
+        return int(index['rows'][0])
+
+def read_time_window(csv_path, dataset_type, start=None, end=None, sep=','):
+    # Rows of a time-sorted CSV between start and end (inclusive). With a valid time index only the bytes
+    # between the indexed rows around the window are read, so the cost does not depend on the file length.
+    time_column, time_format = DATETIME_COLUMNS[dataset_type]
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+
+    index = load_time_index(csv_path)
+    if index is None:
+        print(f"No valid time index for {os.path.basename(csv_path)}, reading the whole file")
+        df = pd.read_csv(csv_path, sep=sep)
+    else:
+        times, offsets = index
+        # Last indexed row before the start and first indexed row after the end; the rows of the window lie between them
+        low = np.searchsorted(times, start.timestamp(), side='left') - 1 if start is not None else 0
+        high = np.searchsorted(times, end.timestamp(), side='right') if end is not None else len(times)
+        with open(csv_path, 'rb') as f:
+            header = f.readline()
+            first = offsets[max(low, 0)] if len(offsets) else f.tell()
+            f.seek(first)
+            data = f.read(offsets[high] - first) if high < len(offsets) else f.read()
+        df = pd.read_csv(io.BytesIO(header + data), sep=sep)
+
+    timestamps = parse_datetimes(df[time_column], format=time_format)
+    selected = np.ones(len(df), dtype=bool)
+    if start is not None:
+        selected &= (timestamps >= start).to_numpy()
+    if end is not None:
+        selected &= (timestamps <= end).to_numpy()
+    return df[selected].reset_index(drop=True)
@@ -1,54 +1,45 @@
 import os
+import functools
 import pandas as pd
 import numpy as np
-from pyod.models.iforest import IForest
-from pyod.models.knn import KNN
-from pyod.models.lof import LOF
-from pyod.models.auto_encoder import AutoEncoder
-from sklearn.preprocessing import StandardScaler
-import joblib
-
-def process_file(file_path, value_column, contamination=0.01):
+from instrumentation import instrument_stage, stage_metrics, add_rows
+from date_parsing import parse_datetimes
+from model_store import save_model_version, load_model_version, latest_model_version
+from feature_engine import load_series, build_feature_matrix
+from feature_pipeline import FEATURES, WINDOW_SIZE, dataset_for_column, make_preprocessing
+from prefetch import prefetch_files
+from data_quality import masked_rows, row_mask, mask_differences
+
+# Maximum number of raw feature rows kept as the KNN/LOF reference set and for threshold refreshes
+REFERENCE_SAMPLE_SIZE = 20000
+
+@instrument_stage()
+def process_file(file_path, value_column, contamination=0.01, scale=True, lean=False):
+    from sklearn.preprocessing import StandardScaler
+
     print(f"Processing file: {file_path}")
     try:
+        if lean:
+            return process_file_lean(file_path, value_column, scale)
+
         # Read the CSV file
         df = pd.read_csv(file_path)
+        add_rows(len(df))
         if value_column == 'GROSS_CONSUMPTION' or value_column =='DAILY_AVERAGE_CONSUMPTION':
-            df['datetime'] = pd.to_datetime(df['READING_START_DATE'], format='%d/%m/%Y %H:%M')
+            df['datetime'] = parse_datetimes(df['READING_START_DATE'], format='%d/%m/%Y %H:%M')
         else:
 
-            df['datetime'] = pd.to_datetime(df['datetime'], format='%d/%m/%Y %H:%M:%S')
+            df['datetime'] = parse_datetimes(df['datetime'], format='%d/%m/%Y %H:%M:%S')
         df = df.sort_values('datetime')
 
         print(f"DataFrame shape: {df.shape}")
         print(f"Columns: {df.columns}")
 
-        # Extract hour and day of week
-        df['hour'] = df['datetime'].dt.hour
-        df['day_of_week'] = df['datetime'].dt.dayofweek
+        X = compute_features(df, value_column, file_path)
 
-        # Calculate rolling statistics
-        window_size = 7
-        df['diff'] = df[value_column].diff()
-        df['rolling_mean'] = df['diff'].rolling(window=window_size).mean()
-        df['rolling_std'] = df['diff'].rolling(window=window_size).std()
-
-        # Calculate Z-scores
-        df['z_score'] = (df['diff'] - df['rolling_mean']) / df['rolling_std']
-
-        # Prepare features for anomaly detection
-        features = ['diff', 'day_of_week', 'rolling_mean', 'rolling_std']
-
-        # Handle NaN values
-        df[features] = df[features].fillna(df[features].mean())
-        
-        # Check for remaining NaN values
-        if df[features].isnull().values.any():
-            print("NaN values found after filling with mean:")
-            print(df[features].isnull().sum())
-            df[features] = df[features].fillna(0)  # Fallback to filling NaNs with 0 if any are left
-
-        X = df[features].values
+        # Raw features are scaled later by a scaler shared across files
+        if not scale:
+            return X
 
         # Standardize the features
         scaler = StandardScaler()
@@ -59,7 +50,62 @@ def process_file(file_path, value_column, contamination=0.01):
         print(f"Error processing file {file_path}: {str(e)}")
         return None
 
-def train_and_save_models(folder_path, value_column, model_save_path, contamination=0.01):
+def compute_features(df, value_column, csv_path=None):
+    # Extract hour and day of week
+    df['hour'] = df['datetime'].dt.hour
+    df['day_of_week'] = df['datetime'].dt.dayofweek
+
+    # Calculate rolling statistics
+    window_size = 7
+    df['diff'] = df[value_column].diff()
+    if csv_path is not None:
+        # Duplicates, gaps and counter resets flagged by the sort stage are not consumption
+        mask_differences(df, csv_path)
+    df['rolling_mean'] = df['diff'].rolling(window=window_size).mean()
+    df['rolling_std'] = df['diff'].rolling(window=window_size).std()
+
+    # Calculate Z-scores
+    df['z_score'] = (df['diff'] - df['rolling_mean']) / df['rolling_std']
+
+    # Prepare features for anomaly detection
+    features = ['diff', 'day_of_week', 'rolling_mean', 'rolling_std']
+
+    # Handle NaN values
+    df[features] = df[features].fillna(df[features].mean())
+    
+    # Check for remaining NaN values
+    if df[features].isnull().values.any():
+        print("NaN values found after filling with mean:")
+        print(df[features].isnull().sum())
+        df[features] = df[features].fillna(0)  # Fallback to filling NaNs with 0 if any are left
+
+    return df[features].values
+
+def process_file_lean(file_path, value_column, scale=True):
+    from sklearn.preprocessing import StandardScaler
+
+    # Same features as process_file, built from two columns into one float32 matrix without a full DataFrame
+    timestamps, values = load_series(file_path, dataset_for_column(value_column), value_column)
+    add_rows(len(values))
+
+    rows = masked_rows(file_path)
+    X, _ = build_feature_matrix(timestamps, values, FEATURES, window_size=WINDOW_SIZE,
+                                masked=row_mask(rows, 0, len(values)) if len(rows) else None)
+    if not scale:
+        return X
+    return StandardScaler().fit_transform(X)
+
+@instrument_stage()
+def train_and_save_models(folder_path, value_column, model_save_path, contamination=0.01, lean=False,
+                          tuned_autoencoder=False, compute_dtype='float32'):
+    # Detector backends are imported here, so importing this module stays fast
+    from pyod.models.iforest import IForest
+    from pyod.models.knn import KNN
+    from pyod.models.lof import LOF
+    from pyod.models.auto_encoder import AutoEncoder
+    from sklearn.preprocessing import StandardScaler
+    from autoencoder_cpu import cpu_autoencoder, fit_autoencoder_cpu
+
     print(f"Starting training with folder_path: {folder_path}")
 
     # Define models
@@ -67,94 +113,239 @@ def train_and_save_models(folder_path, value_column, model_save_path, contaminat
         'IForest': IForest(contamination=contamination, random_state=42),
         'KNN': KNN(contamination=contamination, n_neighbors=5),
         'LOF': LOF(contamination=contamination),
-        'AutoEncoder': AutoEncoder(contamination=contamination)
+        'AutoEncoder': cpu_autoencoder(contamination) if tuned_autoencoder else AutoEncoder(contamination=contamination)
     }
 
     try:
         file_list = os.listdir(folder_path)
         print(f"Files in directory: {file_list}")
         
-        X_combined = []
+        X_raw = []
 
-        for filename in file_list:
-            if filename.endswith('.csv'):
-                file_path = os.path.join(folder_path, filename)
+        # One scaler for the whole dataset, saved with the models so it can be updated later
+        scaler = StandardScaler()
 
-                X_scaled = process_file(file_path, value_column, contamination)
-                if X_scaled is not None:
-                    X_combined.append(X_scaled)
+        # Files are read and turned into features in background threads, a few files ahead of the scaler
+        file_paths = [os.path.join(folder_path, filename) for filename in file_list if filename.endswith('.csv')]
+        load = functools.partial(process_file, value_column=value_column, contamination=contamination, scale=False, lean=lean)
+        for file_path, X in prefetch_files(file_paths, load):
+            if X is not None:
+                scaler.partial_fit(X)
+                X_raw.append(X)
 
-        if X_combined:
-            X_combined = np.vstack(X_combined)
+        if X_raw:
+            X_raw = np.vstack(X_raw)
+            X_combined = scaler.transform(X_raw)
             print(f"Combined feature matrix shape: {X_combined.shape}")
-
-            # Ensure the model save path exists
-            os.makedirs(model_save_path, exist_ok=True)
+            add_rows(len(X_combined))
 
             for model_name, model in models.items():
-                model.fit(X_combined)
-                model_filename = os.path.join(model_save_path, f'{model_name}_model.pkl')
-                joblib.dump(model, model_filename)
-                print(f"Saved {model_name} model to {model_filename}")
+                with stage_metrics(f'train_whole_dataset.{model_name}.fit') as metrics:
+                    metrics.add_rows(len(X_combined))
+                    if model_name == 'AutoEncoder' and tuned_autoencoder:
+                        fit_autoencoder_cpu(model, X_combined, compute_dtype=compute_dtype)
+                    else:
+                        model.fit(X_combined)
+
+            # Uniform sample of the training rows for later incremental updates
+            rng = np.random.default_rng(42)
+            sample = rng.choice(len(X_raw), size=min(REFERENCE_SAMPLE_SIZE, len(X_raw)), replace=False)
+            save_model_version(model_save_path, 1, models, scaler, X_raw[np.sort(sample)], len(X_raw),
+                               make_preprocessing(value_column, scaler))
 
     except Exception as e:
         print(f"Error in training and saving models: {str(e)}")
 
-# Set the dataset type and value column based on the user's choice
-dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
-while dataset_type not in ['helios', 'queensland', 'datamill']:
-    dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
+def update_reservoir(reference, seen, X_new, max_size, rng):
+    # Reservoir sampling: after the update every row seen so far is in the sample with equal probability
+    if len(reference) > max_size:
+        reference = reference[np.sort(rng.choice(len(reference), size=max_size, replace=False))]
+    fill = min(max(max_size - len(reference), 0), len(X_new))
+    reference = np.vstack([reference, X_new[:fill]])
+    rest = X_new[fill:]
+    if len(rest):
+        positions = seen + fill + np.arange(1, len(rest) + 1)
+        slots = (rng.random(len(rest)) * positions).astype(np.int64)
+        accepted = slots < max_size
+        reference[slots[accepted]] = rest[accepted]
+    return reference, seen + len(X_new)
+
+def update_iforest(model, X_new, new_trees, rotate_trees, seed):
+    # Grow trees on the new rows only, then drop the same number of the oldest trees
+    forest = model.detector_
+    forest.warm_start = True
+    forest.random_state = seed
+    forest.n_estimators = len(forest.estimators_) + new_trees
+    forest.fit(X_new)
+
+    if rotate_trees:
+        forest.estimators_ = forest.estimators_[new_trees:]
+        forest.estimators_features_ = forest.estimators_features_[new_trees:]
+        forest._average_path_length_per_tree = forest._average_path_length_per_tree[new_trees:]
+        forest._decision_path_lengths = forest._decision_path_lengths[new_trees:]
+        forest.n_estimators = len(forest.estimators_)
+    model.n_estimators = forest.n_estimators
+
+def warm_start_autoencoder(model, X_new, epochs):
+    import torch
+    from pyod.utils.torch_utility import TorchDataset
+
+    # Continue training the fitted network and optimizer state on the new rows only
+    train_set = TorchDataset(X=X_new, y=None, mean=model.X_mean, std=model.X_std) if model.preprocessing else TorchDataset(X=X_new, y=None)
+    train_loader = torch.utils.data.DataLoader(
+        dataset=train_set, batch_size=model.batch_size,
+        shuffle=True, drop_last=len(X_new) > model.batch_size)
+
+    epoch_num = model.epoch_num
+    model.epoch_num = epochs
+    model.model.train()
+    model.train(train_loader)
+    model.epoch_num = epoch_num
+
+def refresh_threshold(model, X_reference):
+    # Recompute the contamination threshold on the reference sample so it reflects all data seen
+    model.decision_scores_ = model.decision_function(X_reference)
+    model._process_decision_scores()
 
-if dataset_type == 'helios':
-    folder_path = './dataset/helios/user_helios_sorted'
+@instrument_stage()
+def update_models(folder_path, value_column, model_save_path, file_names=None, new_trees=10, rotate_trees=True,
+                  update_epochs=2, reference_size=REFERENCE_SAMPLE_SIZE, lean=False):
+    print(f"Starting model update with folder_path: {folder_path}")
+
+    version = latest_model_version(model_save_path)
+    if version is None:
+        print(f"No trained models found in {model_save_path}. Train the models first.")
+        return None
+
+    models, scaler, reference, seen = load_model_version(model_save_path, version)
+    if scaler is None or reference is None:
+        print(f"Models in {model_save_path} were saved without a scaler or reference sample. Retrain them first.")
+        return None
+
+    if file_names is None:
+        file_names = os.listdir(folder_path)
+
+    X_new = []
+    file_paths = [os.path.join(folder_path, filename) for filename in file_names if filename.endswith('.csv')]
+    for file_path, X in prefetch_files(file_paths, functools.partial(process_file, value_column=value_column, scale=False, lean=lean)):
+        if X is not None:
+            X_new.append(X)
+
+    if not X_new:
+        print("No new feature rows found.")
+        return None
+
+    X_new = np.vstack(X_new)
+    add_rows(len(X_new))
+    print(f"New feature matrix shape: {X_new.shape}")
+
+    # Scaler statistics are merged with the new rows instead of being refitted
+    scaler.partial_fit(X_new)
+    X_new_scaled = scaler.transform(X_new)
+
+    rng = np.random.default_rng(42 + version)
+    reference, seen = update_reservoir(reference, seen, X_new, reference_size, rng)
+    X_reference = scaler.transform(reference)
+
+    if 'IForest' in models:
+        with stage_metrics('train_whole_dataset.IForest.update') as metrics:
+            metrics.add_rows(len(X_new_scaled))
+            update_iforest(models['IForest'], X_new_scaled, new_trees, rotate_trees, seed=42 + version)
+            refresh_threshold(models['IForest'], X_reference)
+
+    if 'AutoEncoder' in models:
+        with stage_metrics('train_whole_dataset.AutoEncoder.update') as metrics:
+            metrics.add_rows(len(X_new_scaled))
+            warm_start_autoencoder(models['AutoEncoder'], X_new_scaled, update_epochs)
+            refresh_threshold(models['AutoEncoder'], X_reference)
+
+    # Neighbour models are refitted on the bounded reference sample, so their cost does not grow with history
+    for model_name in ['KNN', 'LOF']:
+        if model_name in models:
+            with stage_metrics(f'train_whole_dataset.{model_name}.update') as metrics:
+                metrics.add_rows(len(X_reference))
+                models[model_name].fit(X_reference)
+
+    save_model_version(model_save_path, version + 1, models, scaler, reference, seen, make_preprocessing(value_column, scaler))
+    print(f"Saved model version {version + 1} ({seen} rows seen in total)")
+    return version + 1
+
+if __name__ == "__main__":
+    # Set the dataset type and value column based on the user's choice
+    dataset_type = input("Enter dataset type (helios/queensland/datamill): ").lower()
+    while dataset_type not in ['helios', 'queensland', 'datamill']:
+        dataset_type = input("Invalid input. Please enter 'helios', 'queensland', or 'datamill': ").lower()
+
+    if dataset_type == 'helios':
+        folder_path = './dataset/helios/user_helios_sorted'
     
-    value_type = input("Enter data type (daily/total): ").lower()
+        value_type = input("Enter data type (daily/total): ").lower()
     
-    while value_type not in ['daily', 'total']:
-        value_type = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+        while value_type not in ['daily', 'total']:
+            value_type = input("Invalid input. Please enter 'daily' or 'total': ").lower()
     
-    if value_type == 'daily':
-        model_save_path = './models/helios/daily'
-        value_column = 'diff'
-    else:
-        model_save_path = './models/helios/total'
-        value_column = 'meter reading'
+        if value_type == 'daily':
+            model_save_path = './models/helios/daily'
+            value_column = 'diff'
+        else:
+            model_save_path = './models/helios/total'
+            value_column = 'meter reading'
 
-elif dataset_type == 'queensland':
+    elif dataset_type == 'queensland':
     
-    value_type = input("Enter data type (daily/total): ").lower()
+        value_type = input("Enter data type (daily/total): ").lower()
     
-    while value_type not in ['daily', 'total']:
-        value_type = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+        while value_type not in ['daily', 'total']:
+            value_type = input("Invalid input. Please enter 'daily' or 'total': ").lower()
     
-    if value_type == 'daily':
-        folder_path = './dataset/queensland/user_sorted_pulse'
-        model_save_path = './models/queensland/daily'
-        value_column = 'Pulse1'
+        if value_type == 'daily':
+            folder_path = './dataset/queensland/user_sorted_pulse'
+            model_save_path = './models/queensland/daily'
+            value_column = 'Pulse1'
+        else:
+            folder_path = './dataset/queensland/user_sorted_pulsetot'
+            model_save_path = './models/queensland/total'
+            value_column = 'Pulse1_Total'
+
     else:
-        folder_path = './dataset/queensland/user_sorted_pulsetot'
-        model_save_path = './models/queensland/total'
-        value_column = 'Pulse1_Total'
-
-else:
-    folder_path = './dataset/datamill/user_datamill_sorted'  # Replace with the actual path
-    value_type = input("Enter data type (daily/total): ").lower()
-    while value_type not in ['daily', 'total']:
-        value_type = input("Invalid input. Please enter 'daily' or 'total': ").lower()
+        folder_path = './dataset/datamill/user_datamill_sorted'  # Replace with the actual path
+        value_type = input("Enter data type (daily/total): ").lower()
+        while value_type not in ['daily', 'total']:
+            value_type = input("Invalid input. Please enter 'daily' or 'total': ").lower()
     
-    if value_type == 'daily':
-        model_save_path = './models/datamill/daily/'
-        value_column = 'DAILY_AVERAGE_CONSUMPTION'
+        if value_type == 'daily':
+            model_save_path = './models/datamill/daily/'
+            value_column = 'DAILY_AVERAGE_CONSUMPTION'
+        else:
+            model_save_path = './models/datamill/total/'
+            value_column = 'GROSS_CONSUMPTION'
+
+    mode = input("Enter mode (train/update): ").lower()
+    while mode not in ['train', 'update']:
+        mode = input("Invalid input. Please enter 'train' or 'update': ").lower()
+
+    if mode == 'update':
+        # Only the files with new meter data are used for an update
+        folder_path = input(f"Enter folder with the new data files (default {folder_path}): ").strip() or folder_path
     else:
-        model_save_path = './models/datamill/total/'
-        value_column = 'GROSS_CONSUMPTION'
-
-print(f"Selected dataset type: {dataset_type}")
-print(f"Selected pulse type: {value_column}")
-print(f"Folder path: {folder_path}")
-print(f"Model save path: {model_save_path}")
-
-try:
-    train_and_save_models(folder_path, value_column, model_save_path, contamination=0.01)
-except Exception as e:
-    print(f"An error occurred: {str(e)}")
+        tuned_autoencoder = input("Use the tuned CPU AutoEncoder training with early stopping? (yes/no, default no): ").strip().lower() in ['y', 'yes']
+        compute_dtype = 'float32'
+        if tuned_autoencoder:
+            compute_dtype = input("Enter AutoEncoder compute type (float32/bfloat16, default float32): ").strip().lower() or 'float32'
+            if compute_dtype not in ['float32', 'bfloat16']:
+                print("Invalid compute type. Using default value of float32.")
+                compute_dtype = 'float32'
+
+    print(f"Selected dataset type: {dataset_type}")
+    print(f"Selected pulse type: {value_column}")
+    print(f"Folder path: {folder_path}")
+    print(f"Model save path: {model_save_path}")
+
+    try:
+        if mode == 'update':
+            update_models(folder_path, value_column, model_save_path, lean=True)
+        else:
+            train_and_save_models(folder_path, value_column, model_save_path, contamination=0.01, lean=True,
+                                  tuned_autoencoder=tuned_autoencoder, compute_dtype=compute_dtype)
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")